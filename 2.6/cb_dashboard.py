@@ -21,7 +21,8 @@ st.markdown("""Citi Bike experiences availability issues at certain times, and t
 
 ########################## Import data ###########################################################################################
 
-df_analysis = pd.read_csv('subset_newyork_data.csv', index_col = 0)
+# Only the columns used by the line chart are parsed
+df_analysis = pd.read_csv('subset_newyork_data.csv', usecols = ['date', 'trip_count', 'avgTemp'])
 top20 = pd.read_csv('top20.csv', index_col = 0)
 
 
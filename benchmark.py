@@ -0,0 +1,389 @@
+################################################ CITIBIKES BENCHMARKS #####################################################
+# Synthetic tripdata and timings of the pipeline stages, to tell whether a change makes things faster.
+#
+# generate_tripdata writes monthly YYYYMM-citibike-tripdata.csv files with the columns and formats of the Citi Bike
+# exports, so the real ingestion code runs on them unchanged:
+#   - station popularity is skewed (Zipf-like weights over a shuffled station list), and a share of trips are round trips
+#   - the trips per day follow the synthetic temperature curve of weather_stub.py (fewer trips on cold days, fewer on
+#     weekends); the matching daily avgTemp is written to weather.csv next to the trips
+#   - the electric share grows over the year, docked bikes are only ridden by casual riders, members ride less in summer
+#   - electric bikes report GPS coordinates around the station, a few trips have no end station or end coordinates
+#
+# run_suite generates (or reuses) the data for every scale and times the stages below. Every stage is one record of
+# benchmarks.jsonl (run id, commit, scale, stage, seconds, rows per second), so runs of different commits and
+# machines can be compared with the compare command.
+#
+#     ingest            CSVs -> trip store with the per-file aggregates (2.2, ingest.py)
+#     cube              merge of the per-file cube deltas (trip_cube.py)
+#     daily_facts       the daily trip_count merge of 2.4: daily counts of the cube joined with the weather
+#     station_locations coordinate resolution of 2.5: one lat/lng per station name from every trip end, reading the
+#                       trips included (stations.station_locations)
+#     routes            route aggregation with the station coordinates of 2.5 (stations.keyed_map_routes)
+#     map_layers        merge of the per-file route layer counts (map_layers.py)
+#     station_rankings  merge of the per-file station x season counts (station_rankings.py)
+#     station_flows     merge of the per-file station x hour flows (station_flows.py)
+#     durations         merge of the per-file duration sketch counts (duration_sketches.py)
+#     page_*            the aggregation behind each dashboard page, read from the files above
+#
+#     python benchmark.py run --rows 1M 10M 30M --workdir bench
+#     python benchmark.py generate 1M bench/tripdata_1M
+#     python benchmark.py compare benchmarks.jsonl                       (the last two runs)
+#     python benchmark.py compare benchmarks.jsonl --base <run or commit> --head <run or commit>
+
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from weather import LAGUARDIA
+from weather_stub import synthetic_value
+from ingest import (ingest_folder, rebuild_cube, rebuild_map_layers, rebuild_station_rankings, rebuild_station_flows,
+                    rebuild_duration_sketches)
+from daily_facts import read_weather, from_counts, write_daily_facts, read_daily_facts
+from stations import ROUTE_COLUMNS, station_locations, keyed_map_routes
+from trip_cube import read_cube, daily_counts, bike_crosstab, bike_season_counts
+from station_rankings import read_station_rankings
+from station_flows import read_station_flows
+from duration_sketches import DURATION_LIMIT, PERCENTILES, read_duration_sketches
+from map_layers import MapLayerService
+from trip_store import SEASONS, read_trips
+
+
+RESULTS_PATH = 'benchmarks.jsonl'
+BENCH_DIR = 'bench'
+GENERATOR_NAME = '_synthetic.json'
+WEATHER_NAME = 'weather.csv'
+
+TRIPDATA_COLUMNS = ['ride_id', 'rideable_type', 'started_at', 'ended_at', 'start_station_name', 'start_station_id',
+                    'end_station_name', 'end_station_id', 'start_lat', 'start_lng', 'end_lat', 'end_lng',
+                    'member_casual']
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+YEAR = 2022
+N_STATIONS = 1700  # about the number of stations in the 2022 exports
+CHUNK_ROWS = 1_000_000
+SEED = 32
+
+# Generator parameters
+POPULARITY_EXPONENT = 0.9  # station weight 1 / rank ** exponent
+ROUND_TRIP_SHARE = 0.03
+NO_END_STATION_SHARE = 0.004
+NO_END_COORDINATES_SHARE = 0.001
+DOCKED_SHARE_OF_CASUAL = 0.1
+ELECTRIC_SHARE = (0.28, 0.45)  # in January, in December
+GPS_NOISE_DEGREES = 0.0002
+MEDIAN_DURATION_SECONDS = 660
+# Relative trips per hour of the day: night lull, morning and evening commute peaks
+HOUR_WEIGHTS = np.array([0.8, 0.5, 0.3, 0.2, 0.2, 0.5, 1.5, 3.5, 5.5, 4.0, 3.5, 4.0,
+                         4.5, 4.5, 4.8, 5.5, 6.5, 8.0, 7.0, 5.5, 4.0, 3.0, 2.2, 1.5])
+
+# Bounding box of the generated stations (lat, lng)
+LAT_RANGE = (40.63, 40.88)
+LNG_RANGE = (-74.03, -73.90)
+AVENUES = ['1 Ave', '2 Ave', '3 Ave', 'Lexington Ave', 'Park Ave', 'Madison Ave', '5 Ave', '6 Ave', '7 Ave',
+           'Broadway', '8 Ave', '9 Ave', '10 Ave', '11 Ave', '12 Ave', 'Amsterdam Ave']
+
+STAGES = ['ingest', 'cube', 'daily_facts', 'station_locations', 'routes', 'map_layers', 'station_rankings',
+          'station_flows', 'durations',
+          'page_weather', 'page_stations', 'page_map', 'page_classic', 'page_durations', 'page_imbalance']
+PAGE_REPEATS = 3
+
+
+########################## Synthetic tripdata ###############################################################################
+
+def parse_rows(text):
+    """'1M' -> 1000000, '500k' -> 500000, '2500' -> 2500."""
+    text = str(text).strip().lower()
+    scale = {'k': 1_000, 'm': 1_000_000}.get(text[-1:], 1)
+    return int(float(text[:-1] if scale > 1 else text) * scale)
+
+
+def rows_label(rows):
+    if rows % 1_000_000 == 0:
+        return f'{rows // 1_000_000}M'
+    if rows % 1_000 == 0:
+        return f'{rows // 1_000}k'
+    return str(rows)
+
+
+def make_stations(n_stations=N_STATIONS, seed=SEED):
+    """Station names ('W 21 St & 6 Ave'), ids ('6140.05'), coordinates and popularity weights."""
+    rng = np.random.default_rng(seed)
+    names = [f'{side} {street} St & {avenue}' for side in ['W', 'E'] for street in range(1, 201) for avenue in AVENUES]
+    if n_stations > len(names):
+        raise ValueError(f'at most {len(names)} stations can be generated, not {n_stations}')
+    names = np.array(names, dtype=object)[rng.permutation(len(names))[:n_stations]]
+    ids = np.array([f'{4000 + (i * 7) % 5000}.{i % 100:02d}' for i in range(n_stations)], dtype=object)
+    # Popularity ranks are shuffled so the busiest stations are spread over the map
+    weights = 1 / (rng.permutation(n_stations) + 1) ** POPULARITY_EXPONENT
+    return pd.DataFrame({'name': names, 'id': ids,
+                         'lat': rng.uniform(*LAT_RANGE, n_stations), 'lng': rng.uniform(*LNG_RANGE, n_stations),
+                         'weight': weights / weights.sum()})
+
+
+def daily_temperatures(year=YEAR):
+    """Daily avgTemp (degrees C) of the year, from the weather_stub.py curve."""
+    days = pd.date_range(f'{year}-01-01', f'{year}-12-31', freq='D')
+    return pd.DataFrame({'date': days,
+                         'avgTemp': [synthetic_value(LAGUARDIA, 'TAVG', d.date()) / 10 for d in days]})
+
+
+def daily_trip_shares(weather):
+    """Share of the year's trips on each day: more on warm days, fewer on weekends."""
+    shares = np.clip(1 + 0.06 * weather['avgTemp'].to_numpy(), 0.2, None)
+    shares = shares * np.where(weather['date'].dt.weekday.to_numpy() >= 5, 0.9, 1.0)
+    return shares / shares.sum()
+
+
+def _ride_ids(rng, n):
+    # 16 upper-case hex digits, as in the exports
+    return np.frombuffer(rng.bytes(8 * n).hex().upper().encode(), dtype='S16').astype(str)
+
+
+def synthetic_trips(rng, days, weather, stations):
+    """Trips starting on the given days (positions in weather), in the column layout of the tripdata CSVs."""
+    n = len(days)
+    temperature = weather['avgTemp'].to_numpy()[days]
+    month = weather['date'].dt.month.to_numpy()[days]
+    start = rng.choice(len(stations), n, p=stations['weight'].to_numpy())
+    end = rng.choice(len(stations), n, p=stations['weight'].to_numpy())
+    round_trip = rng.random(n) < ROUND_TRIP_SHARE
+    end[round_trip] = start[round_trip]
+
+    member = rng.random(n) < np.clip(0.85 - 0.008 * temperature, 0.5, 0.9)
+    electric_share = ELECTRIC_SHARE[0] + (ELECTRIC_SHARE[1] - ELECTRIC_SHARE[0]) * (month - 1) / 11
+    rideable_type = np.where(rng.random(n) < electric_share, 'electric_bike', 'classic_bike').astype(object)
+    rideable_type[~member & (rng.random(n) < DOCKED_SHARE_OF_CASUAL)] = 'docked_bike'
+
+    seconds = rng.choice(24, n, p=HOUR_WEIGHTS / HOUR_WEIGHTS.sum()) * 3600 + rng.integers(0, 3600, n)
+    started = weather['date'].to_numpy()[days] + seconds.astype('timedelta64[s]')
+    duration = np.clip(rng.lognormal(np.log(MEDIAN_DURATION_SECONDS), 0.7, n), 60, 4 * 3600).astype('int64')
+    ended = started + duration.astype('timedelta64[s]')
+
+    lat, lng = stations['lat'].to_numpy(), stations['lng'].to_numpy()
+    gps = (rideable_type == 'electric_bike') * GPS_NOISE_DEGREES
+    trips = pd.DataFrame({
+        'ride_id': _ride_ids(rng, n), 'rideable_type': rideable_type, 'started_at': started, 'ended_at': ended,
+        'start_station_name': stations['name'].to_numpy()[start], 'start_station_id': stations['id'].to_numpy()[start],
+        'end_station_name': stations['name'].to_numpy()[end], 'end_station_id': stations['id'].to_numpy()[end],
+        'start_lat': lat[start] + rng.normal(0, 1, n) * gps, 'start_lng': lng[start] + rng.normal(0, 1, n) * gps,
+        'end_lat': lat[end] + rng.normal(0, 1, n) * gps, 'end_lng': lng[end] + rng.normal(0, 1, n) * gps,
+        'member_casual': np.where(member, 'member', 'casual').astype(object)})
+    no_end = rng.random(n) < NO_END_STATION_SHARE
+    trips.loc[no_end, ['end_station_name', 'end_station_id']] = np.nan
+    trips.loc[rng.random(n) < NO_END_COORDINATES_SHARE, ['end_lat', 'end_lng']] = np.nan
+    return trips[TRIPDATA_COLUMNS]
+
+
+def generate_tripdata(rows, folder, year=YEAR, n_stations=N_STATIONS, seed=SEED, chunk_rows=CHUNK_ROWS):
+    """Write about rows synthetic trips of one year as monthly tripdata CSVs plus weather.csv. Returns the folder.
+
+    A folder already generated with the same parameters is reused as is.
+    """
+    params = {'rows': int(rows), 'year': year, 'stations': n_stations, 'seed': seed}
+    marker = os.path.join(folder, GENERATOR_NAME)
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f) == params:
+                return folder
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+
+    rng = np.random.default_rng(seed)
+    stations = make_stations(n_stations, seed)
+    weather = daily_temperatures(year)
+    weather.to_csv(os.path.join(folder, WEATHER_NAME), index=False)
+    trips_per_day = rng.multinomial(rows, daily_trip_shares(weather))
+    months = weather['date'].dt.month.to_numpy()
+    for month in range(1, 13):
+        in_month = np.flatnonzero(months == month)
+        days = np.repeat(in_month, trips_per_day[in_month])
+        path = os.path.join(folder, f'{year}{month:02d}-citibike-tripdata.csv')
+        for first in range(0, max(len(days), 1), chunk_rows):
+            trips = synthetic_trips(rng, days[first:first + chunk_rows], weather, stations)
+            trips.to_csv(path, mode='a', header=first == 0, index=False, date_format=TIMESTAMP_FORMAT)
+    with open(marker, 'w') as f:
+        json.dump(params, f)
+    return folder
+
+
+########################## Stages ###########################################################################################
+
+def _page_weather(paths):
+    return read_daily_facts(paths['daily_facts'])
+
+
+def _page_stations(paths):
+    # Load the count vectors, then the queries of the default view and of every single season
+    rankings = read_station_rankings(paths['station_rankings'], paths['store'])
+    return [rankings.top(seasons, 20, direction) for seasons in [SEASONS] + [[s] for s in SEASONS]
+            for direction in ['start', 'end']]
+
+
+def _page_map(paths):
+    layers = MapLayerService.from_files(paths['map_layers'], paths['store'])
+    return layers.routes(level='top5'), layers.routes(seasons=['summer'], min_trips=5), layers.stations()
+
+
+def _page_classic(paths):
+    table = bike_crosstab(read_cube(paths['cube']))
+    return bike_season_counts(table, 'classic_bike'), bike_season_counts(table, 'electric_bike')
+
+
+def _page_durations(paths):
+    # Load the sketches, then the default boxplots and percentiles and the rider type comparison
+    sketches = read_duration_sketches(paths['duration_sketches'], paths['store'])
+    return [(sketches.box(by, max_minutes=DURATION_LIMIT),
+             sketches.quantiles(PERCENTILES, by, max_minutes=DURATION_LIMIT)) for by in ['rideable_type', 'member_casual']]
+
+
+def _page_imbalance(paths):
+    # Load the stations x hours matrices, rank the default window and chart the history of the top station
+    flows = read_station_flows(paths['station_flows'], paths['store'])
+    drains, fills = flows.imbalance(6, 10)
+    stations = list(drains['station_name']) + list(fills['station_name'])
+    return drains, fills, flows.history(stations[0], 6) if stations else None
+
+
+def stage_functions(folder, paths, workers=None):
+    """Stage name -> function running it, in pipeline order (each stage reads what the previous ones wrote)."""
+    def ingest():
+        shutil.rmtree(paths['store'], ignore_errors=True)
+        return ingest_folder(folder, paths['store'], workers, full=True)
+
+    def daily_facts():
+        facts = from_counts(daily_counts(read_cube(paths['cube'])), read_weather(os.path.join(folder, WEATHER_NAME)))
+        return write_daily_facts(facts, paths['daily_facts'])
+
+    return {
+        'ingest': ingest,
+        'cube': lambda: rebuild_cube(paths['store'], paths['cube']),
+        'daily_facts': daily_facts,
+        'station_locations': lambda: station_locations(read_trips(paths['store'], columns=ROUTE_COLUMNS)),
+        'routes': lambda: keyed_map_routes(paths['store']),
+        'map_layers': lambda: rebuild_map_layers(paths['store'], paths['map_layers']),
+        'station_rankings': lambda: rebuild_station_rankings(paths['store'], paths['station_rankings']),
+        'station_flows': lambda: rebuild_station_flows(paths['store'], paths['station_flows']),
+        'durations': lambda: rebuild_duration_sketches(paths['store'], paths['duration_sketches']),
+        'page_weather': lambda: _page_weather(paths),
+        'page_stations': lambda: _page_stations(paths),
+        'page_map': lambda: _page_map(paths),
+        'page_classic': lambda: _page_classic(paths),
+        'page_durations': lambda: _page_durations(paths),
+        'page_imbalance': lambda: _page_imbalance(paths),
+    }
+
+
+def time_stage(func, repeats=1):
+    """Best wall-clock seconds of repeats calls."""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(scales, workdir=BENCH_DIR, stages=STAGES, results=RESULTS_PATH, workers=None, page_repeats=PAGE_REPEATS,
+              seed=SEED):
+    """Time the stages at every scale (rows). Appends one record per stage to results and returns the records."""
+    run = {'run': datetime.now().strftime('%Y%m%dT%H%M%S'), 'commit': git_commit(), 'machine': platform.node(),
+           'python': platform.python_version(), 'cpus': os.cpu_count(), 'workers': workers}
+    records = []
+    for rows in scales:
+        label = rows_label(rows)
+        folder = generate_tripdata(rows, os.path.join(workdir, f'tripdata_{label}'), seed=seed)
+        out = os.path.join(workdir, f'out_{label}')
+        os.makedirs(out, exist_ok=True)
+        paths = {'store': os.path.join(out, 'trip_store'), 'cube': os.path.join(out, 'trip_cube.parquet'),
+                 'daily_facts': os.path.join(out, 'daily_facts.parquet'),
+                 'map_layers': os.path.join(out, 'map_layers.parquet'),
+                 'station_rankings': os.path.join(out, 'station_rankings.parquet'),
+                 'station_flows': os.path.join(out, 'station_flows.parquet'),
+                 'duration_sketches': os.path.join(out, 'duration_sketches.parquet')}
+        functions = stage_functions(folder, paths, workers)
+        # Later stages read what earlier ones wrote, so the stages always run in pipeline order
+        for stage in [s for s in STAGES if s in stages]:
+            seconds = time_stage(functions[stage], page_repeats if stage.startswith('page_') else 1)
+            record = dict(run, scale=rows, stage=stage, seconds=round(seconds, 4),
+                          rows_per_second=round(rows / seconds) if seconds else None)
+            records.append(record)
+            with open(results, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            print(f'{label:>6} {stage:<18} {seconds:10.3f} s')
+    return records
+
+
+########################## Comparison #######################################################################################
+
+def read_results(path=RESULTS_PATH):
+    with open(path) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+
+def compare_runs(results, base=None, head=None):
+    """Seconds per stage and scale of two runs (run ids or commits; default: the last two runs) and head / base."""
+    runs = list(dict.fromkeys(results['run']))
+
+    def pick(ref, default):
+        if ref is None:
+            return default
+        matches = results[(results['run'] == ref) | (results['commit'] == ref)]['run']
+        if matches.empty:
+            raise ValueError(f'no run or commit {ref!r} in the results')
+        return matches.iloc[-1]
+    if len(runs) < 2 and (base is None or head is None):
+        raise ValueError('need two runs to compare')
+    base, head = pick(base, runs[-2]), pick(head, runs[-1])
+    table = results[results['run'].isin([base, head])].pivot_table(index=['scale', 'stage'], columns='run',
+                                                                    values='seconds', aggfunc='min')
+    table = table.reindex(columns=[base, head]).rename(columns={base: 'base', head: 'head'})
+    table['ratio'] = table['head'] / table['base']
+    order = {s: i for i, s in enumerate(STAGES)}
+    return table.reset_index().sort_values(['scale', 'stage'], key=lambda c: c.map(order) if c.name == 'stage' else c,
+                                           ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline and dashboard aggregations on synthetic tripdata')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='generate the data (if needed) and time the stages')
+    run.add_argument('--rows', nargs='+', default=['1M', '10M', '30M'], help='scales, e.g. 1M 10M 30M')
+    run.add_argument('--workdir', default=BENCH_DIR, help='where the synthetic data and the stage outputs go')
+    run.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    run.add_argument('--results', default=RESULTS_PATH)
+    run.add_argument('--workers', type=int, default=None, help='ingestion worker processes (default: one per CPU)')
+    run.add_argument('--repeats', type=int, default=PAGE_REPEATS, help='runs of each page stage (the best is kept)')
+    run.add_argument('--seed', type=int, default=SEED)
+    generate = commands.add_parser('generate', help='only write synthetic tripdata')
+    generate.add_argument('rows', help='e.g. 1M')
+    generate.add_argument('out', help='folder for the monthly CSVs and weather.csv')
+    generate.add_argument('--stations', type=int, default=N_STATIONS)
+    generate.add_argument('--seed', type=int, default=SEED)
+    compare = commands.add_parser('compare', help='compare the timings of two runs')
+    compare.add_argument('results', nargs='?', default=RESULTS_PATH)
+    compare.add_argument('--base', help='run id or commit (default: the second to last run)')
+    compare.add_argument('--head', help='run id or commit (default: the last run)')
+    args = parser.parse_args()
+    if args.command == 'run':
+        run_suite([parse_rows(r) for r in args.rows], args.workdir, args.stages, args.results, args.workers,
+                  args.repeats, args.seed)
+    elif args.command == 'generate':
+        generate_tripdata(parse_rows(args.rows), args.out, n_stations=args.stations, seed=args.seed)
+        print(f'Wrote {parse_rows(args.rows):,} synthetic trips to {args.out}')
+    else:
+        table = compare_runs(read_results(args.results), args.base, args.head)
+        print(table.to_string(index=False, float_format=lambda x: f'{x:.3f}'))
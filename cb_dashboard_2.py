@@ -12,6 +12,21 @@ from numerize import numerize
 from PIL import Image
 import plotly.express as px
 import json
+import os
+import logging
+from trip_store import store_exists, open_store, read_trips, STORE_DIR, SEASONS, BROADCAST_COLUMNS
+from station_index import read_station_index
+from data_cache import shared_cache, source_fingerprint
+from trip_cube import CUBE_PATH, read_cube, bike_crosstab, bike_season_counts
+from station_rankings import STATION_RANKINGS_PATH, read_station_rankings
+from station_flows import STATION_FLOWS_PATH, WINDOWS, read_station_flows
+from duration_sketches import DURATION_SKETCHES_PATH, DURATION_LIMIT, PERCENTILES, read_duration_sketches
+from daily_facts import DAILY_FACTS_PATH, read_daily_facts, from_broadcast, from_counts
+from map_assets import MAP_ASSETS_DIR, MAP_ASSETS_PORT, read_manifest, start_asset_server
+from map_layers import MAP_LAYERS_PATH, LEVELS_OF_DETAIL, MapLayerService, layer_query
+from sampling import estimate_counts
+from page_trace import PageTrace, TRACE_LOG_ENV, DEBUG_ENV
+from trip_queries import DEFAULT_BACKEND, open_queries, date_column
 
 
 ########################### Initial settings for the dashboard ##################################################################
@@ -30,11 +45,312 @@ page = st.sidebar.selectbox('Choose a section of the analysis',
                              'Most popular stations',
                              'Interactive map with aggregated bike trips',
                              'Classic versus Electric Bikes',
+                             'Trip durations',
+                             'Station imbalance',
                              'Recommendations'])
 
 ########################## Import data ###########################################################################################
 
-df = pd.read_csv('reduced_data_to_plot.csv', index_col=0)
+DATA_PATH = 'reduced_data_to_plot.csv'
+MAP_HTML = 'nyc-citibike.html'
+
+# Where the browser loads the map assets (python map_assets.py build) from: in a deployment, 'python map_assets.py
+# serve' or a CDN in front of it. Unset, the dashboard serves map_assets/ itself on MAP_ASSETS_PORT of MAP_ASSETS_HOST
+# and points the browser at the host name it reached the dashboard at (the request's Host header on streamlit >= 1.37,
+# otherwise the browser.serverAddress option). The server only listens on this machine unless MAP_ASSETS_HOST opts in
+# to another interface (e.g. 0.0.0.0). Behind an HTTPS proxy, for a browser on another machine while the server only
+# listens locally, or when the port cannot be bound, the map falls back to the saved kepler HTML.
+MAP_ASSETS_URL = os.environ.get('MAP_ASSETS_URL')
+MAP_ASSETS_HOST = os.environ.get('MAP_ASSETS_HOST', '127.0.0.1')
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1', '[::1]')
+
+# Where no pre-aggregated file answers a page, the trips are queried (trip_queries.py) in memory with pandas or, with
+# QUERY_BACKEND=duckdb, by DuckDB straight over the files, within DUCKDB_MEMORY_LIMIT (e.g. 1GB) when it is set
+QUERY_BACKEND = os.environ.get('QUERY_BACKEND', DEFAULT_BACKEND)
+DUCKDB_MEMORY_LIMIT = os.environ.get('DUCKDB_MEMORY_LIMIT')
+
+# Page timings (page_trace.py): a sidebar panel with DASHBOARD_DEBUG=1, one JSON line per render in DASHBOARD_TRACE_LOG
+TRACE_LOG = os.environ.get(TRACE_LOG_ENV)
+DEBUG = os.environ.get(DEBUG_ENV, '') not in ('', '0')
+
+# Everything below is cached once per server process and shared by all sessions. The first arguments are the
+# fingerprints (mtime + hash) of the data sources, so rebuilding the data invalidates the cached results.
+# Cached frames are shared between sessions and must not be modified in place.
+#
+# When the offline trip cube has been built (python trip_cube.py), the pages answer from its exact, pre-aggregated
+# counts instead of aggregating the trip rows. The weather page reads the daily fact table (python daily_facts.py).
+# A CSV written as a stratified sample (python sampling.py --fraction) carries a weight per row; the pages then show
+# estimated trip counts with 95% intervals rather than sample counts.
+#
+# The data pages have a date range slider. The full range is answered as before; a narrower range is cut from the
+# cube and the daily facts, or pushed down to the trip store so only the month partitions in range are read. The
+# station rankings have no dates, so a narrower range on that page goes to the query backend.
+
+def data_source():
+    # The Parquet trip store when it has been built (python trip_store.py reduced_data_to_plot.csv), otherwise the CSV
+    return STORE_DIR if store_exists() else DATA_PATH
+
+@shared_cache(maxsize=8)
+def load_trips(source, columns):
+    # Each page only reads the columns it uses
+    if source[0] == STORE_DIR:
+        return read_trips(columns=list(columns))
+    return pd.read_csv(DATA_PATH, usecols=list(columns))
+
+@shared_cache(maxsize=2)
+def source_columns(source):
+    if source[0] == STORE_DIR:
+        return set(open_store().schema.names)
+    return set(pd.read_csv(DATA_PATH, nrows=0).columns)
+
+def is_weighted_sample(source):
+    return source[0] != STORE_DIR and {'weight', 'stratum'} <= source_columns(source)
+
+def sample_columns(source, columns):
+    return columns + (('weight', 'stratum') if is_weighted_sample(source) else ())
+
+@shared_cache(maxsize=2)
+def load_cube(cube):
+    return read_cube(cube[0])
+
+def daily_facts():
+    # The daily fact table, else a CSV with the per-trip broadcast of trip_count (2.4 / 2.6); None without either
+    if os.path.exists(DAILY_FACTS_PATH):
+        return source_fingerprint(DAILY_FACTS_PATH)
+    if not os.path.exists(DATA_PATH):
+        return None
+    csv = source_fingerprint(DATA_PATH)
+    return csv if 'trip_count' in source_columns(csv) else None
+
+@shared_cache(maxsize=4)
+def daily_rides_and_temperature(source, facts):
+    if facts is not None and facts[0] == DAILY_FACTS_PATH:
+        return read_daily_facts(DAILY_FACTS_PATH)
+    columns = source_columns(source) if source[0] != STORE_DIR else set()
+    broadcast = [c for c in BROADCAST_COLUMNS if c in columns] if 'date' in columns else []
+    if facts is not None:
+        # No daily fact table yet: undo the per-trip broadcast of trip_count / avgTemp in the CSV
+        return from_broadcast(pd.read_csv(DATA_PATH, usecols=['date'] + broadcast))
+    # Neither: count the trips per day (the weights of a weighted sample), with the CSV's avgTemp if it has one
+    if is_weighted_sample(source):
+        dated_by = date_column(columns)
+        df = load_trips(source, (dated_by, 'weight'))
+        counts = df['weight'].groupby(pd.to_datetime(df[dated_by]).dt.normalize()).sum().round().astype('int64')
+        counts = counts.rename_axis('date').reset_index(name='trip_count')
+    else:
+        counts = trip_queries(source).daily_counts()
+    if 'avgTemp' in broadcast:
+        counts = from_counts(counts, from_broadcast(pd.read_csv(DATA_PATH, usecols=['date', 'avgTemp'])))
+    return counts
+
+def date_mask(dates, date_range):
+    # Rows of the (inclusive) date range
+    dates = pd.to_datetime(dates)
+    return (dates >= pd.Timestamp(date_range[0])) & (dates < pd.Timestamp(date_range[1]) + pd.Timedelta(days = 1))
+
+@shared_cache(maxsize=2)
+def trip_queries(source):
+    # The query backend of the trips, for pages without a pre-aggregated file
+    options = {'memory_limit': DUCKDB_MEMORY_LIMIT} if QUERY_BACKEND == 'duckdb' else {}
+    return open_queries(source[0], QUERY_BACKEND, **options)
+
+@shared_cache(maxsize=4)
+def date_bounds(source, cube, facts):
+    # First and last day of the trips, from the smallest table that has them
+    if cube is not None:
+        dates = load_cube(cube)['date']
+    elif facts is not None and facts[0] == DAILY_FACTS_PATH:
+        dates = daily_rides_and_temperature(source, facts)['date']
+    else:
+        bounds = trip_queries(source).date_range()
+        return None if bounds is None else (bounds[0].date(), bounds[1].date())
+    dates = pd.to_datetime(dates).dropna()
+    return (dates.min().date(), dates.max().date()) if len(dates) else None
+
+@shared_cache(maxsize=2)
+def station_index(source):
+    # Grid of the station coordinates (station_index.py); only the keyed trip store has them
+    if source[0] != STORE_DIR:
+        return None
+    index = read_station_index()
+    return index if len(index) else None
+
+@shared_cache(maxsize=32)
+def area_stations(source, area):
+    # Names of the stations within the area's radius (metres) of its station
+    station, radius = area
+    return tuple(station_index(source).near_station(station, radius)['station_name'])
+
+@shared_cache(maxsize=4)
+def season_options(source, cube):
+    if cube is not None:
+        return list(load_cube(cube)['season'].dropna().unique())
+    return trip_queries(source).seasons()
+
+@shared_cache(maxsize=2)
+def load_station_rankings(rankings):
+    return read_station_rankings(rankings[0])
+
+@shared_cache(maxsize=32)
+def station_popularity(source, rankings, seasons, k, direction, dates=None, area=None):
+    station = f'{direction}_station_name'
+    stations = area_stations(source, area) if area is not None else None
+    if is_weighted_sample(source):
+        dated_by = date_column(source_columns(source)) if dates is not None else None
+        df = load_trips(source, sample_columns(source, ('season', station) + ((dated_by,) if dated_by else ())))
+        # The filters are masks over the whole sample, which the estimates take their stratum sizes from
+        selected = df['season'].isin(seasons) & (date_mask(df[dated_by], dates) if dated_by else True)
+        if stations is not None:
+            selected &= df[station].isin(stations)
+        total = estimate_counts(df, where = selected).iloc[0]
+        top = estimate_counts(df, station, selected).rename(columns = {'estimate': 'value'}).nlargest(k, 'value')
+        return total['estimate'], top, (total['low'], total['high'])
+    if rankings is not None and dates is None:
+        # The sum of the selected season vectors and a partial sort of it
+        return (*load_station_rankings(rankings).top(seasons, k, direction, stations), None)
+    # No rankings file (python station_rankings.py / ingest.py) or a date range: ask the query backend
+    return (*trip_queries(source).top_stations(seasons, k, direction, *(dates or (None, None)), stations), None)
+
+@shared_cache(maxsize=8)
+def bike_type_table(source, cube, dates=None):
+    # rideable_type x season x member_casual counts, built once per date range; the page only reads this small table
+    if cube is not None:
+        table = load_cube(cube)
+        return bike_crosstab(table if dates is None else table[date_mask(table['date'], dates)])
+    return trip_queries(source).bike_crosstab(*(dates or (None, None)))
+
+@shared_cache(maxsize=16)
+def bike_type_by_season(source, cube, member_types, dates=None):
+    if is_weighted_sample(source):
+        dated_by = date_column(source_columns(source)) if dates is not None else None
+        columns = ('season', 'rideable_type') + (('member_casual',) if member_types is not None else ())
+        df = load_trips(source, sample_columns(source, columns + ((dated_by,) if dated_by else ())))
+        selected = pd.Series(True, index = df.index)
+        if member_types is not None:
+            selected &= df['member_casual'].isin(member_types)
+        if dated_by:
+            selected &= date_mask(df[dated_by], dates)
+        counts = estimate_counts(df, ['rideable_type', 'season'], selected).rename(columns = {'estimate': 'trip_count'})
+        def by_season(bike):
+            rows = counts[counts['rideable_type'] == bike].set_index('season')[['trip_count', 'low', 'high']]
+            return rows.reindex(SEASONS, fill_value = 0).rename_axis('season').reset_index()
+        return by_season('classic_bike'), by_season('electric_bike')
+    table = bike_type_table(source, cube, dates)
+    return bike_season_counts(table, 'classic_bike', member_types), bike_season_counts(table, 'electric_bike', member_types)
+
+@shared_cache(maxsize=2)
+def load_station_flows(flows):
+    # stations x hours departure / arrival matrices (python station_flows.py / ingest.py)
+    return read_station_flows(flows[0])
+
+@shared_cache(maxsize=16)
+def station_imbalance(flows, window, k, dates):
+    return load_station_flows(flows).imbalance(window, k, *(dates or (None, None)))
+
+@shared_cache(maxsize=16)
+def station_flow_history(flows, station, window, dates):
+    return load_station_flows(flows).history(station, window, *(dates or (None, None)))
+
+@shared_cache(maxsize=2)
+def load_duration_sketches(sketches):
+    # Duration bucket counts per station, bike type, rider type and day (python duration_sketches.py / ingest.py)
+    return read_duration_sketches(sketches[0])
+
+@shared_cache(maxsize=16)
+def duration_stats(sketches, by, rideable_types, member_types, station, dates, max_minutes):
+    filters = dict(stations = [station] if station else None, rideable_types = rideable_types,
+                   member_types = member_types, start = (dates or (None, None))[0], end = (dates or (None, None))[1],
+                   max_minutes = max_minutes)
+    service = load_duration_sketches(sketches)
+    return service.box(by, **filters), service.quantiles(PERCENTILES, by, **filters)
+
+@shared_cache(maxsize=1)
+def asset_server_port():
+    # One asset server per process, started by the first visit of the map page; None when the port is taken
+    try:
+        server, url = start_asset_server(MAP_ASSETS_DIR, port=int(os.environ.get('MAP_ASSETS_PORT', MAP_ASSETS_PORT)),
+                                         host=MAP_ASSETS_HOST, layers_path=MAP_LAYERS_PATH)
+    except OSError as error:
+        logging.getLogger(__name__).warning('Map asset server not started (%s); showing the saved map instead', error)
+        return None
+    return server.server_address[1]
+
+def map_assets_url():
+    # None when the browser cannot be pointed at the map assets
+    if MAP_ASSETS_URL:
+        return MAP_ASSETS_URL.rstrip('/')
+    context = getattr(st, 'context', None)  # the request headers, streamlit >= 1.37
+    headers = context.headers if context is not None else {}
+    if headers.get('X-Forwarded-Proto', 'http') != 'http':
+        # An https page cannot frame the plain http asset server
+        return None
+    host = (headers.get('Host') or '').rsplit(':', 1)[0] or st.get_option('browser.serverAddress')
+    if not host:
+        return None
+    if host not in LOCAL_HOSTS and MAP_ASSETS_HOST in LOCAL_HOSTS:
+        logging.getLogger(__name__).info('Map assets only served locally (set MAP_ASSETS_HOST to share them with %s); '
+                                         'showing the saved map instead', host)
+        return None
+    port = asset_server_port()
+    return None if port is None else f'http://{host}:{port}'
+
+@shared_cache(maxsize=2)
+def map_layer_options(layers):
+    # Filter choices of the map layers (python map_layers.py / ingest.py)
+    service = MapLayerService.from_files(layers[0])
+    return service.seasons(), service.rideable_types(), sorted(service.keys)
+
+@shared_cache(maxsize=2)
+def map_html(html):
+    # Without built map assets: the saved kepler map, read once per version of the file
+    with open(html[0], 'r') as f:
+        return f.read()
+
+def date_range_filter(bounds):
+    # Sidebar date range; None while the whole period is selected, so the pre-aggregated files answer as they are
+    if bounds is None or bounds[0] == bounds[1]:
+        return None
+    start, end = st.sidebar.slider('Date range', min_value = bounds[0], max_value = bounds[1], value = bounds,
+                                   format = 'YYYY-MM-DD')
+    return None if (start, end) == tuple(bounds) else (start, end)
+
+def area_filter(index):
+    # Sidebar area around a station; None for the whole city or when there are no station coordinates
+    if index is None:
+        return None
+    station = st.sidebar.selectbox('Area around station', [''] + sorted(index.positions),
+                                   format_func = lambda s: s or 'Whole city')
+    if not station:
+        return None
+    radius = st.sidebar.slider('Radius (metres)', min_value = 250, max_value = 5000, value = 1000, step = 250)
+    return station, radius
+
+def period_label(bounds, dates):
+    # '2022' for whole calendar years, otherwise the first and last day shown
+    start, end = dates or bounds or (None, None)
+    if start is None:
+        return ''
+    if (start.month, start.day, end.month, end.day) == (1, 1, 12, 31):
+        return str(start.year) if start.year == end.year else f'{start.year}-{end.year}'
+    return f'{start:%d %b %Y} to {end:%d %b %Y}'
+
+def error_bars(counts, column):
+    # 95% intervals of estimated counts (weighted sample); none for exact counts
+    if 'low' not in counts.columns:
+        return None
+    return dict(type = 'data', symmetric = False, array = counts['high'] - counts[column],
+                arrayminus = counts[column] - counts['low'])
+
+# Each step of the page ends with trace.lap(<step>); the figures go through trace.render_figure
+trace = PageTrace(page, enabled = DEBUG or TRACE_LOG is not None)
+source = source_fingerprint(data_source())
+cube = source_fingerprint(CUBE_PATH) if os.path.exists(CUBE_PATH) else None
+rankings = source_fingerprint(STATION_RANKINGS_PATH) if os.path.exists(STATION_RANKINGS_PATH) else None
+trace.lap('sources')
+
+# First and last day of the data, for the date range slider of the data pages
+bounds = (date_bounds(source, cube, daily_facts() if cube is None else None)
+          if page not in ('Intro page', 'Recommendations') else None)
 
 # ######################################### DEFINE THE PAGES #####################################################################
 
@@ -46,22 +362,27 @@ if page == "Intro page":
     st.markdown("- **Most Popular Stations**: Highlighting stations with the highest usage.")
     st.markdown("- **Weather and Bike Usage**: Examining how weather conditions influence bike demand.")
     st.markdown("- **Interactive Map with Aggregated Trip Data**: Visualizing trip patterns and station activity.")
+    st.markdown("- **Station Imbalance**: Finding the stations that run out of bikes or fill up fastest.")
     st.markdown("- **Recommendations**: Suggesting strategic actions to improve bike availability.")
     st.markdown("Use the dropdown menu on the left labeled **'Anaysis Menu'** to navigate between different sections of the analysis that our team has explored.")
 
     myImage = Image.open("CitiBike.jpg")  # source: https://www.nyc.gov/office-of-the-mayor/news/576-18/mayor-de-blasio-dramatic-expansion-citi-bike#/0
+    trace.lap('load')
     st.image(myImage)
+    trace.lap('render')
     
 
 ## LINE CHART PAGE: WEATHER COMPONENT AND BIKE USAGE
 
 elif page == 'Weather and Bike Usage':
 
-    # Aggregating the data by datetime
-    df_aggregated = df.groupby('date').agg({
-        'trip_count': 'mean',  # Use 'mean' for daily bike rides
-        'avgTemp': 'mean'  # Use 'mean' for daily temperature
-    }).reset_index()
+    # One row per day from the daily fact table
+    df_aggregated = daily_rides_and_temperature(source, daily_facts())
+    trace.lap('load')
+    dates = date_range_filter(bounds)
+    if dates is not None:
+        df_aggregated = df_aggregated[date_mask(df_aggregated['date'], dates)]
+    trace.lap('filter')
     
     # Creating subplot with two y-axes
     fig2 = make_subplots(specs=[[{"secondary_y": True}]])
@@ -72,15 +393,16 @@ elif page == 'Weather and Bike Usage':
         secondary_y=False,
     )
 
-    # Adding trace for daily temperature
-    fig2.add_trace(
-        go.Scatter(x=df_aggregated['date'], y=df_aggregated['avgTemp'], name='Daily temperature', line=dict(color='red')),
-        secondary_y=True,
-    )
+    # Adding trace for daily temperature (when there is weather for the days)
+    if 'avgTemp' in df_aggregated.columns:
+        fig2.add_trace(
+            go.Scatter(x=df_aggregated['date'], y=df_aggregated['avgTemp'], name='Daily temperature', line=dict(color='red')),
+            secondary_y=True,
+        )
 
     # Updating layout
     fig2.update_layout(
-         title='Daily bike rides and Temperature in 2022 New York',
+         title=f'Daily bike rides and Temperature in {period_label(bounds, dates)} New York',
     xaxis_title='Date',
     yaxis=dict(
         title=dict(
@@ -108,8 +430,9 @@ elif page == 'Weather and Bike Usage':
     ),
     height=600
 )
+    trace.lap('figure')
 
-    st.plotly_chart(fig2, use_container_width=True)
+    trace.render_figure(st.plotly_chart, fig2, use_container_width=True)
     st.markdown("A clear correlation exists between daily temperature fluctuations and bike trip frequency. As temperatures decrease, bike usage correspondingly declines. This suggests that the bike shortage issue is likely most pronounced during the warmer months—roughly from May to October—when demand for bikes is at its highest.")
 
 ### BAR CHART PAGE: MOST POPULAR STATIONS  
@@ -118,30 +441,45 @@ elif page == 'Most popular stations':
 
     # Create the filter on the side bar
     with st.sidebar:
-        season_filter = st.multiselect(label = 'Select the season', options = df['season'].unique(),
-    default = df['season'].unique())
-
-    df1 = df.query('season == @season_filter')
-
-    # Define the total rides
-    total_rides = float(df1['trip_count'].count())    
-    st.metric(label = 'Total Bike Rides', value = numerize.numerize(total_rides))
+        seasons = season_options(source, cube)
+        season_filter = st.multiselect(label = 'Select the season', options = seasons,
+    default = seasons)
+        k = st.slider('Number of stations', min_value = 5, max_value = 50, value = 20, step = 5)
+        direction = st.radio('Rank by', ['start', 'end'], format_func = lambda d: f'{d.capitalize()} stations')
+    dates = date_range_filter(bounds)
+    area = area_filter(station_index(source))
+    trace.lap('filter')
+
+    # The rows, count vectors or query backend the ranking is computed from (cached after the first visit)
+    if is_weighted_sample(source):
+        load_trips(source, sample_columns(source, ('season', f'{direction}_station_name')))
+    elif rankings is not None and dates is None:
+        load_station_rankings(rankings)
+    else:
+        trip_queries(source)
+    trace.lap('load')
+
+    # Define the total rides and the top k start (or end) stations for the selected seasons
+    total_rides, top20, interval = station_popularity(source, rankings, sorted(season_filter), k, direction, dates, area)
+    trace.lap('aggregate')
+    st.metric(label = 'Total Bike Rides', value = numerize.numerize(total_rides),
+              help = None if interval is None else 'Estimated from a weighted sample, 95% interval {} to {}'.format(
+                  numerize.numerize(interval[0]), numerize.numerize(interval[1])))
 
     # Bar chart
-     
-    df1['value'] = 1 
-    df_groupby_bar = df1.groupby('start_station_name', as_index = False).agg({'value': 'sum'})
-    top20 = df_groupby_bar.nlargest(20, 'value')
     
-    fig = go.Figure(go.Bar(x = top20['start_station_name'], y = top20['value'], marker={'color':top20['value'],'colorscale': 'Blues'}))
+    fig = go.Figure(go.Bar(x = top20[f'{direction}_station_name'], y = top20['value'], marker={'color':top20['value'],'colorscale': 'Blues'},
+                           error_y = error_bars(top20, 'value')))
     
     fig.update_layout(
-    title = 'Top 20 most popular bike stations in NYC 2022',
-    xaxis_title = 'Start stations',
+    title = f'Top {k} most popular bike stations in NYC {period_label(bounds, dates)}' + (
+        '' if area is None else f' within {area[1]:,} m of {area[0]}'),
+    xaxis_title = f'{direction.capitalize()} stations',
     yaxis_title ='Sum of trips',
     width = 900, height = 600
     )
-    st.plotly_chart(fig, use_container_width=True)
+    trace.lap('figure')
+    trace.render_figure(st.plotly_chart, fig, use_container_width=True)
     st.markdown("The bar chart clearly shows that certain start stations are significantly more popular than others. The top three stations are W 21 St & 6 Ave, West St & Chambers St, and Broadway & W 58 St. The substantial gap between the tallest and shortest bars highlights strong preferences for these leading stations. This insight can be further validated by cross-referencing with the interactive map of aggregated bike trips accessible via the sidebar select box.")
 
 
@@ -149,15 +487,51 @@ elif page == 'Most popular stations':
 
 elif page == 'Interactive map with aggregated bike trips': 
     
-    path_to_html = "nyc-citibike.html" 
-
-    # Read file and keep in variable
-    with open(path_to_html, 'r') as f: 
-        html_data = f.read()
-        
     # Show in webpage
-    st.header('Aggregated Bike Trips in NYC 2022')
-    st.components.v1.html(html_data,height = 1000)
+    dates = date_range_filter(bounds)
+    assets = map_assets_url() if read_manifest() is not None else None
+    if assets is not None and os.path.exists(MAP_LAYERS_PATH):
+        st.header(f'Aggregated Bike Trips in NYC {period_label(bounds, dates)}')
+        if dates is not None:
+            st.caption('The map layers count trips per month, so the routes cover the whole months of the range.')
+        # The asset server cuts the route layer to these filters, so no route rows pass through Streamlit
+        with st.sidebar:
+            seasons, bike_types, station_names = map_layer_options(source_fingerprint(MAP_LAYERS_PATH))
+            map_seasons = st.multiselect(label = 'Select the season', options = seasons, default = seasons)
+            map_bikes = st.multiselect(label = 'Select the bike type', options = bike_types, default = bike_types)
+            min_trips = st.number_input(label = 'Minimum trips per route', min_value = 1, value = 1)
+            level = st.selectbox('Routes shown', list(LEVELS_OF_DETAIL), index = 1,
+                                 format_func = lambda l: 'All routes' if l == 'all' else f'Top {LEVELS_OF_DETAIL[l]} per start station')
+            station = st.selectbox('Every route of one station', [''] + station_names)
+        # Routes from or to the stations of an area, cut by the asset server
+        area = area_filter(station_index(source))
+        query = layer_query(map_seasons, map_bikes, min_trips, level, station or None, *(dates or (None, None)),
+                            *(area or (None, None)))
+        trace.lap('filter')
+        url = f'{assets}/index.html?{query}'
+        st.components.v1.iframe(url, height = 1000)
+        trace.lap('render', len(url))
+    elif assets is not None:
+        st.header(f'Aggregated Bike Trips in NYC {period_label(bounds, None)}')
+        if dates is not None:
+            st.caption('The map shows every date; build the map layers (python map_layers.py) to filter it by date.')
+        # Only the iframe tag goes through Streamlit; the browser loads the shell, bundle and route data itself
+        url = f'{assets}/index.html'
+        st.components.v1.iframe(url, height = 1000)
+        trace.lap('render', len(url))
+    elif not os.path.exists(MAP_HTML):
+        st.info('The map assets cannot be reached from this browser: set MAP_ASSETS_URL to where they are served.'
+                if read_manifest() is not None else
+                'The map has not been built yet: run python map_assets.py build (or save nyc-citibike.html in 2.5).')
+        trace.lap('render')
+    else:
+        st.header(f'Aggregated Bike Trips in NYC {period_label(bounds, None)}')
+        if dates is not None:
+            st.caption('The saved map shows every date; build the map layers (python map_layers.py) to filter it by date.')
+        html = map_html(source_fingerprint(MAP_HTML))
+        trace.lap('load')
+        st.components.v1.html(html, height = 1000)
+        trace.lap('render', len(html.encode()))
     st.markdown('#### Using the filter on the left side of the map, we can examine whether the most popular start stations also feature among the most frequently taken trips.')
     st.markdown("The most popular start stations include W 21 St & 6 Ave, West St & Chambers St, and Broadway & W 58 St. While the aggregated bike trips filter is active, it becomes evident that although Broadway & W 58 St is a highly used start station, it doesn't necessarily correspond to the most common trip routes.")
     st.markdown("Some of the most frequent routes connect Waterway-adjacent stations like West St/Chambers St, 7 Ave & Central Park South, Grand Army Plaza & Central Park S, and Soissons Landing. These routes tend to be along the water or around the perimeter of Central Park, indicating popular leisure and commuting paths around scenic and residential areas.")
@@ -167,19 +541,20 @@ elif page == 'Interactive map with aggregated bike trips':
 
 elif page == 'Classic versus Electric Bikes':
 
-    # Ensure trip_count is numeric
-    df['trip_count'] = pd.to_numeric(df['trip_count'], errors='coerce')
-
-    # Ensure season is a categorical variable
-    df['season'] = pd.Categorical(df['season'], categories=['winter', 'spring', 'summer', 'fall'], ordered=True)
-
-    # Filter DataFrame by bike type
-    classic_bike = df[df['rideable_type'] == 'classic_bike']
-    electric_bike = df[df['rideable_type'] == 'electric_bike']
-
-    # Count trip counts by season
-    classic_counts = classic_bike.groupby('season')['trip_count'].count().reset_index()
-    electric_counts = electric_bike.groupby('season')['trip_count'].count().reset_index()
+    # Rider types to include, when the data has them
+    member_types = None
+    dates = date_range_filter(bounds)
+    member_options = list(bike_type_table(source, cube, dates).get('member_casual', pd.Series(dtype=object)).unique())
+    trace.lap('load')
+    if member_options:
+        with st.sidebar:
+            member_types = sorted(st.multiselect(label = 'Select the rider type', options = member_options,
+                                                 default = member_options))
+    trace.lap('filter')
+
+    # Count trip counts by season for each bike type
+    classic_counts, electric_counts = bike_type_by_season(source, cube, member_types, dates)
+    trace.lap('aggregate')
 
     # Create the figure with subplots
     fig3 = make_subplots(rows=1, cols=1)
@@ -188,6 +563,7 @@ elif page == 'Classic versus Electric Bikes':
     fig3.add_trace(go.Bar(
         x=classic_counts['season'],
         y=classic_counts['trip_count'],
+        error_y=error_bars(classic_counts, 'trip_count'),
         name='Classic Bike',
         marker=dict(color='blue')
     ), row=1, col=1)
@@ -195,6 +571,7 @@ elif page == 'Classic versus Electric Bikes':
     fig3.add_trace(go.Bar(
         x=electric_counts['season'],
         y=electric_counts['trip_count'],
+        error_y=error_bars(electric_counts, 'trip_count'),
         name='Electric Bike',
         marker=dict(color='green')
     ), row=1, col=1)
@@ -210,21 +587,124 @@ elif page == 'Classic versus Electric Bikes':
         barmode='group',  # Group bars side by side
         height=600  # Adjust height if needed
     )
+    trace.lap('figure')
 
     # Display the figure in Streamlit
-    st.plotly_chart(fig3, use_container_width=True)
+    trace.render_figure(st.plotly_chart, fig3, use_container_width=True)
     st.markdown('The graph demonstrates that classic bikes are rented significantly more often than electric bikes across all seasons, indicating that they are generally more popular or more widely available. While electric bike rentals show a slight increase with rising temperatures, their usage fluctuates much less than that of classic bikes, likely due to limited availability. Additionally, the data reveals that classic bikes are rented over 2.8 times more frequently than electric bikes. This substantial difference suggests that limited electric bike availability may be a key factor, making them less accessible to customers regardless of the season.')
 
+### BOXPLOTS: TRIP DURATIONS
+
+elif page == 'Trip durations':
+
+    st.header('Trip durations')
+    if not os.path.exists(DURATION_SKETCHES_PATH):
+        st.info('The duration sketches have not been built yet: run python duration_sketches.py trip_store (or ingest.py).')
+        trace.lap('load')
+    else:
+        sketches = source_fingerprint(DURATION_SKETCHES_PATH)
+        service = load_duration_sketches(sketches)
+        trace.lap('load')
+        with st.sidebar:
+            by = st.radio('Compare', ['rideable_type', 'member_casual'],
+                          format_func = lambda c: 'Bike types' if c == 'rideable_type' else 'Rider types')
+            bike_types = st.multiselect(label = 'Select the bike type', options = service.rideable_types(),
+                                        default = service.rideable_types())
+            rider_types = st.multiselect(label = 'Select the rider type', options = service.member_types(),
+                                         default = service.member_types())
+            station = st.selectbox('Start station', [''] + sorted(service.keys), format_func = lambda s: s or 'All stations')
+            under_limit = st.checkbox(f'Only trips under {DURATION_LIMIT} minutes', value = True)
+        dates = date_range_filter(bounds)
+        trace.lap('filter')
+
+        # Percentiles from the merged sketches of the selection, within 2% of the exact durations
+        box, percentiles = duration_stats(sketches, by, sorted(bike_types), sorted(rider_types), station or None, dates,
+                                          DURATION_LIMIT if under_limit else None)
+        box = box[box['trips'] > 0]
+        trace.lap('aggregate')
+
+        fig6 = go.Figure(go.Box(x = box[by], q1 = box['q1'], median = box['median'], q3 = box['q3'],
+                                lowerfence = box['lowerfence'], upperfence = box['upperfence'], mean = box['mean'],
+                                marker = dict(color = 'blue'), name = 'Trip duration'))
+        fig6.update_layout(title = f'Trip duration in minutes, {period_label(bounds, dates)}', yaxis_title = 'Minutes',
+                           height = 600)
+        trace.lap('figure')
+        trace.render_figure(st.plotly_chart, fig6, use_container_width=True)
+        st.dataframe(percentiles[percentiles['trips'] > 0].round(1))
+        st.markdown("Each box spans the middle half of the trips, from the 25th to the 75th percentile, with the median in between; the whiskers reach the longest and shortest trips within 1.5 times that span. Longer trips keep bikes away from the docks for longer, so stations whose riders take long trips need more bikes to serve the same number of rides.")
+
+### NET FLOW PAGE: STATION IMBALANCE
+
+elif page == 'Station imbalance':
+
+    st.header('Stations that drain and fill fastest in NYC')
+    if not os.path.exists(STATION_FLOWS_PATH):
+        st.info('The hourly station flows have not been built yet: run python station_flows.py trip_store (or ingest.py).')
+        trace.lap('load')
+    else:
+        flows = source_fingerprint(STATION_FLOWS_PATH)
+        load_station_flows(flows)
+        trace.lap('load')
+        with st.sidebar:
+            window = st.select_slider('Rolling window', options = WINDOWS, value = 6,
+                                      format_func = lambda w: f'{w} hours' if w < 24 else f'{w // 24} days' if w > 24 else '1 day')
+            k = st.slider('Number of stations', min_value = 5, max_value = 30, value = 10, step = 5)
+        dates = date_range_filter(bounds)
+        trace.lap('filter')
+
+        # Lowest (drains) and highest (fills) net flow over any window of the range
+        drains, fills = station_imbalance(flows, window, k, dates)
+        trace.lap('aggregate')
+
+        fig4 = go.Figure()
+        fig4.add_trace(go.Bar(y = drains['station_name'], x = drains['imbalance'], orientation = 'h', name = 'Drains',
+                              marker = dict(color = 'red'), customdata = drains['window_end'],
+                              hovertemplate = '%{y}: %{x} bikes in the window to %{customdata}<extra></extra>'))
+        fig4.add_trace(go.Bar(y = fills['station_name'], x = fills['imbalance'], orientation = 'h', name = 'Fills',
+                              marker = dict(color = 'blue'), customdata = fills['window_end'],
+                              hovertemplate = '%{y}: +%{x} bikes in the window to %{customdata}<extra></extra>'))
+        fig4.update_layout(
+            title = f'Largest net flow (arrivals - departures) over {window} hours, {period_label(bounds, dates)}',
+            xaxis_title = 'Net flow of bikes', yaxis = dict(autorange = 'reversed'), height = 600)
+        trace.lap('figure')
+        trace.render_figure(st.plotly_chart, fig4, use_container_width=True)
+
+        # The imbalance of one station over time
+        stations = list(drains['station_name']) + [s for s in fills['station_name'] if s not in set(drains['station_name'])]
+        if stations:
+            station = st.selectbox('Station', stations)
+            history = station_flow_history(flows, station, window, dates)
+            fig5 = make_subplots(specs=[[{"secondary_y": True}]])
+            fig5.add_trace(go.Scatter(x = history['time'], y = history['cumulative'], name = 'Cumulative net flow',
+                                      line = dict(color = 'blue')), secondary_y = False)
+            fig5.add_trace(go.Scatter(x = history['time'], y = history['rolling_imbalance'], name = f'Net flow over {window} hours',
+                                      line = dict(color = 'red')), secondary_y = True)
+            fig5.update_layout(title = f'Net flow of {station}', xaxis_title = 'Hour', height = 500,
+                               legend = dict(x = 0, y = 1.1, orientation = 'h'))
+            trace.lap('figure')
+            trace.render_figure(st.plotly_chart, fig5, use_container_width=True)
+        st.markdown("A station with a strongly negative net flow loses bikes faster than riders return them and is the first to run empty; one with a strongly positive net flow fills its docks. These are the stations where rebalancing trucks make the largest difference, and the window end shows when in the day the imbalance builds up.")
+
 ### CONCLUSIONS PAGE: RECOMMENDATIONS
 
 else:
     
     st.header('Conclusions and Recommendations')
     bikes = Image.open("business_pic.JPG")
+    trace.lap('load')
     st.image(bikes)
+    trace.lap('render')
     
     st.markdown('### Key Conclusions and Recommendations for New York CitiBikes Moving Forward:')
     st.markdown('- **Temperature and Demand Correlation:** There is a strong link between weather and bike trip volumes. To meet peak demand, stations should be fully stocked during warmer months, while reducing supply in winter and late autumn to optimize logistics and minimize costs. Implementing predictive analytics can further enhance supply chain efficiency by forecasting demand accurately.')
     st.markdown('- **Expansion at High-Traffic Locations:** Increasing the number of bikes and adding more bike parking spaces at the most popular stations—especially those along water-fronts and near Central Park—will help accommodate the high usage. Consider partnerships with local businesses to sponsor additional infrastructure improvements.')
     st.markdown('- **Boost Electric Bike Availability:** Expanding the electric bike fleet can better serve customer preferences and improve accessibility, particularly for longer or hilly routes. Introducing flexible rental options and subscription models for electric bikes can attract more users.')
-    st.markdown('- **Maintain Popular Routes and Stations:** Regular maintenance and infrastructure improvements at key routes and stations will enhance the user experience and support sustainable growth. Consider introducing real-time monitoring of bike and station conditions can help ensure rapid response to maintenance needs.')
\ No newline at end of file
+    st.markdown('- **Maintain Popular Routes and Stations:** Regular maintenance and infrastructure improvements at key routes and stations will enhance the user experience and support sustainable growth. Consider introducing real-time monitoring of bike and station conditions can help ensure rapid response to maintenance needs.')
+
+########################## Page timings ###########################################################################################
+
+if DEBUG:
+    with st.sidebar.expander('Page timings', expanded = True):
+        st.dataframe(trace.table())
+if TRACE_LOG:
+    trace.write(TRACE_LOG)
@@ -0,0 +1,78 @@
+################################################ CITIBIKES DAILY FACTS #####################################################
+# One row per day: date, trip_count and the weather measures (avgTemp, ...).
+#
+# 2.2 merges avgTemp onto every trip and 2.4 / 2.6 merge the daily trip_count back onto every trip, so each per-day
+# value is repeated on millions of rows and the weather page then groups by date to undo it. The daily values are
+# kept here instead, in a 365-row table per year that the dashboard reads as is, and the trip rows stay free of
+# broadcast columns (trip_store.py drops them).
+#
+#     python daily_facts.py --cube trip_cube.parquet --weather NYC_Weather.csv          (from the cube + weather.py)
+#     python daily_facts.py --trips reduced_data_to_plot.csv                           (from the old broadcast CSV)
+#
+# ingest.py rebuilds the table from the merged cube after every run (keeping its weather unless --weather is given).
+
+import argparse
+import pandas as pd
+from trip_store import BROADCAST_COLUMNS
+from trip_cube import read_cube, daily_counts
+from weather import daily_weather, LAGUARDIA
+
+
+DAILY_FACTS_PATH = 'daily_facts.parquet'
+
+
+def from_broadcast(trips):
+    """Recover the daily facts from trip rows that carry trip_count / avgTemp on every row."""
+    columns = [c for c in BROADCAST_COLUMNS if c in trips.columns]
+    facts = trips.groupby(pd.to_datetime(trips['date']))[columns].mean().reset_index()
+    if 'trip_count' in facts.columns:
+        facts['trip_count'] = facts['trip_count'].round().astype('Int64')
+    return facts
+
+
+def read_weather(path, station=LAGUARDIA):
+    """Daily weather from a weather.py export (date, station, datatype, value) or a wide date/avgTemp CSV."""
+    weather = pd.read_csv(path)
+    if 'datatype' in weather.columns:
+        weather['date'] = pd.to_datetime(weather['date'])
+        return daily_weather(weather, station)
+    weather['date'] = pd.to_datetime(weather['date'])
+    return weather
+
+
+def from_counts(counts, weather=None):
+    """Daily facts from exact per-day trip counts (see trip_cube.daily_counts) and optional daily weather."""
+    facts = counts[['date', 'trip_count']].copy()
+    facts['date'] = pd.to_datetime(facts['date'])
+    if weather is not None:
+        facts = facts.merge(weather, on='date', how='left')
+    return facts.sort_values('date', ignore_index=True)
+
+
+def write_daily_facts(facts, path=DAILY_FACTS_PATH):
+    facts.to_parquet(path, index=False)
+    return path
+
+
+def read_daily_facts(path=DAILY_FACTS_PATH):
+    return pd.read_parquet(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the daily fact table (trip_count + weather per day)')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--cube', help='trip cube built by trip_cube.py / ingest.py')
+    source.add_argument('--trips', help='trip CSV that still carries the broadcast trip_count / avgTemp columns')
+    parser.add_argument('--weather', help='weather CSV from weather.py (or a date/avgTemp CSV)')
+    parser.add_argument('--station', default=LAGUARDIA)
+    parser.add_argument('--out', default=DAILY_FACTS_PATH)
+    args = parser.parse_args()
+    weather = read_weather(args.weather, args.station) if args.weather else None
+    if args.cube:
+        facts = from_counts(daily_counts(read_cube(args.cube)), weather)
+    else:
+        facts = from_broadcast(pd.read_csv(args.trips, usecols=lambda c: c in ['date'] + BROADCAST_COLUMNS))
+        if weather is not None:
+            facts = from_counts(facts, weather)
+    write_daily_facts(facts, args.out)
+    print(f'Wrote {len(facts)} days to {args.out}')
@@ -0,0 +1,147 @@
+################################################ CITIBIKES DATA CACHE #####################################################
+# Process-wide cache for the dashboard data and aggregates.
+#
+# Streamlit re-executes cb_dashboard_2.py on every interaction, but imported modules are only loaded once per server
+# process, so anything kept here is shared by every user session. Entries are keyed on the arguments of the cached
+# function; pass source_fingerprint(path) as the first argument so a changed source file gets a new key, and the old
+# entries simply age out of the LRU.
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+
+DEFAULT_MAXSIZE = 32
+
+# Content hashes are only recomputed when a file's (mtime, size) changes
+_digests = {}
+_digests_lock = threading.Lock()
+
+# One cache per decorated function, keyed by its qualified name so it survives the script being re-run
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+########################## Fingerprints #####################################################################################
+
+def file_digest(path, chunk_size=1 << 20):
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _digests_lock:
+        if memo_key in _digests:
+            return _digests[memo_key]
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    with _digests_lock:
+        _digests[memo_key] = digest
+    return digest
+
+
+def source_fingerprint(path):
+    """Hashable (path, mtime, size, sha1) description of a file, or of every file under a directory."""
+    if os.path.isdir(path):
+        entries = []
+        for folder, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                entries.append(source_fingerprint(os.path.join(folder, name)))
+        return (path, tuple(entries))
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size, file_digest(path))
+
+
+########################## LRU cache ########################################################################################
+
+class LRUCache:
+    """Thread-safe, size-bounded mapping with least-recently-used eviction."""
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            key_lock = self._pending.setdefault(key, threading.Lock())
+
+        # Only one session computes a missing entry; the others wait for it instead of repeating the work
+        with key_lock:
+            with self._lock:
+                if key in self._data:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return self._data[key]
+            try:
+                value = compute()
+                with self._lock:
+                    self.misses += 1
+                    self._data[key] = value
+                    while len(self._data) > self.maxsize:
+                        self._data.popitem(last=False)
+            finally:
+                with self._lock:
+                    self._pending.pop(key, None)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+def _freeze(value):
+    # Turn the usual Streamlit widget values (lists, dicts, sets) into hashable keys
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def shared_cache(maxsize=DEFAULT_MAXSIZE):
+    """Decorator caching a function's results across sessions. Cached values are shared: never mutate them."""
+    def decorator(func):
+        name = f'{func.__module__}.{func.__qualname__}'
+        with _caches_lock:
+            cache = _caches.get(name)
+            if cache is None:
+                cache = _caches[name] = LRUCache(maxsize)
+            cache.maxsize = maxsize
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (_freeze(args), _freeze(kwargs))
+            return cache.get_or_compute(key, lambda: func(*args, **kwargs))
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+def cache_info():
+    with _caches_lock:
+        return {name: cache.info() for name, cache in _caches.items()}
+
+
+def clear_all():
+    with _caches_lock:
+        for cache in _caches.values():
+            cache.clear()
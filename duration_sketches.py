@@ -0,0 +1,198 @@
+################################################ CITIBIKES DURATION SKETCHES #####################################################
+# Trip duration percentiles and boxplots for any station / bike type / rider type / date selection.
+#
+# 2.4 draws its tripduration boxplots and histograms from the full frame of trips. Here the durations are kept as
+# mergeable quantile sketches instead: every duration falls into a logarithmic bucket, bucket i covering
+#
+#     (MIN_MINUTES * GAMMA ** (i - 1), MIN_MINUTES * GAMMA ** i]
+#
+# with GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY), and the sketch of a group of trips is its trips per
+# bucket (the DDSketch layout). Any quantile read back from the buckets is within RELATIVE_ACCURACY (2%) of the true
+# duration, and two sketches merge by adding their counts, so the sketches are counted per
+#
+#     start station key x rideable_type x member_casual x date x bucket
+#
+# (duration_sketches.parquet, maintained per source file by ingest.py) and summed over whatever the page selects.
+# A few hundred buckets cover one second to several days, so no raw durations are kept.
+#
+#     python duration_sketches.py trip_store duration_sketches.parquet
+#
+#     sketches = read_duration_sketches()
+#     sketches.quantiles([0.5, 0.9], by='member_casual', rideable_types=['electric_bike'], start='2022-06-01')
+#     sketches.box(by='rideable_type', max_minutes=80)
+
+import argparse
+import numpy as np
+import pandas as pd
+from trip_store import STORE_DIR, open_store, read_station_dim
+
+
+DURATION_SKETCHES_PATH = 'duration_sketches.parquet'
+
+SKETCH_DIMENSIONS = ['start_station_key', 'rideable_type', 'member_casual', 'date']
+
+RELATIVE_ACCURACY = 0.02
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+MIN_MINUTES = 1 / 60  # shorter trips share bucket 0
+
+# Durations 2.4 keeps for its plots: 0 < tripduration < 80 minutes
+DURATION_LIMIT = 80
+
+PERCENTILES = [0.05, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+
+
+def duration_bucket(minutes):
+    """Bucket of each duration in minutes."""
+    minutes = np.maximum(np.asarray(minutes, dtype='float64'), MIN_MINUTES)
+    return np.ceil(np.log(minutes / MIN_MINUTES) / np.log(GAMMA) - 1e-9).astype('int16')
+
+
+def bucket_minutes(buckets):
+    """The duration a bucket stands for: within RELATIVE_ACCURACY of every duration in it."""
+    return MIN_MINUTES * 2 * GAMMA ** np.asarray(buckets, dtype='float64') / (GAMMA + 1)
+
+
+########################## Build ############################################################################################
+
+def duration_counts(trips):
+    """Trips per station, bike type, rider type, day and duration bucket of one chunk of keyed trips (trips with a
+    positive tripduration). Mergeable by summing trips."""
+    trips = trips[trips['tripduration'] > 0]
+    keys = {c: trips[c].astype(object) if isinstance(trips[c].dtype, pd.CategoricalDtype) else trips[c]
+            for c in SKETCH_DIMENSIONS}
+    keys['bucket'] = duration_bucket(trips['tripduration'].to_numpy())
+    counts = pd.DataFrame(keys).groupby(SKETCH_DIMENSIONS + ['bucket'], dropna=False).size()
+    return counts.rename('trips').reset_index()
+
+
+def merge_duration_counts(partials):
+    partials = [p for p in partials if len(p)]
+    if not partials:
+        counts = pd.DataFrame({'start_station_key': pd.Series(dtype='int32'), 'rideable_type': pd.Series(dtype=object),
+                               'member_casual': pd.Series(dtype=object), 'date': pd.Series(dtype='datetime64[ns]'),
+                               'bucket': pd.Series(dtype='int16'), 'trips': pd.Series(dtype='int64')})
+    else:
+        counts = pd.concat([p.astype({'rideable_type': object, 'member_casual': object}) for p in partials],
+                           ignore_index=True)
+        counts = counts.groupby(SKETCH_DIMENSIONS + ['bucket'], dropna=False)['trips'].sum().reset_index()
+    return counts.astype({'start_station_key': 'int32', 'bucket': 'int16', 'trips': 'int64',
+                          'rideable_type': 'category', 'member_casual': 'category'})
+
+
+def build_duration_counts(root=STORE_DIR):
+    """The duration sketches of an existing keyed trip store, one partition file at a time."""
+    dataset = open_store(root)
+    columns = SKETCH_DIMENSIONS + ['tripduration']
+    missing = [c for c in columns if c not in dataset.schema.names]
+    if missing:
+        raise ValueError(f'{root} has no {", ".join(missing)}; rebuild it with ingest.py')
+    return merge_duration_counts([duration_counts(fragment.to_table(columns=columns).to_pandas())
+                                  for fragment in dataset.get_fragments()])
+
+
+def write_duration_sketches(counts, path=DURATION_SKETCHES_PATH):
+    counts.to_parquet(path, index=False)
+    return path
+
+
+def read_duration_sketches(path=DURATION_SKETCHES_PATH, root=STORE_DIR):
+    return DurationSketches(merge_duration_counts([pd.read_parquet(path)]), read_station_dim(root))
+
+
+########################## Queries ##########################################################################################
+
+class DurationSketches:
+    """Duration bucket counts that any filter combination is summed from."""
+
+    def __init__(self, counts, dim):
+        self.station_key = counts['start_station_key'].to_numpy(dtype='int64')
+        self.rideable_type = pd.Categorical(counts['rideable_type'])
+        self.member_casual = pd.Categorical(counts['member_casual'])
+        self.date = pd.to_datetime(counts['date']).to_numpy()
+        self.bucket = counts['bucket'].to_numpy(dtype='int64')
+        self.trips = counts['trips'].to_numpy(dtype='int64')
+        self.n_buckets = int(self.bucket.max()) + 1 if len(self.bucket) else 1
+        self.keys = dict(zip(dim['station_name'].astype(object), dim['station_key'].astype(int)))
+
+    def rideable_types(self):
+        return list(self.rideable_type.categories)
+
+    def member_types(self):
+        return list(self.member_casual.categories)
+
+    def _mask(self, stations=None, rideable_types=None, member_types=None, start=None, end=None, max_minutes=None):
+        mask = np.ones(len(self.trips), dtype=bool)
+        if stations is not None:
+            mask &= np.isin(self.station_key, [self.keys.get(s, -1) for s in stations])
+        if rideable_types is not None:
+            mask &= np.isin(self.rideable_type, list(rideable_types))
+        if member_types is not None:
+            mask &= np.isin(self.member_casual, list(member_types))
+        if start is not None:
+            mask &= self.date >= np.datetime64(pd.Timestamp(start).normalize())
+        if end is not None:
+            mask &= self.date <= np.datetime64(pd.Timestamp(end).normalize())
+        if max_minutes is not None:
+            # Whole buckets: the cut is as exact as the sketch
+            mask &= self.bucket <= duration_bucket(max_minutes)
+        return mask
+
+    def histograms(self, by=None, **filters):
+        """Trips per group (rows) and duration bucket (columns) of the selection, and the group labels.
+
+        by is None (one group) or 'rideable_type' / 'member_casual'; filters are those of quantiles.
+        """
+        mask = self._mask(**filters)
+        if by is None:
+            groups, labels = np.zeros(mask.sum(), dtype='int64'), ['all']
+        else:
+            column = getattr(self, by)
+            groups, labels = column.codes[mask].astype('int64'), list(column.categories)
+        cells = np.bincount(groups * self.n_buckets + self.bucket[mask], weights=self.trips[mask],
+                            minlength=len(labels) * self.n_buckets)
+        return cells.reshape(len(labels), self.n_buckets).astype('int64'), labels
+
+    def quantiles(self, qs=PERCENTILES, by=None, **filters):
+        """Duration (minutes) at each quantile per group, with the group's trips; NaN for groups without trips.
+
+        filters: stations (names), rideable_types, member_types, start / end dates, max_minutes (the longest
+        duration counted, e.g. DURATION_LIMIT); None selects all.
+        """
+        histograms, labels = self.histograms(by, **filters)
+        cumulative = np.cumsum(histograms, axis=1)
+        totals = cumulative[:, -1]
+        values = np.full((len(labels), len(qs)), np.nan)
+        for row in np.flatnonzero(totals):
+            # The bucket of the trip at rank q * (n - 1), as DDSketch does
+            ranks = np.floor(np.asarray(qs) * (totals[row] - 1))
+            values[row] = bucket_minutes(np.searchsorted(cumulative[row], ranks, side='right'))
+        result = pd.DataFrame(values, columns=[f'p{round(q * 100, 1):g}' for q in qs])
+        result.insert(0, by or 'group', labels)
+        result.insert(1, 'trips', totals)
+        return result
+
+    def box(self, by=None, **filters):
+        """Boxplot statistics per group: q1, median, q3 and whiskers at the furthest durations within 1.5 IQR."""
+        histograms, labels = self.histograms(by, **filters)
+        stats = self.quantiles([0.25, 0.5, 0.75], by, **filters)
+        stats.columns = [by or 'group', 'trips', 'q1', 'median', 'q3']
+        iqr = stats['q3'] - stats['q1']
+        minutes = bucket_minutes(np.arange(self.n_buckets))
+        used = histograms > 0
+        # Closest used bucket inside each fence (the fences themselves if no bucket is outside)
+        low, high = (stats['q1'] - 1.5 * iqr).to_numpy(), (stats['q3'] + 1.5 * iqr).to_numpy()
+        inside = used & (minutes >= low[:, None]) & (minutes <= high[:, None])
+        stats['lowerfence'] = np.where(inside.any(axis=1), np.where(inside, minutes, np.inf).min(axis=1), np.nan)
+        stats['upperfence'] = np.where(inside.any(axis=1), np.where(inside, minutes, -np.inf).max(axis=1), np.nan)
+        stats['mean'] = (histograms * minutes).sum(axis=1) / np.maximum(stats['trips'].to_numpy(), 1)
+        return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Count trip duration sketches per station, bike type, rider and day')
+    parser.add_argument('store', nargs='?', default=STORE_DIR, help='keyed trip store (built by ingest.py)')
+    parser.add_argument('out', nargs='?', default=DURATION_SKETCHES_PATH)
+    args = parser.parse_args()
+    counts = build_duration_counts(args.store)
+    write_duration_sketches(counts, args.out)
+    print(f'Wrote {len(counts):,} duration sketch counts to {args.out}')
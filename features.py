@@ -0,0 +1,50 @@
+################################################ CITIBIKES FEATURES #####################################################
+# Timestamp parsing and the derived trip features, in one vectorized pass.
+#
+# The notebooks parse dates several times over (strptime in a list comprehension in 2.2, pd.to_datetime with
+# dayfirst=True, .dt.date and another pd.to_datetime) and derive the season with a per-row list comprehension in
+# 2.6. Here started_at / ended_at are parsed once with an explicit format, and date, month, hour, weekday, season
+# and tripduration are all computed from the parsed columns with array operations.
+
+import numpy as np
+import pandas as pd
+from trip_store import SEASONS, SEASON_BY_MONTH
+
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Season category code of each month (index 0 unused), for a vectorized lookup
+SEASON_CODE_BY_MONTH = np.array([-1] + [SEASONS.index(s) for s in SEASON_BY_MONTH[1:]], dtype='int8')
+
+FEATURE_COLUMNS = ['date', 'month', 'hour', 'weekday', 'season', 'tripduration']
+
+
+def parse_timestamps(values):
+    """Parse Citi Bike timestamps ('2022-08-27 13:56:47.728' or without the milliseconds) with one explicit format."""
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    values = values.astype('string')
+    # Seconds resolution with the fixed format, then the optional fraction added on as a number
+    whole = pd.to_datetime(values.str.slice(0, 19), format=TIMESTAMP_FORMAT)
+    fraction = pd.to_numeric(values.str.slice(19), errors='coerce').fillna(0).to_numpy(dtype='float64')
+    return whole + pd.to_timedelta(np.round(fraction * 1e6), unit='us')
+
+
+def derive_features(trips):
+    """Return the trips with parsed timestamps and date, month, hour, weekday, season and tripduration (minutes)."""
+    started = parse_timestamps(trips['started_at'])
+    columns = {'started_at': started}
+    if 'ended_at' in trips.columns:
+        ended = parse_timestamps(trips['ended_at'])
+        columns['ended_at'] = ended
+        columns['tripduration'] = (ended - started).dt.total_seconds() / 60
+
+    month = started.dt.month.to_numpy(dtype='int8')
+    columns['date'] = started.dt.normalize()
+    columns['month'] = month
+    columns['hour'] = started.dt.hour.to_numpy(dtype='int8')
+    columns['weekday'] = started.dt.weekday.to_numpy(dtype='int8')
+    columns['season'] = pd.Categorical.from_codes(SEASON_CODE_BY_MONTH[month], categories=SEASONS, ordered=True)
+    return trips.assign(**{name: (value.to_numpy() if isinstance(value, pd.Series) else value)
+                           for name, value in columns.items()})
@@ -0,0 +1,266 @@
+################################################ CITIBIKES INGESTION #####################################################
+# Loads the monthly Citi Bike tripdata CSVs into the partitioned trip store (see trip_store.py).
+#
+# Replaces the pd.concat(pd.read_csv(f) for f in filepaths) step of 2.2: every file is parsed in a worker process in
+# fixed-size chunks with declared dtypes, and each normalized chunk is written straight to its month partition, so
+# memory stays at roughly one chunk per worker no matter how many months are loaded.
+#
+# Ingestion is incremental. trip_store/_manifest.json records every ingested file with its checksum, and only new or
+# changed files are parsed again. While a file is parsed, its share of each downstream aggregate (see
+# FILE_AGGREGATES) is saved under trip_store/_aggregates/<name>/<file>.parquet. The aggregates are rebuilt by
+# merging those per-file deltas, never by rescanning the trips.
+#
+# Timestamps are parsed once per chunk and the date/hour/weekday/season/tripduration features derived with them (see
+# features.py), so nothing downstream parses dates again.
+#
+# Station names are replaced by integer keys before the trips are written. The workers share one key registry, and the
+# station dimension (names + coordinates) is saved in the store after every finished file (see stations.py).
+#
+#     python ingest.py 2022-citibike-tripdata --store trip_store --workers 4
+
+import os
+import glob
+import json
+import argparse
+from datetime import datetime
+from multiprocessing import Manager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from trip_store import STORE_DIR, normalize_trips, write_trips, read_station_dim
+from features import derive_features
+from stations import StationKeys, encode_stations, coordinate_counts, merge_coordinate_counts, update_station_dim
+from trip_cube import CUBE_PATH, aggregate_chunk, finalize_cube, write_cube, daily_counts
+from map_layers import (MAP_LAYERS_PATH, route_layer_counts, merge_route_layer_counts, build_route_layer_counts,
+                        write_map_layers)
+from station_rankings import (STATION_RANKINGS_PATH, station_season_counts, merge_station_season_counts,
+                              build_station_season_counts, write_station_rankings)
+from station_flows import (STATION_FLOWS_PATH, station_hour_flows, merge_station_hour_flows, build_station_hour_flows,
+                           write_station_flows)
+from duration_sketches import (DURATION_SKETCHES_PATH, duration_counts, merge_duration_counts, build_duration_counts,
+                               write_duration_sketches)
+from daily_facts import DAILY_FACTS_PATH, from_counts, read_weather, read_daily_facts, write_daily_facts
+from data_cache import file_digest
+
+
+CHUNK_ROWS = 500_000
+
+MANIFEST_NAME = '_manifest.json'
+AGGREGATES_DIR = '_aggregates'
+
+# Declared dtypes of the raw tripdata files, so pandas never has to guess (the station ids mix numbers and text)
+RAW_DTYPES = {
+    'ride_id': 'string',
+    'rideable_type': 'category',
+    'started_at': 'string',
+    'ended_at': 'string',
+    'start_station_name': 'category',
+    'start_station_id': 'string',
+    'end_station_name': 'category',
+    'end_station_id': 'string',
+    'start_lat': 'float64',
+    'start_lng': 'float64',
+    'end_lat': 'float64',
+    'end_lng': 'float64',
+    'member_casual': 'category',
+}
+
+# Downstream aggregates maintained per source file: name -> (aggregate one chunk, merge partial results).
+# Merging must be associative, so the delta of one file can be combined with the deltas of all other files.
+FILE_AGGREGATES = {
+    'cube': (aggregate_chunk, finalize_cube),
+    'stations': (coordinate_counts, merge_coordinate_counts),
+    'routes': (route_layer_counts, merge_route_layer_counts),
+    'station_seasons': (station_season_counts, merge_station_season_counts),
+    'station_flows': (station_hour_flows, merge_station_hour_flows),
+    'durations': (duration_counts, merge_duration_counts),
+}
+
+
+def list_tripdata_files(folder):
+    return sorted(glob.glob(os.path.join(folder, '*tripdata*.csv')))
+
+
+def source_stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+########################## Manifest #########################################################################################
+
+def manifest_path(root=STORE_DIR):
+    return os.path.join(root, MANIFEST_NAME)
+
+
+def read_manifest(root=STORE_DIR):
+    path = manifest_path(root)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, root=STORE_DIR):
+    # Write then rename, so an interrupted run never leaves a half-written manifest behind
+    os.makedirs(root, exist_ok=True)
+    tmp = manifest_path(root) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, manifest_path(root))
+
+
+def pending_files(paths, manifest):
+    """Files that are new or whose checksum changed since they were last ingested."""
+    pending = []
+    for path in paths:
+        entry = manifest.get(os.path.basename(path))
+        if entry is None or entry['size'] != os.path.getsize(path) or entry['sha1'] != file_digest(path):
+            pending.append(path)
+    return pending
+
+
+########################## Ingest ###########################################################################################
+
+def aggregate_path(root, name, path):
+    return os.path.join(root, AGGREGATES_DIR, name, f'{source_stem(path)}.parquet')
+
+
+def remove_file_parts(path, root=STORE_DIR):
+    # Drop whatever an earlier run wrote for this source file so re-ingesting it never duplicates trips
+    for part in glob.glob(os.path.join(root, 'year=*', 'month=*', f'part-{source_stem(path)}-*.parquet')):
+        os.remove(part)
+
+
+def ingest_file(path, root=STORE_DIR, chunk_rows=CHUNK_ROWS, station_keys=None):
+    """Stream one tripdata CSV into the store chunk by chunk and save its aggregate deltas. Returns a manifest entry."""
+    if station_keys is None:
+        station_keys = StationKeys.from_dim(read_station_dim(root))
+    remove_file_parts(path, root)
+    rows = 0
+    partials = {name: [] for name in FILE_AGGREGATES}
+    reader = pd.read_csv(path, dtype=RAW_DTYPES, chunksize=chunk_rows)
+    for i, chunk in enumerate(reader):
+        chunk = encode_stations(normalize_trips(derive_features(chunk)), station_keys)
+        write_trips(chunk, root, part_name=f'part-{source_stem(path)}-{i:04d}')
+        for name, (aggregate, merge) in FILE_AGGREGATES.items():
+            partials[name].append(aggregate(chunk))
+        rows += len(chunk)
+
+    for name, (aggregate, merge) in FILE_AGGREGATES.items():
+        out = aggregate_path(root, name, path)
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        merge(partials[name]).to_parquet(out, index=False)
+
+    return {'sha1': file_digest(path), 'size': os.path.getsize(path), 'rows': rows,
+            'ingested_at': datetime.now().isoformat(timespec='seconds')}
+
+
+def ingest_files(paths, root=STORE_DIR, workers=None, chunk_rows=CHUNK_ROWS):
+    """Ingest the given files in a process pool, recording each one in the manifest as soon as it is done."""
+    manifest = read_manifest(root)
+    if not paths:
+        return {}
+    done = {}
+    with Manager() as manager, ProcessPoolExecutor(max_workers=workers) as pool:
+        station_keys = StationKeys.from_dim(read_station_dim(root), manager.dict(), manager.Lock())
+        futures = {pool.submit(ingest_file, path, root, chunk_rows, station_keys): path for path in paths}
+        for future in as_completed(futures):
+            path = futures[future]
+            entry = future.result()
+            # The keys a file was written with must be saved before the file counts as ingested
+            update_station_dim(station_keys, merge_aggregate('stations', root), root)
+            done[path] = manifest[os.path.basename(path)] = entry
+            write_manifest(manifest, root)
+            print(f'{os.path.basename(path)}: {entry["rows"]:,} rows')
+    return done
+
+
+def ingest_folder(folder, root=STORE_DIR, workers=None, chunk_rows=CHUNK_ROWS, full=False):
+    """Ingest the new or changed tripdata CSVs of a folder (every file with full=True). Returns {file: entry}."""
+    paths = list_tripdata_files(folder)
+    if not full:
+        paths = pending_files(paths, read_manifest(root))
+    return ingest_files(paths, root, workers, chunk_rows)
+
+
+########################## Aggregates #######################################################################################
+
+def merge_aggregate(name, root=STORE_DIR):
+    """Combine the saved per-file deltas of one aggregate."""
+    aggregate, merge = FILE_AGGREGATES[name]
+    files = sorted(glob.glob(os.path.join(root, AGGREGATES_DIR, name, '*.parquet')))
+    return merge([pd.read_parquet(f) for f in files])
+
+
+def rebuild_cube(root=STORE_DIR, path=CUBE_PATH):
+    return write_cube(merge_aggregate('cube', root), path)
+
+
+def rebuild_daily_facts(root=STORE_DIR, path=DAILY_FACTS_PATH, weather=None):
+    """Daily facts from the merged cube. Without new weather, the weather columns of the existing table are kept."""
+    if weather is None and os.path.exists(path):
+        previous = read_daily_facts(path).drop(columns='trip_count')
+        weather = previous if len(previous.columns) > 1 else None
+    return write_daily_facts(from_counts(daily_counts(merge_aggregate('cube', root)), weather), path)
+
+
+def merge_or_scan(name, root, scan):
+    """The merged deltas of an aggregate, or scan(root) when files were ingested before the aggregate existed."""
+    saved = {os.path.basename(f) for f in glob.glob(os.path.join(root, AGGREGATES_DIR, name, '*.parquet'))}
+    if any(f'{source_stem(file)}.parquet' not in saved for file in read_manifest(root)):
+        return scan(root)
+    return merge_aggregate(name, root)
+
+
+def rebuild_map_layers(root=STORE_DIR, path=MAP_LAYERS_PATH):
+    return write_map_layers(merge_or_scan('routes', root, build_route_layer_counts), path)
+
+
+def rebuild_station_rankings(root=STORE_DIR, path=STATION_RANKINGS_PATH):
+    return write_station_rankings(merge_or_scan('station_seasons', root, build_station_season_counts), path)
+
+
+def rebuild_station_flows(root=STORE_DIR, path=STATION_FLOWS_PATH):
+    return write_station_flows(merge_or_scan('station_flows', root, build_station_hour_flows), path)
+
+
+def rebuild_duration_sketches(root=STORE_DIR, path=DURATION_SKETCHES_PATH):
+    return write_duration_sketches(merge_or_scan('durations', root, build_duration_counts), path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest the monthly Citi Bike tripdata CSVs into the trip store')
+    parser.add_argument('folder', help='folder with the monthly *-citibike-tripdata*.csv files')
+    parser.add_argument('--store', default=STORE_DIR)
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--full', action='store_true', help='re-ingest every file, not only new or changed ones')
+    parser.add_argument('--cube', default=CUBE_PATH, help='where to write the merged trip cube')
+    parser.add_argument('--daily-facts', default=DAILY_FACTS_PATH, help='where to write the daily trip counts')
+    parser.add_argument('--weather', help='weather CSV from weather.py (or a date/avgTemp CSV) for the daily facts')
+    parser.add_argument('--map-layers', default=MAP_LAYERS_PATH, help='where to write the merged map route counts')
+    parser.add_argument('--station-rankings', default=STATION_RANKINGS_PATH,
+                        help='where to write the merged per-season station counts')
+    parser.add_argument('--station-flows', default=STATION_FLOWS_PATH,
+                        help='where to write the merged per-hour station departures and arrivals')
+    parser.add_argument('--duration-sketches', default=DURATION_SKETCHES_PATH,
+                        help='where to write the merged trip duration sketches')
+    args = parser.parse_args()
+    done = ingest_folder(args.folder, args.store, args.workers, args.chunk_rows, args.full)
+    print(f'Ingested {sum(e["rows"] for e in done.values()):,} rows from {len(done)} new or changed files')
+    if done or not os.path.exists(args.cube):
+        rebuild_cube(args.store, args.cube)
+        print(f'Updated {args.cube}')
+    if done or args.weather or not os.path.exists(args.daily_facts):
+        rebuild_daily_facts(args.store, args.daily_facts, read_weather(args.weather) if args.weather else None)
+        print(f'Updated {args.daily_facts}')
+    if done or not os.path.exists(args.map_layers):
+        rebuild_map_layers(args.store, args.map_layers)
+        print(f'Updated {args.map_layers}')
+    if done or not os.path.exists(args.station_rankings):
+        rebuild_station_rankings(args.store, args.station_rankings)
+        print(f'Updated {args.station_rankings}')
+    if done or not os.path.exists(args.station_flows):
+        rebuild_station_flows(args.store, args.station_flows)
+        print(f'Updated {args.station_flows}')
+    if done or not os.path.exists(args.duration_sketches):
+        rebuild_duration_sketches(args.store, args.duration_sketches)
+        print(f'Updated {args.duration_sketches}')
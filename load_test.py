@@ -0,0 +1,212 @@
+################################################ CITIBIKES LOAD TEST #####################################################
+# Many concurrent dashboard sessions in one process, to size the hosting of cb_dashboard_2.py.
+#
+# A Streamlit server runs every session's script in a thread of one process, sharing the process memory and the
+# shared_cache results. Here each simulated session is an AppTest (streamlit.testing.v1, streamlit >= 1.28) driven
+# from its own thread of this process, so the sessions compete for the same interpreter and caches as real viewers
+# would. Every session opens the dashboard, then walks through the sidebar pages; on 'Most popular stations' it also
+# picks a random set of seasons. Every rerun is timed.
+#
+# For each concurrency level the report gives the p50 / p95 / p99 rerun latency, the throughput (reruns per second
+# over the whole level), the peak and final resident memory of the process and the reruns that raised. The memory is
+# sampled while the level runs where the current resident memory can be read (psutil or /proc, see page_trace.py);
+# elsewhere the peak is the process's peak so far and the final memory is not reported. Results can also be appended
+# as JSON lines (--out), one per level.
+#
+#     cd <folder with the dashboard data>
+#     python load_test.py --sessions 10 50 100 --rounds 2
+#     python load_test.py --sessions 50 --pages 'Most popular stations' 'Classic versus Electric Bikes' --out load.jsonl
+
+import os
+import re
+import json
+import time
+import argparse
+import threading
+import warnings
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from page_trace import rss_bytes, peak_rss_bytes
+try:
+    import streamlit
+    from streamlit.testing.v1 import AppTest
+except ImportError:  # streamlit < 1.28
+    AppTest = None
+try:  # internals patched by shared_test_server
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+except ImportError:
+    Runtime = ScriptCache = None
+
+
+DASHBOARD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cb_dashboard_2.py')
+SESSION_LEVELS = [10, 50, 100]
+ROUNDS = 1
+TIMEOUT = 120  # seconds one rerun may take before it counts as failed
+RSS_INTERVAL = 0.1
+SEED = 32
+
+# Streamlit versions (major, minor) whose Runtime / ScriptCache internals shared_test_server was checked against
+PATCHED_VERSIONS = ((1, 28), (1, 65))
+
+STATIONS_PAGE = 'Most popular stations'
+SEASON_FILTER = 'Select the season'
+
+
+class RssSampler(threading.Thread):
+    """Peak resident memory of the process while running (the process's peak so far where only that is known)."""
+
+    def __init__(self, interval=RSS_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = rss_bytes()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while self.peak is not None and not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        if self.peak is None:
+            return peak_rss_bytes()
+        self.peak = max(self.peak, rss_bytes())
+        return self.peak
+
+
+@contextmanager
+def shared_test_server():
+    """Make concurrent AppTests share one runtime and one compiled script until the end of the block, as the
+    sessions of a server do.
+
+    AppTest sets Runtime._instance for the length of one run and clears it afterwards, so one session's teardown
+    would remove the runtime under another session's running script. It also compiles the script on every run, and
+    concurrent compiles in threads are not safe on every Python version.
+
+    Other streamlit versions are left unpatched, with a warning: their sessions may then fail each other's reruns.
+    """
+    if not patchable():
+        warnings.warn(f'streamlit {getattr(streamlit, "__version__", "?")} is outside the versions '
+                      f'{PATCHED_VERSIONS} the shared runtime was checked against; the sessions run unpatched')
+        yield
+        return
+    instance, exists, get_bytecode = (Runtime.__dict__['instance'], Runtime.__dict__['exists'],
+                                      ScriptCache.get_bytecode)
+    shared, scripts = [], ScriptCache()
+
+    def current(cls):
+        if not shared and cls._instance is not None:
+            shared.append(cls._instance)
+        return shared[0] if shared else instance.__func__(cls)
+    try:
+        Runtime.instance = classmethod(current)
+        Runtime.exists = classmethod(lambda cls: bool(shared) or cls._instance is not None)
+        ScriptCache.get_bytecode = lambda self, script_path: get_bytecode(scripts, script_path)
+        yield
+    finally:
+        Runtime.instance, Runtime.exists, ScriptCache.get_bytecode = instance, exists, get_bytecode
+
+
+def patchable():
+    """Whether this streamlit has the internals shared_test_server replaces, in a version it was checked against."""
+    if Runtime is None or ScriptCache is None:
+        return False
+    version = tuple(int(part) for part in re.findall(r'\d+', streamlit.__version__)[:2])
+    return (PATCHED_VERSIONS[0] <= version <= PATCHED_VERSIONS[1] and
+            isinstance(Runtime.__dict__.get('instance'), classmethod) and
+            isinstance(Runtime.__dict__.get('exists'), classmethod) and
+            callable(getattr(ScriptCache, 'get_bytecode', None)) and hasattr(Runtime, '_instance'))
+
+
+def _timed_rerun(at, action, latencies, errors):
+    start = time.perf_counter()
+    try:
+        action()
+        failed = len(at.exception) > 0
+    except Exception:
+        failed = True
+    latencies.append(time.perf_counter() - start)
+    errors.append(failed)
+
+
+def run_session(session, pages=None, rounds=ROUNDS, script=DASHBOARD, timeout=TIMEOUT, seed=SEED):
+    """One viewer: open the dashboard and walk through the pages. Returns (rerun latencies, rerun failed flags)."""
+    rng = np.random.default_rng([seed, session])
+    latencies, errors = [], []
+    at = AppTest.from_file(script, default_timeout=timeout)
+    _timed_rerun(at, at.run, latencies, errors)
+    if errors[-1] and not at.sidebar.selectbox:
+        return latencies, errors
+    menu = at.sidebar.selectbox[0]
+    for _ in range(rounds):
+        for page in pages or menu.options:
+            _timed_rerun(at, lambda: at.sidebar.selectbox[0].select(page).run(), latencies, errors)
+            seasons = [m for m in at.sidebar.multiselect if m.label == SEASON_FILTER]
+            if page == STATIONS_PAGE and seasons:
+                options = seasons[0].options
+                chosen = [o for o in options if rng.random() < 0.5] or options[:1]
+                _timed_rerun(at, lambda: seasons[0].set_value(chosen).run(), latencies, errors)
+    return latencies, errors
+
+
+def _mb(nbytes):
+    return None if nbytes is None else round(nbytes / 2 ** 20, 1)
+
+
+def _format_mb(mb):
+    return 'n/a' if mb is None else f'{mb:,.0f} MB'
+
+
+def run_level(sessions, pages=None, rounds=ROUNDS, script=DASHBOARD, timeout=TIMEOUT, seed=SEED):
+    """Run sessions viewers at once; the latency percentiles, throughput and memory of the level."""
+    sampler = RssSampler()
+    sampler.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        results = list(pool.map(lambda s: run_session(s, pages, rounds, script, timeout, seed), range(sessions)))
+    seconds = time.perf_counter() - start
+    peak = sampler.stop()
+    latencies = np.concatenate([np.asarray(r[0]) for r in results])
+    errors = sum(sum(r[1]) for r in results)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (np.nan,) * 3
+    return {'time': datetime.now().isoformat(timespec='seconds'), 'sessions': sessions, 'reruns': len(latencies),
+            'errors': int(errors), 'p50': round(p50, 4), 'p95': round(p95, 4), 'p99': round(p99, 4),
+            'throughput': round(len(latencies) / seconds, 2), 'seconds': round(seconds, 2),
+            'rss_peak_mb': _mb(peak), 'rss_end_mb': _mb(rss_bytes())}
+
+
+def run_load_test(levels=SESSION_LEVELS, pages=None, rounds=ROUNDS, script=DASHBOARD, timeout=TIMEOUT, seed=SEED,
+                  out=None):
+    """One report row per concurrency level, in the order given (the caches stay warm from one level to the next)."""
+    if AppTest is None:
+        raise RuntimeError('load_test.py needs streamlit >= 1.28 (streamlit.testing.v1.AppTest)')
+    rows = []
+    with shared_test_server():
+        for sessions in levels:
+            row = run_level(sessions, pages, rounds, script, timeout, seed)
+            rows.append(row)
+            if out:
+                with open(out, 'a') as f:
+                    f.write(json.dumps(row) + '\n')
+            print(f'{sessions:>4} sessions: {row["reruns"]:,} reruns, p50 {row["p50"]:.3f} s, p95 {row["p95"]:.3f} s, '
+                  f'p99 {row["p99"]:.3f} s, {row["throughput"]:.1f} reruns/s, '
+                  f'peak RSS {_format_mb(row["rss_peak_mb"])}, {row["errors"]} errors')
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the dashboard with concurrent simulated sessions')
+    parser.add_argument('--sessions', nargs='+', type=int, default=SESSION_LEVELS, help='concurrency levels')
+    parser.add_argument('--rounds', type=int, default=ROUNDS, help='walks through the pages per session')
+    parser.add_argument('--pages', nargs='+', help='pages to visit (default: every page of the menu)')
+    parser.add_argument('--script', default=DASHBOARD)
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, help='seconds a rerun may take')
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--out', help='append one JSON line per level to this file')
+    args = parser.parse_args()
+    report = run_load_test(args.sessions, args.pages, args.rounds, args.script, args.timeout, args.seed, args.out)
+    print(report.to_string(index=False))
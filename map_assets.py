@@ -0,0 +1,353 @@
+################################################ CITIBIKES MAP ASSETS #####################################################
+# Static delivery of the kepler map: a small cached shell, the kepler bundle and the route data as separate files.
+#
+# The dashboard used to read nyc-citibike.html (the kepler bundle with every route row inlined as JSON) into a string
+# on every rerun of the map page and push it through the Streamlit websocket. Here the saved map is split into
+#   - index.html   the page shell (a few kB), revalidated with its ETag on every visit,
+#   - kepler.js    the kepler.gl bundle, identical for every build of the data,
+#   - routes.arrow the route table as an Arrow IPC stream (float32 coordinates, int32 trips),
+#   - config.json  the kepler map config (nyc_map.json from 2.5),
+# each with precompressed .gz (and .br when the brotli package is installed) variants and a sha1 ETag in
+# manifest.json. The shell fetches config and routes, then loads the bundle; kepler.js and routes.arrow are requested
+# with ?v=<etag> and cached by the browser for good, so a repeat visit only costs a 304 for the shell.
+#
+# The files are served by the asset server below (content negotiation, ETag / If-None-Match, Cache-Control). Streamlit's
+# own static serving is not used because it sends .html and .js as text/plain. Given map_layers.parquet, the server
+# also answers layers/routes.arrow and layers/stations.arrow for the selection in index.html's query string (see
+# map_layers.py), so the map only receives the routes the sidebar filters ask for.
+#
+#     python map_assets.py build trip_store --config nyc_map.json        (or a route CSV from stations.py)
+#     python map_assets.py serve --port 8504 --layers map_layers.parquet
+
+import os
+import re
+import gzip
+import json
+import hashlib
+import argparse
+import threading
+import pyarrow as pa
+import pandas as pd
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+from trip_store import STORE_DIR, read_station_dim, decode_station_keys
+from data_cache import LRUCache
+from map_layers import MAP_LAYERS_PATH, MapLayerService, layer_query, layer_params
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+MAP_ASSETS_DIR = 'map_assets'
+MAP_ASSETS_PORT = 8504
+MANIFEST_NAME = 'manifest.json'
+DATASET_ID = 'data_1'  # dataset id the 2.5 kepler config refers to
+
+ROUTE_PAYLOAD_COLUMNS = ['start_station_name', 'end_station_name', 'trips', 'start_lat', 'start_lng', 'end_lat',
+                         'end_lng']
+COUNT_COLUMNS = ['trips', 'departures', 'arrivals', 'net']
+
+CONTENT_TYPES = {'.html': 'text/html; charset=utf-8', '.js': 'application/javascript; charset=utf-8',
+                 '.json': 'application/json', '.arrow': 'application/vnd.apache.arrow.stream'}
+
+# The shell is revalidated on every visit; everything it loads is versioned by ETag and never changes under its URL
+SHELL_CACHE_CONTROL = 'no-cache'
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Layers are revalidated too: their ETag changes when the route counts are rebuilt
+LAYER_CACHE_CONTROL = 'no-cache'
+
+LAYERS_PREFIX = 'layers/'
+
+BOOTSTRAP_MARK = '<!-- map bootstrap -->'
+BOOTSTRAP = """<script>
+(function () {
+  var manifest = %(manifest)s;
+  function url(name) { return name + '?v=' + manifest[name].etag; }
+  function toBase64(buffer) {
+    // The kepler bundle takes Arrow datasets as base64 IPC streams (as keplergl's use_arrow)
+    var bytes = new Uint8Array(buffer), chunks = [];
+    for (var i = 0; i < bytes.length; i += 0x8000) {
+      chunks.push(String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000)));
+    }
+    return btoa(chunks.join(''));
+  }
+  function arrow(r) { return r.arrayBuffer(); }
+  // With a layer selection in the query string the routes come filtered from the layer endpoints, with stations
+  var query = window.location.search;
+  var loads = [fetch(url('config.json')).then(function (r) { return r.json(); }),
+               fetch(query ? 'layers/routes.arrow' + query : url('routes.arrow')).then(arrow)];
+  if (query) {
+    loads.push(fetch('layers/stations.arrow' + query).then(arrow));
+  }
+  Promise.all(loads).then(function (loaded) {
+    var config = loaded[0], data = {};
+    data[%(dataset)s] = toBase64(loaded[1]);
+    if (loaded.length > 2) {
+      data.stations = toBase64(loaded[2]);
+    }
+    window.__keplerglDataConfig = {config: config, data: data,
+                                   options: {readOnly: false, centerMap: !(config.config && config.config.mapState)}};
+    var bundle = document.createElement('script');
+    bundle.src = url('kepler.js');
+    document.body.appendChild(bundle);
+  });
+})();
+</script>"""
+
+
+########################## Building ##########################################################################################
+
+def kepler_template():
+    """The kepler.gl page template shipped with the keplergl package (what save_to_html fills in)."""
+    import keplergl
+    with open(os.path.join(os.path.dirname(keplergl.__file__), 'static', 'keplergl.html'), encoding='utf-8') as f:
+        return f.read()
+
+
+def split_template(html):
+    """(shell, bundle): the page without its data and the inline kepler bundle script, from a template or saved map."""
+    # A saved map (save_to_html) starts its body with the inlined data; drop it
+    html = re.sub(r'<script>window\.__keplerglDataConfig = .*?;</script>', '', html, count=1, flags=re.S)
+    bundle = None
+    for match in re.finditer(r'<script>(.*?)</script>', html, flags=re.S):
+        if '__keplerglDataConfig' in match.group(1):
+            bundle = match
+    if bundle is None:
+        raise ValueError('no kepler.gl bundle script found in the template')
+    return html[:bundle.start()] + BOOTSTRAP_MARK + html[bundle.end():], bundle.group(1)
+
+
+def arrow_payload(frame):
+    """A frame as an Arrow IPC stream: counts as int32, coordinates as float32, everything else as strings."""
+    columns = {}
+    for col in frame.columns:
+        values = frame[col]
+        if col in COUNT_COLUMNS:
+            columns[col] = pa.array(values.to_numpy(dtype='int32'))
+        elif col == 'lat' or col == 'lng' or col.endswith(('_lat', '_lng')):
+            columns[col] = pa.array(values.to_numpy(dtype='float32'), from_pandas=True)
+        else:
+            columns[col] = pa.array(values.astype(object), type=pa.string(), from_pandas=True)
+    table = pa.table(columns)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def route_payload(routes):
+    """The route table as an Arrow IPC stream: names, trips (int32) and float32 coordinates."""
+    return arrow_payload(routes[[c for c in ROUTE_PAYLOAD_COLUMNS if c in routes.columns]])
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6, mtime=0)
+    return body
+
+
+def load_routes(source):
+    """Route table with names and coordinates from a keyed trip store or a route file written by stations.py."""
+    if os.path.isdir(source):
+        from stations import keyed_map_routes
+        return decode_station_keys(keyed_map_routes(source), read_station_dim(source))
+    if source.endswith('.parquet'):
+        routes = pd.read_parquet(source)
+        if 'start_station_key' in routes.columns:
+            routes = decode_station_keys(routes, read_station_dim())
+        return routes
+    routes = pd.read_csv(source)
+    # 2.5 names the count column 'value'
+    return routes.rename(columns={'value': 'trips'})
+
+
+def write_asset(folder, name, body):
+    """Write one asset with its precompressed variants; returns its manifest entry."""
+    entry = {'etag': hashlib.sha1(body).hexdigest()[:16], 'bytes': len(body)}
+    variants = {'': body, '.gz': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = compress(body, 'br')
+    for suffix, data in variants.items():
+        path = os.path.join(folder, name + suffix)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        if suffix:
+            entry[suffix[1:]] = len(data)
+    return entry
+
+
+def build_map_assets(routes, config=None, template=None, folder=MAP_ASSETS_DIR):
+    """Write shell, bundle, route payload and config to folder. Returns the manifest."""
+    os.makedirs(folder, exist_ok=True)
+    shell, bundle = split_template(template if template is not None else kepler_template())
+    manifest = {'kepler.js': write_asset(folder, 'kepler.js', bundle.encode('utf-8')),
+                'routes.arrow': write_asset(folder, 'routes.arrow', route_payload(routes)),
+                'config.json': write_asset(folder, 'config.json', json.dumps(config or {}).encode('utf-8'))}
+    bootstrap = BOOTSTRAP % {'manifest': json.dumps({name: {'etag': entry['etag']} for name, entry in manifest.items()}),
+                             'dataset': json.dumps(DATASET_ID)}
+    manifest['index.html'] = write_asset(folder, 'index.html', shell.replace(BOOTSTRAP_MARK, bootstrap).encode('utf-8'))
+    path = os.path.join(folder, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+    return manifest
+
+
+def read_manifest(folder=MAP_ASSETS_DIR):
+    path = os.path.join(folder, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+########################## Serving ###########################################################################################
+
+class AssetHandler(BaseHTTPRequestHandler):
+    """Serves the files listed in an asset folder's manifest: br/gzip by Accept-Encoding, strong ETags and 304s.
+
+    With a layers_path (map_layers.parquet), layers/routes.arrow and layers/stations.arrow return the map layers of
+    the selection in their query string (see map_layers.layer_query).
+    """
+    folder = MAP_ASSETS_DIR
+    layers_path = None
+    store = STORE_DIR
+    loaded = (None, {})  # (manifest mtime, manifest); reloaded when build_map_assets rewrites the folder
+    layers = (None, None)  # (map layers mtime, MapLayerService)
+    payloads = LRUCache(maxsize=64)
+
+    def manifest(self):
+        path = os.path.join(self.folder, MANIFEST_NAME)
+        mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+        if mtime != type(self).loaded[0]:
+            type(self).loaded = (mtime, read_manifest(self.folder) or {})
+        return type(self).loaded[1]
+
+    def layer_service(self):
+        if self.layers_path is None or not os.path.exists(self.layers_path):
+            return None, None
+        mtime = os.stat(self.layers_path).st_mtime_ns
+        if mtime != type(self).layers[0]:
+            type(self).layers = (mtime, MapLayerService.from_files(self.layers_path, self.store))
+        return type(self).layers
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        name = url.path.lstrip('/') or 'index.html'
+        if name.startswith(LAYERS_PREFIX):
+            return self._layer(name[len(LAYERS_PREFIX):], url.query)
+        entry = self.manifest().get(name)
+        if entry is None:
+            return self._send(404, b'not found', {'Content-Type': 'text/plain'})
+
+        encoding = self._encoding([e for e, key in [('br', 'br'), ('gzip', 'gz')] if key in entry])
+
+        def body():
+            suffix = {'br': '.br', 'gzip': '.gz'}.get(encoding, '')
+            with open(os.path.join(self.folder, name + suffix), 'rb') as f:
+                return f.read()
+
+        cache_control = SHELL_CACHE_CONTROL if name == 'index.html' else ASSET_CACHE_CONTROL
+        self._respond(name, entry['etag'], encoding, cache_control, body)
+
+    def _layer(self, name, query):
+        mtime, service = self.layer_service()
+        if service is None or name not in ['routes.arrow', 'stations.arrow']:
+            return self._send(404, b'not found', {'Content-Type': 'text/plain'})
+        try:
+            params = layer_params(query)
+        except (ValueError, KeyError) as error:
+            return self._send(400, str(error).encode(), {'Content-Type': 'text/plain'})
+        if name == 'stations.arrow':
+            params = {k: params[k] for k in ['seasons', 'rideable_types', 'start', 'end', 'near', 'radius']}
+        # Same data version and the same selection give the same payload
+        canonical = layer_query(**params) if name == 'routes.arrow' else layer_query(**params, level='all')
+        etag = hashlib.sha1(f'{mtime}|{name}|{canonical}'.encode()).hexdigest()[:16]
+        encoding = self._encoding(['br', 'gzip'] if brotli is not None else ['gzip'])
+
+        def body():
+            def compute():
+                layer = service.routes(**params) if name == 'routes.arrow' else service.stations(**params)
+                return compress(arrow_payload(layer), encoding)
+            return self.payloads.get_or_compute((etag, encoding), compute)
+
+        self._respond(name, etag, encoding, LAYER_CACHE_CONTROL, body)
+
+    def _encoding(self, available):
+        accepted = [e.split(';')[0].strip() for e in self.headers.get('Accept-Encoding', '').split(',')]
+        return next((e for e in available if e in accepted), None)
+
+    def _respond(self, name, etag, encoding, cache_control, body):
+        etag = f'"{etag}{"-" + encoding if encoding else ""}"'
+        headers = {'ETag': etag, 'Vary': 'Accept-Encoding', 'Cache-Control': cache_control}
+        if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+            return self._send(304, b'', headers)
+        headers['Content-Type'] = CONTENT_TYPES.get(os.path.splitext(name)[1], 'application/octet-stream')
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        self._send(200, body(), headers)
+
+    def _send(self, status, body, headers):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_asset_server(folder=MAP_ASSETS_DIR, port=MAP_ASSETS_PORT, host='127.0.0.1', layers_path=None,
+                       store=STORE_DIR):
+    """Serve folder (and the map layers, with a layers_path) in a background thread. Returns (server, url)."""
+    handler = type('Handler', (AssetHandler,), {'folder': folder, 'layers_path': layers_path, 'store': store})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or serve the static kepler map assets')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='write shell, bundle, route payload and config')
+    build.add_argument('source', nargs='?', default=STORE_DIR,
+                       help='keyed trip store, or a route table (.parquet / .csv) written by stations.py')
+    build.add_argument('--config', default='nyc_map.json', help='kepler config saved in 2.5 (optional)')
+    build.add_argument('--template', help='kepler page to take the bundle from (default: the keplergl package)')
+    build.add_argument('--out', default=MAP_ASSETS_DIR)
+    serve = commands.add_parser('serve', help='serve the assets with ETags and compression')
+    serve.add_argument('--folder', default=MAP_ASSETS_DIR)
+    serve.add_argument('--port', type=int, default=MAP_ASSETS_PORT)
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--layers', default=MAP_LAYERS_PATH, help='route counts from map_layers.py / ingest.py')
+    serve.add_argument('--store', default=STORE_DIR, help='trip store with the station dimension')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        config = None
+        if os.path.exists(args.config):
+            with open(args.config) as f:
+                config = json.load(f)
+        template = None
+        if args.template:
+            with open(args.template, encoding='utf-8') as f:
+                template = f.read()
+        manifest = build_map_assets(load_routes(args.source), config, template, args.out)
+        for name, entry in manifest.items():
+            sizes = ', '.join(f'{k} {entry[k]:,}' for k in ['gz', 'br'] if k in entry)
+            print(f'{name}: {entry["bytes"]:,} bytes ({sizes})')
+    else:
+        handler = type('Handler', (AssetHandler,), {'folder': args.folder, 'layers_path': args.layers,
+                                                    'store': args.store})
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        print(f'Map assets on http://{args.host}:{args.port}/index.html')
+        server.serve_forever()
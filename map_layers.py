@@ -0,0 +1,253 @@
+################################################ CITIBIKES MAP LAYERS #####################################################
+# Pre-aggregated route and station layers for the kepler map, cut to the sidebar filters on the server.
+#
+# Extra 2.5 puts raw route rows into KeplerGl(data={'data_1': df_reduced}) and leaves every filter to the browser, so
+# the route table has to be cut down to fit a file-size budget first, and the long-tail routes are the ones dropped.
+# Here the routes are counted once per
+#
+#     start station key x end station key x season x rideable_type x year_month
+#
+# (map_layers.parquet, maintained per source file by ingest.py), and a layer is assembled on request from those
+# counts: the selected seasons, bike types and months are summed per route with np.bincount, routes under min_trips are
+# dropped and a level of detail keeps the top N routes of every start station. Asking for one station returns its
+# complete set of routes, however small. With a station and a radius, only the routes starting or ending within that
+# distance of the station are returned (see station_index.py).
+#
+# year_month (YYYYMM) gives the layers a date range at month resolution. Counts built before it existed have
+# year_month -1 and only count towards the full range; 'python ingest.py <folder> --full' rebuilds them by month.
+#
+#     python map_layers.py trip_store map_layers.parquet
+#
+#     layers = MapLayerService.from_files('map_layers.parquet', 'trip_store')
+#     layers.routes(seasons=['summer'], rideable_types=['electric_bike'], min_trips=5, level='top5', start='2022-06-01')
+
+import argparse
+import numpy as np
+import pandas as pd
+from urllib.parse import parse_qs, urlencode
+from trip_store import STORE_DIR, SEASONS, open_store, read_station_dim, decode_station_keys
+from station_index import StationIndex
+
+
+MAP_LAYERS_PATH = 'map_layers.parquet'
+
+ROUTE_LAYER_DIMENSIONS = ['start_station_key', 'end_station_key', 'season', 'rideable_type', 'year_month']
+
+# Columns the build reads from the trips (year_month is derived from the date)
+ROUTE_LAYER_INPUT_COLUMNS = ['start_station_key', 'end_station_key', 'season', 'rideable_type', 'date']
+
+# Level of detail -> most routes kept per start station (None keeps every route)
+LEVELS_OF_DETAIL = {'top1': 1, 'top5': 5, 'top20': 20, 'all': None}
+
+
+########################## Build ############################################################################################
+
+def year_month(dates):
+    """YYYYMM of each date (-1 where unknown)."""
+    dates = pd.to_datetime(pd.Series(dates))
+    return (dates.dt.year * 100 + dates.dt.month).fillna(-1).astype('int32')
+
+
+def route_layer_counts(trips):
+    """Trips per route, season, bike type and month of one chunk of keyed trips. Mergeable by summing trips."""
+    trips = trips[(trips['start_station_key'] >= 0) & (trips['end_station_key'] >= 0)]
+    keys = {c: trips[c].astype(object) if isinstance(trips[c].dtype, pd.CategoricalDtype) else trips[c]
+            for c in ROUTE_LAYER_DIMENSIONS[:-1]}
+    keys['year_month'] = year_month(trips['date']).to_numpy() if 'date' in trips.columns else -1
+    counts = pd.DataFrame(keys).groupby(ROUTE_LAYER_DIMENSIONS, dropna=False).size()
+    return counts.rename('trips').reset_index()
+
+
+def merge_route_layer_counts(partials):
+    partials = [p for p in partials if len(p)]
+    if not partials:
+        counts = pd.DataFrame({'start_station_key': pd.Series(dtype='int32'), 'end_station_key': pd.Series(dtype='int32'),
+                               'season': pd.Series(dtype=object), 'rideable_type': pd.Series(dtype=object),
+                               'year_month': pd.Series(dtype='int32'), 'trips': pd.Series(dtype='int64')})
+    else:
+        # Counts saved before year_month existed cover an unknown month
+        counts = pd.concat([p.astype({'season': object, 'rideable_type': object}) for p in partials], ignore_index=True)
+        counts['year_month'] = counts['year_month'].fillna(-1) if 'year_month' in counts.columns else -1
+        counts = counts.groupby(ROUTE_LAYER_DIMENSIONS, dropna=False)['trips'].sum().reset_index()
+    return counts.astype({'start_station_key': 'int32', 'end_station_key': 'int32', 'year_month': 'int32',
+                          'trips': 'int64', 'season': pd.CategoricalDtype(SEASONS, ordered=True), 'rideable_type': 'category'})
+
+
+def build_route_layer_counts(root=STORE_DIR):
+    """The route counts of an existing keyed trip store, one partition file at a time."""
+    dataset = open_store(root)
+    if 'start_station_key' not in dataset.schema.names:
+        raise ValueError(f'{root} has no station keys; rebuild it with ingest.py')
+    columns = [c for c in ROUTE_LAYER_INPUT_COLUMNS if c in dataset.schema.names]
+    return merge_route_layer_counts([route_layer_counts(fragment.to_table(columns=columns).to_pandas())
+                                     for fragment in dataset.get_fragments()])
+
+
+def write_map_layers(counts, path=MAP_LAYERS_PATH):
+    counts.to_parquet(path, index=False)
+    return path
+
+
+def read_map_layers(path=MAP_LAYERS_PATH):
+    return merge_route_layer_counts([pd.read_parquet(path)])
+
+
+########################## Layers ###########################################################################################
+
+class MapLayerService:
+    """Route and station layers of the map for any season / bike type selection."""
+
+    def __init__(self, counts, dim):
+        self.dim = dim
+        start = counts['start_station_key'].to_numpy(dtype='int64')
+        end = counts['end_station_key'].to_numpy(dtype='int64')
+        self.n_stations = int(max(len(dim), start.max() + 1 if len(start) else 0, end.max() + 1 if len(end) else 0))
+        # Every distinct route once; each count row points at its route
+        routes, self.route_index = np.unique(start * self.n_stations + end, return_inverse=True)
+        self.start = routes // self.n_stations
+        self.end = routes % self.n_stations
+        self.trips = counts['trips'].to_numpy(dtype='int64')
+        self.season = pd.Categorical(counts['season'], categories=SEASONS)
+        self.rideable_type = pd.Categorical(counts['rideable_type'])
+        self.year_month = counts['year_month'].to_numpy(dtype='int64')
+        self.keys = dict(zip(dim['station_name'].astype(object), dim['station_key'].astype(int)))
+        self.lat = np.full(self.n_stations, np.nan)
+        self.lng = np.full(self.n_stations, np.nan)
+        self.lat[dim['station_key'].to_numpy()] = dim['lat'].to_numpy(dtype='float64')
+        self.lng[dim['station_key'].to_numpy()] = dim['lng'].to_numpy(dtype='float64')
+        self.index = StationIndex(dim)
+
+    @classmethod
+    def from_files(cls, path=MAP_LAYERS_PATH, root=STORE_DIR):
+        return cls(read_map_layers(path), read_station_dim(root))
+
+    def seasons(self):
+        return [s for s in SEASONS if (self.season == s).any()]
+
+    def rideable_types(self):
+        return list(self.rideable_type.categories)
+
+    def totals(self, seasons=None, rideable_types=None, start=None, end=None):
+        """Trips of every route (in route order) over the selected seasons, bike types and the months from start to
+        end (dates, month resolution); None selects all."""
+        mask = np.ones(len(self.trips), dtype=bool)
+        if seasons is not None:
+            mask &= np.isin(self.season, list(seasons))
+        if rideable_types is not None:
+            mask &= np.isin(self.rideable_type, list(rideable_types))
+        if start is not None:
+            mask &= self.year_month >= year_month([start])[0]
+        if end is not None:
+            mask &= (self.year_month >= 0) & (self.year_month <= year_month([end])[0])
+        totals = np.bincount(self.route_index[mask], weights=self.trips[mask], minlength=len(self.start))
+        return totals.astype('int64')
+
+    def area(self, near=None, radius=None):
+        """Whether each station key lies within radius metres of the station near (None: no area, all stations)."""
+        if near is None or radius is None:
+            return None
+        inside = np.zeros(self.n_stations, dtype=bool)
+        if near in self.index.positions:
+            inside[self.index.keys_within(*self.index.location(near), float(radius))] = True
+        return inside
+
+    def _station_rank(self, totals):
+        # Rank of every route among the routes of its start station, busiest first
+        order = np.lexsort((-totals, self.start))
+        starts = self.start[order]
+        first = np.flatnonzero(np.r_[True, starts[1:] != starts[:-1]])
+        rank = np.empty(len(order), dtype='int64')
+        rank[order] = np.arange(len(order)) - np.repeat(first, np.diff(np.r_[first, len(order)]))
+        return rank
+
+    def routes(self, seasons=None, rideable_types=None, min_trips=1, level='all', station=None, start=None, end=None,
+               near=None, radius=None):
+        """The route layer: start/end station, trips and coordinates, busiest first.
+
+        level is a key of LEVELS_OF_DETAIL. With a station name, only the routes from or to that station are returned;
+        with near and radius, only the routes from or to a station within radius metres of the station near.
+        """
+        totals = self.totals(seasons, rideable_types, start, end)
+        keep = totals >= max(int(min_trips), 1)
+        if station is not None:
+            key = self.keys.get(station, -1)
+            keep &= (self.start == key) | (self.end == key)
+        inside = self.area(near, radius)
+        if inside is not None:
+            keep &= inside[self.start] | inside[self.end]
+        top = LEVELS_OF_DETAIL[level]
+        if top is not None:
+            keep &= self._station_rank(totals) < top
+        rows = np.flatnonzero(keep)
+        rows = rows[np.argsort(-totals[rows], kind='stable')]
+        start, end = self.start[rows], self.end[rows]
+        layer = pd.DataFrame({'start_station_key': start.astype('int32'), 'end_station_key': end.astype('int32'),
+                              'trips': totals[rows], 'start_lat': self.lat[start], 'start_lng': self.lng[start],
+                              'end_lat': self.lat[end], 'end_lng': self.lng[end]})
+        return decode_station_keys(layer, self.dim)
+
+    def stations(self, seasons=None, rideable_types=None, start=None, end=None, near=None, radius=None):
+        """The station layer: departures, arrivals and net flow (arrivals - departures) of every used station (in the
+        area of near and radius when given)."""
+        totals = self.totals(seasons, rideable_types, start, end)
+        departures = np.bincount(self.start, weights=totals, minlength=self.n_stations).astype('int64')
+        arrivals = np.bincount(self.end, weights=totals, minlength=self.n_stations).astype('int64')
+        inside = self.area(near, radius)
+        keys = np.flatnonzero((departures + arrivals) * (inside if inside is not None else 1))
+        names = pd.Categorical.from_codes(keys, categories=pd.Index(self.dim['station_name'].astype(object)))
+        layer = pd.DataFrame({'station_name': names, 'departures': departures[keys], 'arrivals': arrivals[keys],
+                              'net': arrivals[keys] - departures[keys], 'lat': self.lat[keys], 'lng': self.lng[keys]})
+        return layer.sort_values('departures', ascending=False, ignore_index=True)
+
+
+########################## Query strings ####################################################################################
+
+def layer_query(seasons=None, rideable_types=None, min_trips=1, level='all', station=None, start=None, end=None,
+                near=None, radius=None):
+    """URL query of a layer selection (the map shell passes it on to the layer endpoints)."""
+    params = {'min_trips': int(min_trips), 'level': level}
+    for name, date in [('start', start), ('end', end)]:
+        if date is not None:
+            params[name] = pd.Timestamp(date).strftime('%Y-%m-%d')
+    if seasons is not None:
+        params['seasons'] = ','.join(sorted(seasons))
+    if rideable_types is not None:
+        params['bikes'] = ','.join(sorted(rideable_types))
+    if station is not None:
+        params['station'] = station
+    if near is not None and radius is not None:
+        params['near'], params['radius'] = near, int(radius)
+    return urlencode(sorted(params.items()))
+
+
+def _query_date(params, name):
+    # A date of the query string; ValueError for anything pd.Timestamp cannot read as one
+    if name not in params:
+        return None
+    date = pd.Timestamp(params[name])
+    if pd.isna(date):
+        raise ValueError(f'{name} is not a date: {params[name]!r}')
+    return date.normalize()
+
+
+def layer_params(query):
+    """Keyword arguments of MapLayerService.routes from a layer_query string. Raises ValueError for a bad value."""
+    params = {k: v[0] for k, v in parse_qs(query, keep_blank_values=True).items()}
+    level = params.get('level', 'all')
+    if level not in LEVELS_OF_DETAIL:
+        raise ValueError(f'unknown level of detail {level!r}')
+    return {'seasons': params['seasons'].split(',') if 'seasons' in params else None,
+            'rideable_types': params['bikes'].split(',') if 'bikes' in params else None,
+            'min_trips': int(params.get('min_trips', 1)), 'level': level, 'station': params.get('station'),
+            'start': _query_date(params, 'start'), 'end': _query_date(params, 'end'), 'near': params.get('near'),
+            'radius': int(params['radius']) if 'radius' in params else None}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Count routes per season, bike type and month for the map layers')
+    parser.add_argument('store', nargs='?', default=STORE_DIR, help='keyed trip store (built by ingest.py)')
+    parser.add_argument('out', nargs='?', default=MAP_LAYERS_PATH)
+    args = parser.parse_args()
+    counts = build_route_layer_counts(args.store)
+    write_map_layers(counts, args.out)
+    print(f'Wrote {len(counts):,} route counts to {args.out}')
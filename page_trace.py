@@ -0,0 +1,153 @@
+################################################ CITIBIKES PAGE TRACES #####################################################
+# Timing spans of a dashboard page render, to tell which step of a slow page is slow.
+#
+# Every render of a page gets a PageTrace. The page marks the end of each step with trace.lap(name) (data load,
+# filtering, aggregation, figure construction) or wraps it in trace.span(name); figures go through
+# trace.render_figure, which times their serialization and rendering separately. Each span records its wall-clock
+# seconds, the change in the process's resident memory and, where it applies, the bytes sent to the browser. Cached
+# steps show up as near-zero spans, so a slow span on a warm page is the step itself and not the data it reads.
+#
+# The current resident memory comes from psutil when it is installed, else from /proc (Linux). Elsewhere only the
+# peak is known (resource.getrusage), which says nothing about one span, so the memory columns are null ("n/a").
+#
+# The dashboard shows the spans of the current render in a sidebar panel (DASHBOARD_DEBUG=1) and appends one JSON
+# line per render to DASHBOARD_TRACE_LOG when it is set:
+#
+#     {"time": "...", "page": "Most popular stations", "seconds": 0.41, "rss_mb": 612.3,
+#      "spans": [{"span": "load", "seconds": 0.02, "rss_delta_mb": 0.0, "bytes": null}, ...]}
+#
+#     python page_trace.py dashboard_trace.jsonl        (seconds per page and span: median, p95, max)
+
+import os
+import json
+import time
+import sys
+import argparse
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+TRACE_LOG_ENV = 'DASHBOARD_TRACE_LOG'
+DEBUG_ENV = 'DASHBOARD_DEBUG'
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+_log_lock = threading.Lock()
+
+
+def rss_bytes():
+    """Current resident memory of the process, or None where it cannot be read (see peak_rss_bytes)."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return None
+
+
+def peak_rss_bytes():
+    """Peak resident memory of the process so far, or None where it cannot be read."""
+    try:
+        import resource  # not on Windows
+    except ImportError:
+        return getattr(psutil.Process().memory_info(), 'peak_wset', None) if psutil is not None else None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux and the BSDs
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _mb(nbytes, digits):
+    return None if nbytes is None else round(nbytes / 2 ** 20, digits)
+
+
+class PageTrace:
+    """The spans of one page render. With enabled=False spans are still timed but payloads are not measured."""
+
+    def __init__(self, page, enabled=True):
+        self.page = page
+        self.enabled = enabled
+        self.spans = []
+        self.time = datetime.now().isoformat(timespec='milliseconds')
+        self._start = time.perf_counter()
+        self._mark = (self._start, rss_bytes())
+
+    @contextmanager
+    def span(self, name):
+        """Time the block. The yielded dict takes the payload size of the step as 'bytes'."""
+        record = {'span': name, 'seconds': None, 'rss_delta_mb': None, 'bytes': None}
+        rss, start = rss_bytes(), time.perf_counter()
+        try:
+            yield record
+        finally:
+            self._close(record, start, rss)
+
+    def lap(self, name, payload_bytes=None):
+        """Record the time since the previous lap or span (or the start) as span name."""
+        record = {'span': name, 'seconds': None, 'rss_delta_mb': None, 'bytes': payload_bytes}
+        self._close(record, *self._mark)
+        return record
+
+    def _close(self, record, start, rss):
+        end, end_rss = time.perf_counter(), rss_bytes()
+        record['seconds'] = round(end - start, 6)
+        record['rss_delta_mb'] = None if rss is None or end_rss is None else _mb(end_rss - rss, 3)
+        self.spans.append(record)
+        self._mark = (end, end_rss)
+
+    def render_figure(self, render, fig, **kwargs):
+        """Serialize a Plotly figure (to measure its payload) and hand it to render, e.g. st.plotly_chart."""
+        if self.enabled:
+            with self.span('serialize') as record:
+                record['bytes'] = len(fig.to_json().encode())
+        with self.span('render'):
+            return render(fig, **kwargs)
+
+    def record(self):
+        return {'time': self.time, 'page': self.page, 'seconds': round(time.perf_counter() - self._start, 6),
+                'rss_mb': _mb(rss_bytes(), 1), 'spans': list(self.spans)}
+
+    def table(self):
+        """The spans as a frame, with a total row (the whole render, including the time outside the spans)."""
+        record = self.record()
+        total = {'span': 'total', 'seconds': record['seconds'], 'rss_delta_mb': None,
+                 'bytes': sum(s['bytes'] for s in self.spans if s['bytes'] is not None) or None}
+        table = pd.DataFrame(self.spans + [total], columns=['span', 'seconds', 'rss_delta_mb', 'bytes'])
+        table['rss_delta_mb'] = [f'{d:+.3f}' if pd.notna(d) else 'n/a' for d in table['rss_delta_mb']]
+        return table
+
+    def write(self, path):
+        """Append the render as one JSON line (safe to call from concurrent sessions)."""
+        line = json.dumps(self.record())
+        with _log_lock, open(path, 'a') as f:
+            f.write(line + '\n')
+        return path
+
+
+def read_traces(path):
+    """One row per span of every logged render: time, page, render seconds, span, seconds, rss_delta_mb, bytes."""
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    rows = [{'time': r['time'], 'page': r['page'], 'render_seconds': r['seconds'], **s}
+            for r in records for s in r['spans']]
+    return pd.DataFrame(rows, columns=['time', 'page', 'render_seconds', 'span', 'seconds', 'rss_delta_mb', 'bytes'])
+
+
+def summarize(traces):
+    """Seconds per page and span over the logged renders: count, median, p95 and max, and the median payload."""
+    summary = traces.groupby(['page', 'span'], sort=False).agg(
+        renders=('seconds', 'size'), median=('seconds', 'median'), p95=('seconds', lambda s: s.quantile(0.95)),
+        max=('seconds', 'max'), bytes=('bytes', 'median'))
+    return summary.reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the page traces logged by the dashboard')
+    parser.add_argument('log', nargs='?', default=os.environ.get(TRACE_LOG_ENV, 'dashboard_trace.jsonl'))
+    args = parser.parse_args()
+    print(summarize(read_traces(args.log)).to_string(index=False, float_format=lambda x: f'{x:.4f}'))
@@ -0,0 +1,282 @@
+################################################ CITIBIKES SAMPLING #####################################################
+# Size-targeted samples of the trips, e.g. the reduced_data_to_plot.csv the dashboard is deployed with.
+#
+# Extra 2.5 finds its sample fraction by trial and error: sample 40%, then 20%, write each CSV, measure it with
+# os.path.getsize and rescale the fraction by target size / measured size. Here the fraction comes from a probe: the
+# first rows are encoded in the output format at two sizes in memory, which gives the fixed (header / footer) and
+# per-row cost. One pass over the source then draws a Bernoulli sample slightly above the target, and the sample is
+# trimmed to the budget by dropping random rows, measuring its exact encoded size in memory each time. Only the
+# final file is written.
+#
+# Stratified samples (--fraction) draw the same share of every date x start station x rideable_type stratum and store
+# each row's stratum and weight (trips it stands for), so the dashboard can show estimated totals with confidence
+# intervals (estimate_counts) instead of raw sample counts. Strata too small to get two sample rows are pooled with
+# their neighbours (same date and station, then same date), so the sample keeps close to the fraction asked for.
+#
+#     python sampling.py trip_store reduced_data_to_plot.csv --budget-mb 24.5
+#     python sampling.py 2022-citibike-tripdata.csv sample.parquet --budget-mb 100 --tolerance 0.01
+#     python sampling.py trip_store reduced_data_to_plot.csv --fraction 0.1 --columns season rideable_type
+
+import io
+import os
+import argparse
+from itertools import chain
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+from trip_store import STORE_DIR, STATION_KEYS, SEASONS, open_store, read_station_dim, decode_station_keys
+
+
+SAMPLE_FORMATS = ['csv', 'parquet']
+PROBE_ROWS = 20_000
+CHUNK_ROWS = 1_000_000
+TOLERANCE = 0.02
+MAX_TRIMS = 6
+SEED = 32  # the seed of the 2.5 samples
+
+# Strata of the stratified samples, and the z of a 95% interval
+STRATA = ['date', 'start_station_name', 'rideable_type']
+MIN_PER_STRATUM = 2
+Z_95 = 1.96
+
+
+########################## Encoding #########################################################################################
+
+def encode(df, fmt):
+    """The bytes df would be written as."""
+    buffer = io.BytesIO()
+    if fmt == 'csv':
+        df.to_csv(buffer, index=False)
+    elif fmt == 'parquet':
+        df.to_parquet(buffer, index=False)
+    else:
+        raise ValueError(f'format must be one of {SAMPLE_FORMATS}, not {fmt!r}')
+    return buffer.getvalue()
+
+
+def encoded_size_model(probe, fmt):
+    """(fixed bytes, bytes per row) of the format, from encoding the probe and its first half."""
+    half = probe.iloc[:len(probe) // 2]
+    small, large = len(encode(half, fmt)), len(encode(probe, fmt))
+    per_row = (large - small) / max(len(probe) - len(half), 1)
+    return max(small - per_row * len(half), 0.0), per_row
+
+
+########################## Source ###########################################################################################
+
+def _store_reader(source, columns):
+    # Store columns to read for the requested ones, and a function turning what was read into the requested frame
+    dataset = open_store(source)
+    names = dataset.schema.names
+    decode = [c for c in columns if c not in names and STATION_KEYS.get(c) in names] if columns else []
+    read = [STATION_KEYS[c] if c in decode else c for c in columns if c in names or c in decode] if columns else None
+    dim = read_station_dim(source) if decode else None
+
+    def to_frame(table):
+        chunk = table.to_pandas()
+        if 'season' in chunk.columns:
+            chunk['season'] = pd.Categorical(chunk['season'], categories=SEASONS, ordered=True)
+        if decode:
+            chunk = decode_station_keys(chunk, dim, [STATION_KEYS[c] for c in decode])
+        return chunk[[c for c in columns if c in chunk.columns]] if columns else chunk
+    return dataset, read, to_frame
+
+
+def _iter_chunks(source, columns=None, chunk_rows=CHUNK_ROWS):
+    if os.path.isdir(source):
+        dataset, read, to_frame = _store_reader(source, columns)
+        for batch in dataset.to_batches(columns=read, batch_size=chunk_rows):
+            yield to_frame(batch)
+    else:
+        yield from pd.read_csv(source, usecols=columns, chunksize=chunk_rows)
+
+
+def _iter_months(source, columns=None):
+    # Whole month partitions of a store (every trip of a date is in its month), or the whole CSV at once
+    if os.path.isdir(source):
+        dataset, read, to_frame = _store_reader(source, columns)
+        months = sorted({tuple(ds.get_partition_keys(f.partition_expression).get(k) for k in ['year', 'month'])
+                         for f in dataset.get_fragments()})
+        for year, month in months:
+            yield to_frame(dataset.to_table(columns=read, filter=(ds.field('year') == year) & (ds.field('month') == month)))
+    else:
+        yield pd.read_csv(source, usecols=columns)
+
+
+def estimate_rows(source, probe_rows=PROBE_ROWS):
+    """Rows of the source: exact for a trip store (Parquet metadata), from the probe's line length for a CSV."""
+    if os.path.isdir(source):
+        return open_store(source).count_rows()
+    with open(source, 'rb') as f:
+        header = len(f.readline())
+        probe = [len(line) for _, line in zip(range(probe_rows), f)]
+    if not probe:
+        return 0
+    return round((os.path.getsize(source) - header) / (sum(probe) / len(probe)))
+
+
+########################## Sampling #########################################################################################
+
+def sample_to_size(source, budget, fmt='csv', tolerance=TOLERANCE, columns=None, seed=SEED, chunk_rows=CHUNK_ROWS):
+    """Random sample of source whose encoded size is within tolerance (a share) of budget bytes.
+
+    Returns (encoded bytes, report). The report holds the rows and bytes of the sample, the fraction drawn and
+    whether the budget was met (a source smaller than the budget is returned whole).
+    """
+    rng = np.random.default_rng(seed)
+    chunks = _iter_chunks(source, columns, chunk_rows)
+    first = next(chunks, None)
+    if first is None:
+        raise ValueError(f'{source} has no rows')
+    fixed, per_row = encoded_size_model(first.head(PROBE_ROWS), fmt)
+    total = max(estimate_rows(source), len(first))
+    # Draw a little more than needed; the excess is trimmed against the exact encoded size below
+    fraction = min(1.0, (budget - fixed) / per_row * (1 + 2 * tolerance) / total)
+
+    parts, seen = [], 0
+    for chunk in chain([first], chunks):
+        seen += len(chunk)
+        parts.append(chunk[rng.random(len(chunk)) < fraction])
+    sample = pd.concat(parts, ignore_index=True)
+
+    # Rows are dropped in a random order, and the kept ones stay in source order
+    drop_order = rng.permutation(len(sample))
+    rows = len(sample)
+    for _ in range(MAX_TRIMS):
+        body = encode(sample.iloc[np.sort(drop_order[:rows])], fmt)
+        size = len(body)
+        if abs(size - budget) <= tolerance * budget or (size < budget and rows == len(sample)):
+            break
+        rows = min(len(sample), int(rows * (budget - fixed) / max(size - fixed, 1)))
+
+    report = {'source_rows': seen, 'rows': rows, 'bytes': size, 'fraction': rows / max(seen, 1),
+              'within_tolerance': abs(size - budget) <= tolerance * budget}
+    return body, report
+
+
+########################## Stratified samples ###############################################################################
+
+def collapse_strata(frame, strata, fraction, min_per_stratum=MIN_PER_STRATUM):
+    """Stratum code of every row of frame.
+
+    A row's stratum is its group of strata when that group expects min_per_stratum sample rows (fraction * N_h);
+    the rows of smaller groups are pooled per group of strata[:-1], then strata[:-2], ..., and finally all together.
+    """
+    codes = np.full(len(frame), -1, dtype='int64')
+    offset = 0
+    for depth in range(len(strata), -1, -1):
+        pending = np.flatnonzero(codes < 0)
+        if not len(pending):
+            break
+        if depth:
+            group = frame.iloc[pending].groupby(list(strata[:depth]), observed=True, dropna=False,
+                                                sort=False).ngroup().to_numpy()
+        else:
+            group = np.zeros(len(pending), dtype='int64')
+        keep = fraction * np.bincount(group)[group] >= min_per_stratum if depth else np.ones(len(pending), bool)
+        used, code = np.unique(group[keep], return_inverse=True)
+        codes[pending[keep]] = offset + code
+        offset += len(used)
+    return codes
+
+
+def stratified_sample(source, fraction, strata=STRATA, columns=None, min_per_stratum=MIN_PER_STRATUM, seed=SEED):
+    """Simple random sample of round(fraction * N_h) rows (at least min_per_stratum) from every stratum h.
+
+    Sparse strata are pooled (see collapse_strata), so the sample stays close to fraction of the trips and every
+    stratum has the two rows its variance estimate needs. Every row carries its stratum id and its weight N_h / n_h,
+    the number of trips it stands for.
+    """
+    rng = np.random.default_rng(seed)
+    if columns is not None:
+        columns = list(columns) + [c for c in strata if c not in columns]
+    parts, offset = [], 0
+    for frame in _iter_months(source, columns):
+        codes = collapse_strata(frame, strata, fraction, min_per_stratum)
+        population = np.bincount(codes)
+        size = np.minimum(population, np.maximum(min_per_stratum, np.round(fraction * population))).astype('int64')
+        # Random order within each stratum; its first n_h rows are the sample
+        order = np.lexsort((rng.random(len(codes)), codes))
+        first = np.r_[0, np.cumsum(population)[:-1]]
+        rank = np.arange(len(order)) - first[codes[order]]
+        rows = np.sort(order[rank < size[codes[order]]])
+        part = frame.iloc[rows].reset_index(drop=True)
+        part['stratum'] = (codes[rows] + offset).astype('int64')
+        part['weight'] = population[codes[rows]] / size[codes[rows]]
+        parts.append(part)
+        offset += len(population)
+    return pd.concat(parts, ignore_index=True)
+
+
+def estimate_counts(sample, by=None, where=None, z=Z_95):
+    """Estimated trips per group of `by` (a column or list of columns; all trips with by=None) with a z-interval.
+
+    where is a boolean mask of the rows to count (a filter of the page). It is applied here rather than by the caller
+    because the stratum sizes n_h and N_h are those of the whole sample: a filtered domain is estimated with the 0/1
+    indicator of being in it. The estimate is the sum of the weights. Its variance is the stratified-sampling variance
+    of a total, sum over strata of N_h^2 (1 - n_h / N_h) s_h^2 / n_h, with s_h^2 the sample variance of the indicator.
+    With by=None there is always one row (zeros when nothing is selected).
+    """
+    stratum_rows = sample.groupby('stratum').size()
+    if where is not None:
+        sample = sample[np.asarray(where, dtype=bool)]
+    if by is None:
+        sample = sample.assign(_all='all')
+        by = '_all'
+    by = [by] if isinstance(by, str) else list(by)
+    cells = sample.groupby(by + ['stratum'], observed=True).agg(m=('weight', 'size'), weight=('weight', 'first'))
+    cells = cells.reset_index()
+    n = cells['stratum'].map(stratum_rows).to_numpy(dtype='float64')
+    N = n * cells['weight'].to_numpy()
+    p = cells['m'].to_numpy() / n
+    cells['estimate'] = cells['m'] * cells['weight']
+    cells['variance'] = N ** 2 * (1 - n / N) * np.divide(p * (1 - p), n - 1, out=np.zeros_like(p), where=n > 1)
+    out = cells.groupby(by, observed=True)[['estimate', 'variance']].sum()
+    se = np.sqrt(out.pop('variance'))
+    out['low'] = out['estimate'] - z * se
+    out['high'] = out['estimate'] + z * se
+    out = out.reset_index()
+    if by != ['_all']:
+        return out
+    return out.drop(columns='_all') if len(out) else pd.DataFrame({'estimate': [0.0], 'low': [0.0], 'high': [0.0]})
+
+
+def write_sample(body, out):
+    with open(out + '.tmp', 'wb') as f:
+        f.write(body)
+    os.replace(out + '.tmp', out)
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a random sample of the trips that fits a file-size budget, '
+                                                 'or a weighted stratified sample')
+    parser.add_argument('source', nargs='?', default=STORE_DIR, help='trip store directory or trip CSV')
+    parser.add_argument('out', nargs='?', default='reduced_data_to_plot.csv')
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--budget-mb', type=float, help='target size in MB (2**20 bytes)')
+    mode.add_argument('--fraction', type=float, help='stratified sample of this fraction of every stratum')
+    parser.add_argument('--format', choices=SAMPLE_FORMATS, help='default: from the extension of out')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed deviation as a share of the budget')
+    parser.add_argument('--strata', nargs='+', default=STRATA)
+    parser.add_argument('--min-per-stratum', type=int, default=MIN_PER_STRATUM,
+                        help='sample rows a stratum needs before sparse ones are pooled')
+    parser.add_argument('--columns', nargs='+', help='columns to keep (default: all)')
+    parser.add_argument('--seed', type=int, default=SEED)
+    args = parser.parse_args()
+    fmt = args.format or ('parquet' if args.out.endswith('.parquet') else 'csv')
+    if args.fraction is not None:
+        sample = stratified_sample(args.source, args.fraction, args.strata, args.columns, args.min_per_stratum,
+                                   args.seed)
+        write_sample(encode(sample, fmt), args.out)
+        trips = sample['weight'].sum()
+        print(f'Wrote {len(sample):,} rows ({len(sample) / max(trips, 1):.2%} of {trips:,.0f} trips, asked for '
+              f'{args.fraction:.2%}) from {sample["stratum"].nunique():,} strata to {args.out}')
+    else:
+        body, report = sample_to_size(args.source, int(args.budget_mb * 2 ** 20), fmt, args.tolerance, args.columns,
+                                      args.seed)
+        write_sample(body, args.out)
+        print(f'Wrote {report["rows"]:,} of {report["source_rows"]:,} rows ({report["fraction"]:.2%}) to {args.out}: '
+              f'{report["bytes"] / 2 ** 20:.2f} MB')
+        if not report['within_tolerance']:
+            print(f'Warning: {report["bytes"] / 2 ** 20:.2f} MB is not within {args.tolerance:.0%} of {args.budget_mb} MB')
@@ -0,0 +1,201 @@
+################################################ CITIBIKES STATION FLOWS #####################################################
+# Hourly net flow of every station, to find the stations that run empty or fill up.
+#
+# A station's net flow in an hour is its arrivals minus its departures (as in the station layer of map_layers.py):
+# a station with a negative net flow loses bikes and drains, one with a positive net flow fills up. The trips are
+# counted once per
+#
+#     station key x hour          (departures by started_at, arrivals by ended_at)
+#
+# with np.bincount over integer station and hour codes, and kept in station_flows.parquet, maintained per source file
+# by ingest.py. StationFlows holds the counts as dense stations x hours matrices (about 1,700 x 8,760 for a year), so
+# the cumulative imbalance of a station is a cumsum of its row and the rolling imbalance over a window of w hours the
+# difference of that cumsum w columns apart. The stations that drain and fill fastest are those with the lowest and
+# highest rolling imbalance.
+#
+#     python station_flows.py trip_store station_flows.parquet
+#
+#     flows = read_station_flows()
+#     drains, fills = flows.imbalance(window=6, k=10, start='2022-06-01', end='2022-08-31')
+#     history = flows.history('W 21 St & 6 Ave', window=6)
+
+import argparse
+import numpy as np
+import pandas as pd
+from trip_store import STORE_DIR, open_store, read_station_dim
+
+
+STATION_FLOWS_PATH = 'station_flows.parquet'
+
+# direction -> (station key column, time column, count column)
+FLOW_COLUMNS = {'start': ('start_station_key', 'started_at', 'departures'),
+                'end': ('end_station_key', 'ended_at', 'arrivals')}
+
+# Stations whose rolling imbalance is computed at once (bounds the memory of the window sums)
+STATION_BLOCK = 256
+
+# Rolling windows offered by the dashboard, in hours
+WINDOWS = [1, 3, 6, 12, 24, 72, 168]
+
+
+def hour_codes(times):
+    """Hours since 1970 of each timestamp (-1 where unknown)."""
+    times = pd.to_datetime(pd.Series(times))
+    codes = times.to_numpy(dtype='datetime64[h]').astype('int64')
+    return np.where(times.isna().to_numpy(), -1, codes)
+
+
+def _sum_cells(keys, hours, counts):
+    """Sum each count column per (key, hour) cell with one np.bincount over the cell codes. Returns a flow frame."""
+    used, hour_index = np.unique(hours, return_inverse=True)
+    n_keys = int(keys.max()) + 1 if len(keys) else 0
+    cells = hour_index * n_keys + keys
+    sums = {name: np.bincount(cells, weights=values, minlength=n_keys * len(used)) for name, values in counts.items()}
+    kept = np.flatnonzero(np.logical_or.reduce([s != 0 for s in sums.values()])) if sums else np.array([], 'int64')
+    flows = pd.DataFrame({'station_key': (kept % max(n_keys, 1)).astype('int32'),
+                          'time': used[kept // max(n_keys, 1)].astype('datetime64[h]').astype('datetime64[ns]')})
+    for name, values in sums.items():
+        flows[name] = values[kept].astype('int64')
+    return flows
+
+
+########################## Build ############################################################################################
+
+def station_hour_flows(trips):
+    """Departures and arrivals per station key and hour of one chunk of keyed trips. Mergeable by summing."""
+    keys, hours, counts = [], [], {'departures': [], 'arrivals': []}
+    for direction, (key_column, time_column, name) in FLOW_COLUMNS.items():
+        key, hour = trips[key_column].to_numpy(dtype='int64'), hour_codes(trips[time_column])
+        known = (key >= 0) & (hour >= 0)
+        keys.append(key[known])
+        hours.append(hour[known])
+        for column in counts:
+            counts[column].append(np.full(known.sum(), column == name, dtype='int64'))
+    return _sum_cells(np.concatenate(keys), np.concatenate(hours), {c: np.concatenate(v) for c, v in counts.items()})
+
+
+def merge_station_hour_flows(partials):
+    partials = [p for p in partials if len(p)]
+    if not partials:
+        return pd.DataFrame({'station_key': pd.Series(dtype='int32'), 'time': pd.Series(dtype='datetime64[ns]'),
+                             'departures': pd.Series(dtype='int64'), 'arrivals': pd.Series(dtype='int64')})
+    flows = pd.concat(partials, ignore_index=True)
+    return _sum_cells(flows['station_key'].to_numpy(dtype='int64'), hour_codes(flows['time']),
+                      {c: flows[c].to_numpy(dtype='int64') for c in ['departures', 'arrivals']})
+
+
+def build_station_hour_flows(root=STORE_DIR):
+    """The flows of an existing keyed trip store, one partition file at a time."""
+    dataset = open_store(root)
+    if 'start_station_key' not in dataset.schema.names or 'ended_at' not in dataset.schema.names:
+        raise ValueError(f'{root} has no station keys or trip end times; rebuild it with ingest.py')
+    columns = [c for direction in FLOW_COLUMNS.values() for c in direction[:2]]
+    return merge_station_hour_flows([station_hour_flows(fragment.to_table(columns=columns).to_pandas())
+                                     for fragment in dataset.get_fragments()])
+
+
+def write_station_flows(flows, path=STATION_FLOWS_PATH):
+    flows.to_parquet(path, index=False)
+    return path
+
+
+def read_station_flows(path=STATION_FLOWS_PATH, root=STORE_DIR):
+    return StationFlows.from_counts(pd.read_parquet(path), read_station_dim(root))
+
+
+########################## Flows ############################################################################################
+
+class StationFlows:
+    """Departures and arrivals of every station (rows, by station key) and hour (columns, from first_hour on)."""
+
+    def __init__(self, names, first_hour, departures, arrivals):
+        self.names = np.asarray(names, dtype=object)
+        self.first_hour = pd.Timestamp(first_hour)
+        self.departures = departures  # (stations, hours) int32
+        self.arrivals = arrivals
+        self.keys = {name: key for key, name in enumerate(self.names)}
+
+    @classmethod
+    def from_counts(cls, counts, dim):
+        """From station_hour_flows counts keyed by the station dimension."""
+        keys = counts['station_key'].to_numpy(dtype='int64')
+        hours = hour_codes(counts['time'])
+        first = int(hours.min()) if len(hours) else 0
+        shape = (max(len(dim), int(keys.max()) + 1 if len(keys) else 0),
+                 int(hours.max()) - first + 1 if len(hours) else 0)
+        matrices = []
+        for column in ['departures', 'arrivals']:
+            # One cell per row: the counts are merged
+            matrix = np.zeros(shape, dtype='int32')
+            matrix[keys, hours - first] = counts[column].to_numpy()
+            matrices.append(matrix)
+        names = list(dim['station_name'].astype(object)) + [f'station {k}' for k in range(len(dim), shape[0])]
+        return cls(names, np.datetime64(first, 'h'), *matrices)
+
+    @property
+    def hours(self):
+        return pd.date_range(self.first_hour, periods=self.departures.shape[1], freq=pd.Timedelta(hours=1))
+
+    def _columns(self, start=None, end=None):
+        # Hour columns of the days from start to end (inclusive)
+        first = 0 if start is None else (pd.Timestamp(start).normalize() - self.first_hour) // pd.Timedelta(hours=1)
+        last = self.departures.shape[1] if end is None else (
+            (pd.Timestamp(end).normalize() + pd.Timedelta(days=1) - self.first_hour) // pd.Timedelta(hours=1))
+        return slice(int(np.clip(first, 0, self.departures.shape[1])), int(np.clip(last, 0, self.departures.shape[1])))
+
+    def net(self, start=None, end=None):
+        """Arrivals - departures per station and hour of the date range."""
+        columns = self._columns(start, end)
+        return self.arrivals[:, columns].astype('int64') - self.departures[:, columns]
+
+    def history(self, station, window=24, start=None, end=None):
+        """One station's hourly departures, arrivals and net flow, its cumulative imbalance since start and the
+        rolling imbalance over the last window hours."""
+        key, columns = self.keys[station], self._columns(start, end)
+        departures, arrivals = self.departures[key, columns], self.arrivals[key, columns]
+        net = arrivals.astype('int64') - departures
+        cumulative = np.cumsum(net)
+        rolling = cumulative - np.concatenate([np.zeros(min(window, len(net)), 'int64'), cumulative[:-window]])
+        return pd.DataFrame({'time': self.hours[columns], 'departures': departures, 'arrivals': arrivals, 'net': net,
+                             'cumulative': cumulative, 'rolling_imbalance': rolling})
+
+    def imbalance(self, window=24, k=10, start=None, end=None):
+        """The k stations that drain fastest and the k that fill fastest over any window hours of the date range.
+
+        Each frame has the station, its lowest (drains) or highest (fills) rolling imbalance, the hour that window
+        ends and the station's departures and arrivals over the whole range.
+        """
+        columns = self._columns(start, end)
+        n_hours = columns.stop - columns.start
+        window = max(1, min(window, n_hours))
+        lowest, highest = np.zeros(len(self.names), 'int64'), np.zeros(len(self.names), 'int64')
+        lowest_at, highest_at = np.zeros(len(self.names), 'int64'), np.zeros(len(self.names), 'int64')
+        for block in range(0, len(self.names) if n_hours else 0, STATION_BLOCK):
+            rows = slice(block, block + STATION_BLOCK)
+            net = self.arrivals[rows, columns].astype('int64') - self.departures[rows, columns]
+            cumulative = np.concatenate([np.zeros((net.shape[0], 1), 'int64'), np.cumsum(net, axis=1)], axis=1)
+            rolling = cumulative[:, window:] - cumulative[:, :-window]
+            lowest_at[rows], highest_at[rows] = rolling.argmin(axis=1), rolling.argmax(axis=1)
+            lowest[rows] = np.take_along_axis(rolling, lowest_at[rows, None], axis=1)[:, 0]
+            highest[rows] = np.take_along_axis(rolling, highest_at[rows, None], axis=1)[:, 0]
+        departures = self.departures[:, columns].sum(axis=1, dtype='int64')
+        arrivals = self.arrivals[:, columns].sum(axis=1, dtype='int64')
+        window_end = self.hours[columns.start:columns.stop][window - 1:] if n_hours else pd.DatetimeIndex([])
+
+        def ranked(values, at, order):
+            best = np.flatnonzero(order * values > 0)
+            best = best[np.lexsort((best, -order * values[best]))][:k]
+            return pd.DataFrame({'station_name': self.names[best], 'imbalance': values[best],
+                                 'window_end': window_end[at[best]], 'departures': departures[best],
+                                 'arrivals': arrivals[best]})
+        return ranked(lowest, lowest_at, -1), ranked(highest, highest_at, 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Count departures and arrivals per station and hour')
+    parser.add_argument('store', nargs='?', default=STORE_DIR, help='keyed trip store (built by ingest.py)')
+    parser.add_argument('out', nargs='?', default=STATION_FLOWS_PATH)
+    args = parser.parse_args()
+    flows = build_station_hour_flows(args.store)
+    write_station_flows(flows, args.out)
+    print(f'Wrote {len(flows):,} station x hour flows to {args.out}')
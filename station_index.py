@@ -0,0 +1,174 @@
+################################################ CITIBIKES STATION INDEX #####################################################
+# Radius, viewport and nearest-station queries over the station dimension, answered on the server.
+#
+# In 2.5 the station coordinates are only columns joined onto the trips, and every spatial question is left to kepler
+# in the browser or answered by comparing the lat/lng of every trip row. Here the stations of the station dimension
+# (trip_store/_station_dim.parquet) are projected once to metres and put into a uniform grid: the stations are sorted
+# by grid cell, so the stations of a row of cells are one slice of the sorted arrays. A query only measures the
+# stations of the cells it overlaps.
+#
+# The projection is UTM zone 18N (the zone of New York) when pyproj is installed, as imported in 2.5, and otherwise
+# an equirectangular projection around the stations' mean latitude, which is within a fraction of a percent over the
+# few kilometres of a query.
+#
+# The queries return station keys, which filter trips, rankings and map layers without touching a coordinate:
+#
+#     index = read_station_index('trip_store')
+#     index.within(40.7411, -73.9897, 500)              (stations within 500 m, nearest first)
+#     index.in_bbox(40.70, -74.02, 40.75, -73.97)       (stations in the viewport south, west, north, east)
+#     index.nearest(40.7411, -73.9897, k=5)
+#     index.near_station('W 21 St & 6 Ave', 1000)
+#     index.keys_within(40.7411, -73.9897, 500)          (only the keys, about 0.1 ms)
+#
+#     python station_index.py trip_store 40.7411 -73.9897 --radius 500
+
+import argparse
+import numpy as np
+import pandas as pd
+from trip_store import STORE_DIR, read_station_dim
+try:
+    from pyproj import Transformer
+except ImportError:  # optional: the equirectangular projection is used instead
+    Transformer = None
+
+
+UTM_CRS = 'EPSG:32618'  # WGS 84 / UTM zone 18N
+EARTH_RADIUS = 6_371_008.8  # metres
+
+# Side of a grid cell in metres (Citi Bike docks are a few hundred metres apart)
+CELL_SIZE = 250
+
+RESULT_COLUMNS = ['station_key', 'station_name', 'lat', 'lng', 'distance']
+
+
+class Projection:
+    """lat/lng to x/y in metres."""
+
+    def __init__(self, lat0):
+        self.lat0 = lat0
+        self._utm = Transformer.from_crs('EPSG:4326', UTM_CRS, always_xy=True) if Transformer is not None else None
+
+    def __call__(self, lat, lng):
+        lat, lng = np.asarray(lat, dtype='float64'), np.asarray(lng, dtype='float64')
+        if self._utm is not None:
+            return self._utm.transform(lng, lat)
+        x = EARTH_RADIUS * np.radians(lng) * np.cos(np.radians(self.lat0))
+        return x, EARTH_RADIUS * np.radians(lat)
+
+
+class StationIndex:
+    """Uniform grid over the projected stations of a station dimension (stations without coordinates are left out)."""
+
+    def __init__(self, dim, cell_size=CELL_SIZE):
+        dim = dim.dropna(subset=['lat', 'lng'])
+        self.cell_size = cell_size
+        self.project = Projection(float(dim['lat'].mean()) if len(dim) else 0.0)
+        x, y = self.project(dim['lat'].to_numpy(), dim['lng'].to_numpy())
+        self.x0, self.y0 = (float(x.min()), float(y.min())) if len(dim) else (0.0, 0.0)
+        ix, iy = self._cell(x, y)
+        self.nx = int(ix.max()) + 1 if len(dim) else 1
+        self.ny = int(iy.max()) + 1 if len(dim) else 1
+        # Stations sorted by cell; starts[c]:starts[c + 1] are the stations of cell c
+        cells = iy * self.nx + ix
+        order = np.argsort(cells, kind='stable')
+        self.starts = np.searchsorted(cells[order], np.arange(self.nx * self.ny + 1))
+        self.x, self.y = np.asarray(x)[order], np.asarray(y)[order]
+        self.keys = dim['station_key'].to_numpy(dtype='int64')[order]
+        self.names = dim['station_name'].astype(object).to_numpy()[order]
+        self.lat = dim['lat'].to_numpy(dtype='float64')[order]
+        self.lng = dim['lng'].to_numpy(dtype='float64')[order]
+        self.positions = dict(zip(self.names, range(len(self.names))))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _cell(self, x, y):
+        return (np.floor((np.asarray(x) - self.x0) / self.cell_size).astype('int64'),
+                np.floor((np.asarray(y) - self.y0) / self.cell_size).astype('int64'))
+
+    def _candidates(self, xmin, ymin, xmax, ymax):
+        # Positions of the stations in the cells overlapping the rectangle: one slice per row of cells
+        (ix0, ix1), (iy0, iy1) = [np.clip(c, 0, n - 1) for c, n in
+                                  zip(self._cell([xmin, xmax], [ymin, ymax]), (self.nx, self.ny))]
+        rows = np.arange(iy0, iy1 + 1) * self.nx
+        slices = [np.arange(self.starts[row + ix0], self.starts[row + ix1 + 1]) for row in rows]
+        return np.concatenate(slices) if slices else np.array([], dtype='int64')
+
+    def _result(self, positions, distance):
+        order = np.lexsort((self.keys[positions], distance))
+        positions, distance = positions[order], distance[order]
+        return pd.DataFrame({'station_key': self.keys[positions].astype('int32'), 'station_name': self.names[positions],
+                             'lat': self.lat[positions], 'lng': self.lng[positions], 'distance': distance},
+                            columns=RESULT_COLUMNS)
+
+    def _distances(self, positions, x, y):
+        return np.hypot(self.x[positions] - x, self.y[positions] - y)
+
+    def _within(self, lat, lng, radius):
+        x, y = self.project(lat, lng)
+        if not len(self):
+            return np.array([], 'int64'), np.array([])
+        positions = self._candidates(x - radius, y - radius, x + radius, y + radius)
+        distance = self._distances(positions, x, y)
+        keep = distance <= radius
+        return positions[keep], distance[keep]
+
+    def within(self, lat, lng, radius):
+        """Stations within radius metres of a point, nearest first, with their distance in metres."""
+        return self._result(*self._within(lat, lng, radius))
+
+    def keys_within(self, lat, lng, radius):
+        """Only the station keys of within, unordered (what a filter needs, without building a frame)."""
+        return self.keys[self._within(lat, lng, radius)[0]]
+
+    def in_bbox(self, south, west, north, east):
+        """Stations inside a lat/lng viewport, with their distance in metres from its centre."""
+        xs, ys = self.project([south, south, north, north], [west, east, west, east])
+        if not len(self):
+            return self._result(np.array([], 'int64'), np.array([]))
+        positions = self._candidates(np.min(xs), np.min(ys), np.max(xs), np.max(ys))
+        keep = ((self.lat[positions] >= south) & (self.lat[positions] <= north) &
+                (self.lng[positions] >= west) & (self.lng[positions] <= east))
+        x, y = self.project((south + north) / 2, (west + east) / 2)
+        return self._result(positions[keep], self._distances(positions[keep], x, y))
+
+    def nearest(self, lat, lng, k=5):
+        """The k stations nearest to a point, nearest first."""
+        x, y = self.project(lat, lng)
+        k = min(k, len(self))
+        radius = self.cell_size
+        while k:
+            # Every station within radius is found, so the k nearest are final once k of them are within it
+            positions = self._candidates(x - radius, y - radius, x + radius, y + radius)
+            distance = self._distances(positions, x, y)
+            if (distance <= radius).sum() >= k or len(positions) == len(self):
+                best = np.argsort(distance, kind='stable')[:k]
+                return self._result(positions[best], distance[best])
+            radius *= 2
+        return self._result(np.array([], 'int64'), np.array([]))
+
+    def location(self, station):
+        """lat, lng of a station name."""
+        position = self.positions[station]
+        return self.lat[position], self.lng[position]
+
+    def near_station(self, station, radius):
+        """Stations within radius metres of a station (itself included, at distance 0)."""
+        return self.within(*self.location(station), radius)
+
+
+def read_station_index(root=STORE_DIR, cell_size=CELL_SIZE):
+    return StationIndex(read_station_dim(root), cell_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the stations near a point')
+    parser.add_argument('store', help='keyed trip store (built by ingest.py)')
+    parser.add_argument('lat', type=float)
+    parser.add_argument('lng', type=float)
+    parser.add_argument('--radius', type=float, help='metres (default: the --k nearest stations)')
+    parser.add_argument('--k', type=int, default=5)
+    args = parser.parse_args()
+    index = read_station_index(args.store)
+    found = index.within(args.lat, args.lng, args.radius) if args.radius else index.nearest(args.lat, args.lng, args.k)
+    print(found.to_string(index=False))
@@ -0,0 +1,142 @@
+################################################ CITIBIKES STATION RANKINGS #####################################################
+# Per-season trip counts of every station, for the 'Most popular stations' page.
+#
+# The page used to filter the trips to the selected seasons and group them by start station on every click. Here the
+# trips are counted once into one vector per season and direction (trips starting / ending at each station), kept in
+# station_rankings.parquet and maintained per source file by ingest.py. Any season selection is then the sum of at
+# most four vectors, and its top k stations a partial sort (np.argpartition) of that sum.
+#
+#     python station_rankings.py trip_store station_rankings.parquet
+#
+#     rankings = read_station_rankings()
+#     total, top = rankings.top(['summer', 'fall'], k=20, direction='end')
+
+import argparse
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from trip_store import STORE_DIR, SEASONS, open_store, read_station_dim
+
+
+STATION_RANKINGS_PATH = 'station_rankings.parquet'
+
+DIRECTIONS = ['start', 'end']
+
+
+########################## Build ############################################################################################
+
+def station_season_counts(trips):
+    """Trips starting and ending at each station key per season, of one chunk of keyed trips (key -1: no station)."""
+    counts = []
+    for direction in DIRECTIONS:
+        keys = pd.DataFrame({'station_key': trips[f'{direction}_station_key'].to_numpy(),
+                             'season': trips['season'].astype(object).to_numpy()})
+        counts.append(keys.groupby(['station_key', 'season']).size().rename(f'{direction}s'))
+    return pd.concat(counts, axis=1).fillna(0).astype('int64').reset_index()
+
+
+def merge_station_season_counts(partials):
+    partials = [p for p in partials if len(p)]
+    if not partials:
+        return pd.DataFrame({'station_key': pd.Series(dtype='int32'), 'season': pd.Series(dtype=object),
+                             'starts': pd.Series(dtype='int64'), 'ends': pd.Series(dtype='int64')})
+    counts = pd.concat([p.astype({'season': object}) for p in partials], ignore_index=True)
+    counts = counts.groupby(['station_key', 'season'])[['starts', 'ends']].sum().reset_index()
+    return counts.astype({'station_key': 'int32', 'starts': 'int64', 'ends': 'int64'})
+
+
+def build_station_season_counts(root=STORE_DIR):
+    """The counts of an existing keyed trip store, one partition file at a time."""
+    columns = ['start_station_key', 'end_station_key', 'season']
+    return merge_station_season_counts([station_season_counts(fragment.to_table(columns=columns).to_pandas())
+                                        for fragment in open_store(root).get_fragments()])
+
+
+def write_station_rankings(counts, path=STATION_RANKINGS_PATH):
+    counts.to_parquet(path, index=False)
+    return path
+
+
+def read_station_rankings(path=STATION_RANKINGS_PATH, root=STORE_DIR):
+    return StationRankings.from_counts(pd.read_parquet(path), read_station_dim(root))
+
+
+########################## Rankings #########################################################################################
+
+class StationRankings:
+    """Trips per season (rows, in SEASONS order) and station (columns), for trips starting and ending there."""
+
+    def __init__(self, names, vectors, unknown):
+        self.names = np.asarray(names, dtype=object)
+        self.name_ranks = np.argsort(np.argsort(self.names.astype(str), kind='stable'), kind='stable')
+        self.vectors = vectors  # direction -> (len(SEASONS), stations) int64
+        self.unknown = unknown  # direction -> trips per season without a station
+
+    @classmethod
+    def from_counts(cls, counts, dim):
+        """From station_season_counts keyed by the station dimension."""
+        keys = counts['station_key'].to_numpy(dtype='int64')
+        seasons = pd.Categorical(counts['season'], categories=SEASONS).codes.astype('int64')
+        known, valid = keys >= 0, seasons >= 0
+        vectors, unknown = {}, {}
+        for direction in DIRECTIONS:
+            trips = counts[f'{direction}s'].to_numpy(dtype='int64')
+            vector = np.zeros((len(SEASONS), len(dim)), dtype='int64')
+            np.add.at(vector, (seasons[known & valid], keys[known & valid]), trips[known & valid])
+            vectors[direction] = vector
+            unknown[direction] = np.bincount(seasons[~known & valid], weights=trips[~known & valid],
+                                             minlength=len(SEASONS)).astype('int64')
+        return cls(dim['station_name'].astype(object).to_numpy(), vectors, unknown)
+
+    @classmethod
+    def from_trips(cls, trips):
+        """From trip rows with season and start/end_station_name (the CSV and name-only stores)."""
+        columns = [f'{d}_station_name' for d in DIRECTIONS]
+        categoricals = [pd.Categorical(trips[c]) for c in columns]
+        names = union_categoricals(categoricals, ignore_order=True).categories
+        seasons = pd.Categorical(trips['season'], categories=SEASONS).codes.astype('int64')
+        vectors, unknown = {}, {}
+        for direction, values in zip(DIRECTIONS, categoricals):
+            # Map each column's own category codes onto the shared station list
+            codes = np.append(names.get_indexer(values.categories), -1)[values.codes]
+            known, valid = codes >= 0, seasons >= 0
+            cells = np.bincount(seasons[known & valid] * len(names) + codes[known & valid],
+                                minlength=len(SEASONS) * len(names))
+            vectors[direction] = cells.reshape(len(SEASONS), len(names)).astype('int64')
+            unknown[direction] = np.bincount(seasons[~known & valid], minlength=len(SEASONS)).astype('int64')
+        return cls(names.astype(object), vectors, unknown)
+
+    def counts(self, seasons=None, direction='start'):
+        """Trips per station over the selected seasons (None: all), and the total including trips without a station."""
+        rows = [SEASONS.index(s) for s in seasons] if seasons is not None else list(range(len(SEASONS)))
+        totals = self.vectors[direction][rows].sum(axis=0)
+        return totals, float(totals.sum() + self.unknown[direction][rows].sum())
+
+    def top(self, seasons=None, k=20, direction='start', stations=None):
+        """Total trips and the k busiest start (or end) stations for the selected seasons.
+
+        With station names (e.g. those of an area, see station_index.py) only their trips are counted.
+        """
+        totals, total = self.counts(seasons, direction)
+        if stations is not None:
+            totals = np.where(np.isin(self.names, list(stations)), totals, 0)
+            total = float(totals.sum())
+        best = np.flatnonzero(totals)
+        if len(best) > k:
+            # Ties at the cut go to the stations first by name, as in the DuckDB backend
+            cut = np.partition(totals[best], -k)[-k]
+            above, tied = best[totals[best] > cut], best[totals[best] == cut]
+            tied = tied[np.argsort(self.name_ranks[tied])]
+            best = np.concatenate([above, tied[:k - len(above)]])
+        best = best[np.lexsort((self.name_ranks[best], -totals[best]))]
+        return total, pd.DataFrame({f'{direction}_station_name': self.names[best], 'value': totals[best]})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Count trips per station and season for the station rankings')
+    parser.add_argument('store', nargs='?', default=STORE_DIR, help='keyed trip store (built by ingest.py)')
+    parser.add_argument('out', nargs='?', default=STATION_RANKINGS_PATH)
+    args = parser.parse_args()
+    counts = build_station_season_counts(args.store)
+    write_station_rankings(counts, args.out)
+    print(f'Wrote {len(counts):,} station x season counts to {args.out}')
@@ -0,0 +1,206 @@
+################################################ CITIBIKES STATIONS #####################################################
+# Station dimension, station locations and the route table behind the kepler map.
+#
+# Replaces the per-station loops of 2.5 (an .iloc lookup, a membership test and a mask over the whole station frame
+# for every station, followed by a pd.concat of thousands of small frames). One canonical lat/lng is computed for
+# every station in a single grouped pass over all start and end observations, and the coordinates are attached to
+# the route table with hash joins.
+#
+# Every station gets a stable integer key in the station dimension (trip_store/_station_dim.parquet, see
+# trip_store.py). Trips, the cube and the route table are stored with those keys; names are only looked up for
+# what is finally shown or exported.
+#
+#     python stations.py trip_store routes.parquet                  (integer keys)
+#     python stations.py trip_store df_final_locations_for_map.csv  (station names, for kepler)
+
+import os
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from trip_store import (STORE_DIR, STATION_KEYS, STATION_DIM_COLUMNS, read_trips, open_store, read_station_dim,
+                        write_station_dim, decode_station_keys)
+
+
+ROUTE_COLUMNS = ['start_station_name', 'end_station_name', 'start_lat', 'start_lng', 'end_lat', 'end_lng']
+KEYED_ROUTE_COLUMNS = ['start_station_key', 'end_station_key', 'end_lat', 'end_lng']
+
+# Grid used by the 'mode' resolver (about 1 m). Docked bikes report the dock's exact coordinates, so the most frequent
+# grid cell is the dock itself while the scattered e-bike GPS fixes rarely share a cell.
+MODE_DECIMALS = 5
+
+
+########################## Station keys #####################################################################################
+
+class StationKeys:
+    """Station name -> key registry. New names get the next free key; existing keys never change.
+
+    mapping and lock can be multiprocessing.Manager proxies, so that ingestion workers share one registry.
+    """
+
+    def __init__(self, mapping=None, lock=None):
+        self.mapping = {} if mapping is None else mapping
+        self.lock = threading.Lock() if lock is None else lock
+
+    @classmethod
+    def from_dim(cls, dim, mapping=None, lock=None):
+        keys = cls({} if mapping is None else mapping, lock)
+        keys.mapping.update(dict(zip(dim['station_name'].astype(object), dim['station_key'].astype(int))))
+        return keys
+
+    def keys_for(self, names):
+        """Keys of the given (distinct) names as an int32 array, registering unseen names."""
+        known = dict(self.mapping) if len(names) else {}
+        missing = [n for n in names if n not in known]
+        if missing:
+            with self.lock:
+                for name in missing:
+                    key = self.mapping.get(name)
+                    if key is None:
+                        key = len(self.mapping)
+                        self.mapping[name] = key
+                    known[name] = key
+        return np.array([known[n] for n in names], dtype='int32')
+
+
+def encode_stations(df, station_keys):
+    """Replace start/end_station_name with int32 start/end_station_key (returns a new frame)."""
+    out = df.copy(deep=False)
+    for name_col, key_col in STATION_KEYS.items():
+        if name_col not in out.columns:
+            continue
+        names = out[name_col].astype('category')
+        # One registry lookup per distinct name, then a vectorized take over the category codes
+        category_keys = np.append(station_keys.keys_for(list(names.cat.categories)), np.int32(-1))
+        keys = category_keys[names.cat.codes.to_numpy()]
+        position = out.columns.get_loc(name_col)
+        out = out.drop(columns=name_col)
+        out.insert(position, key_col, keys)
+    return out
+
+
+########################## Locations ########################################################################################
+
+def _observations(trips, id_columns=('start_station_name', 'end_station_name')):
+    # Every trip gives one observation of its start station and one of its end station
+    names = ['station', 'lat', 'lng']
+    start_id, end_id = id_columns
+    starts = trips[[start_id, 'start_lat', 'start_lng']].set_axis(names, axis=1)
+    ends = trips[[end_id, 'end_lat', 'end_lng']].set_axis(names, axis=1)
+    obs = pd.concat([starts, ends], ignore_index=True)
+    if isinstance(obs['station'].dtype, pd.CategoricalDtype):
+        obs['station'] = obs['station'].astype(object)
+    return obs.dropna()
+
+
+def _coordinate_counts(obs):
+    obs = obs.assign(lat=obs['lat'].round(MODE_DECIMALS), lng=obs['lng'].round(MODE_DECIMALS))
+    return obs.groupby(['station', 'lat', 'lng']).size().reset_index(name='n')
+
+
+def _mode(counts):
+    counts = counts.sort_values(['station', 'n'], ascending=[True, False])
+    return counts.drop_duplicates('station')[['station', 'lat', 'lng']].reset_index(drop=True)
+
+
+def station_locations(trips, how='median'):
+    """One lat/lng per station name. 'median' or 'mode' keep e-bike GPS jitter from moving a station."""
+    obs = _observations(trips)
+    if how == 'median':
+        locations = obs.groupby('station')[['lat', 'lng']].median().reset_index()
+    elif how == 'mode':
+        locations = _mode(_coordinate_counts(obs))
+    else:
+        raise ValueError(f"how must be 'median' or 'mode', not {how!r}")
+    return locations.rename(columns={'station': 'station_name'})
+
+
+def coordinate_counts(trips):
+    """How often each station key was seen at each ~1 m grid cell. Mergeable across chunks by summing n."""
+    obs = _observations(trips, ('start_station_key', 'end_station_key'))
+    return _coordinate_counts(obs[obs['station'] >= 0])
+
+
+def merge_coordinate_counts(partials):
+    partials = [p for p in partials if len(p)]
+    if not partials:
+        return pd.DataFrame({'station': pd.Series(dtype='int32'), 'lat': pd.Series(dtype='float64'),
+                             'lng': pd.Series(dtype='float64'), 'n': pd.Series(dtype='int64')})
+    counts = pd.concat(partials, ignore_index=True).groupby(['station', 'lat', 'lng'])['n'].sum().reset_index()
+    counts['station'] = counts['station'].astype('int32')
+    return counts
+
+
+def build_station_dim(station_keys, counts):
+    """The dimension table: every registered key with its name and the mode of its observed coordinates."""
+    mapping = dict(station_keys.mapping)
+    dim = pd.DataFrame({'station_key': np.fromiter(mapping.values(), dtype='int32', count=len(mapping)),
+                        'station_name': list(mapping.keys())})
+    locations = _mode(counts).rename(columns={'station': 'station_key'})
+    dim = dim.merge(locations, on='station_key', how='left')
+    return dim.sort_values('station_key').reset_index(drop=True)[STATION_DIM_COLUMNS]
+
+
+def update_station_dim(station_keys, counts, root=STORE_DIR):
+    dim = build_station_dim(station_keys, counts)
+    write_station_dim(dim, root)
+    return dim
+
+
+########################## Routes ###########################################################################################
+
+def attach_coordinates(routes, locations, id_name='station_name'):
+    """Add start_lat/start_lng/end_lat/end_lng to a route table keyed by start_<id>/end_<id>."""
+    coords = locations.set_index(id_name)[['lat', 'lng']]
+    out = routes.merge(coords.add_prefix('start_'), left_on=f'start_{id_name}', right_index=True, how='left')
+    return out.merge(coords.add_prefix('end_'), left_on=f'end_{id_name}', right_index=True, how='left')
+
+
+def route_table(trips):
+    """Trips per (start station, end station), as in 2.5. Keyed by station keys when the trips carry them."""
+    if 'start_station_key' in trips.columns:
+        ends = ['start_station_key', 'end_station_key']
+        trips = trips[(trips['start_station_key'] >= 0) & (trips['end_station_key'] >= 0)]
+    else:
+        ends = ['start_station_name', 'end_station_name']
+        trips = trips.dropna(subset=ends)
+    trips = trips.dropna(subset=[c for c in ['end_lat', 'end_lng'] if c in trips.columns])
+    routes = trips.groupby(ends, observed=True).size()
+    return routes.reset_index(name='trips')
+
+
+def map_routes(trips, how='median'):
+    """The 2.5 map table: trips per route with the coordinates of both ends."""
+    return attach_coordinates(route_table(trips), station_locations(trips, how))
+
+
+def keyed_map_routes(root=STORE_DIR):
+    """Route table of a keyed trip store, with coordinates taken from the station dimension."""
+    routes = route_table(read_trips(root, columns=KEYED_ROUTE_COLUMNS))
+    return attach_coordinates(routes, read_station_dim(root), id_name='station_key')
+
+
+def store_has_keys(root=STORE_DIR):
+    return 'start_station_key' in open_store(root).schema.names
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the route table with station coordinates for the kepler map')
+    parser.add_argument('source', nargs='?', default=STORE_DIR, help='trip store directory or trip CSV')
+    parser.add_argument('out', nargs='?', default='df_final_locations_for_map.csv',
+                        help='.parquet keeps integer station keys, .csv resolves the station names')
+    parser.add_argument('--how', choices=['median', 'mode'], default='median')
+    args = parser.parse_args()
+    if os.path.isdir(args.source) and store_has_keys(args.source):
+        routes = keyed_map_routes(args.source)
+        if not args.out.endswith('.parquet'):
+            routes = decode_station_keys(routes, read_station_dim(args.source))
+    elif os.path.isdir(args.source):
+        routes = map_routes(read_trips(args.source, columns=ROUTE_COLUMNS), args.how)
+    else:
+        routes = map_routes(pd.read_csv(args.source, usecols=ROUTE_COLUMNS), args.how)
+    if args.out.endswith('.parquet'):
+        routes.to_parquet(args.out, index=False)
+    else:
+        routes.to_csv(args.out)
+    print(f'Wrote {len(routes):,} routes to {args.out}')
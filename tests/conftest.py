@@ -0,0 +1,89 @@
+import os
+import sys
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from trip_store import SEASON_BY_MONTH  # noqa: E402
+
+
+DASHBOARD = os.path.join(ROOT, 'cb_dashboard_2.py')
+
+# The pages of the sidebar menu that only need the data files (Recommendations shows business_pic.JPG)
+DATA_PAGES = ['Intro page', 'Weather and Bike Usage', 'Most popular stations',
+              'Interactive map with aggregated bike trips', 'Classic versus Electric Bikes', 'Trip durations',
+              'Station imbalance']
+
+STATIONS = pd.DataFrame({'name': ['W 21 St & 6 Ave', 'West St & Chambers St', 'Broadway & W 58 St',
+                                  'E 2 St & 10 Ave', '7 Ave & Central Park South', 'Soissons Landing'],
+                         'lat': [40.7417, 40.7175, 40.7668, 40.7281, 40.7667, 40.6924],
+                         'lng': [-73.9942, -74.0131, -73.9818, -73.9867, -73.9790, -74.0140]})
+
+
+def notebook_trips(rows=3000, seed=0):
+    """Trips in the layout of the 2.6 notebook export: derived date / season and the broadcast trip_count / avgTemp."""
+    rng = np.random.default_rng(seed)
+    seconds = np.sort(rng.integers(0, 365 * 24 * 3600, rows))
+    started = pd.Timestamp('2022-01-01') + pd.to_timedelta(seconds, unit='s')
+    ended = started + pd.to_timedelta(rng.integers(120, 3600, rows), unit='s')
+    start, end = rng.integers(0, len(STATIONS), rows), rng.integers(0, len(STATIONS), rows)
+    # 2.6 merges the daily values on date, which becomes the first column
+    trips = pd.DataFrame({
+        'date': started.strftime('%Y-%m-%d'), 'ride_id': [f'{seed:04d}{i:012X}' for i in range(rows)],
+        'rideable_type': rng.choice(['classic_bike', 'electric_bike'], rows),
+        'started_at': started.strftime('%Y-%m-%d %H:%M:%S'), 'ended_at': ended.strftime('%Y-%m-%d %H:%M:%S'),
+        'season': SEASON_BY_MONTH[started.month],
+        'start_station_name': STATIONS['name'].to_numpy()[start], 'end_station_name': STATIONS['name'].to_numpy()[end],
+        'member_casual': rng.choice(['member', 'casual'], rows),
+        'start_lat': STATIONS['lat'].to_numpy()[start], 'start_lng': STATIONS['lng'].to_numpy()[start],
+        'end_lat': STATIONS['lat'].to_numpy()[end], 'end_lng': STATIONS['lng'].to_numpy()[end]})
+    trips['trip_count'] = trips.groupby('date')['date'].transform('size')
+    trips['avgTemp'] = 10 + 10 * np.sin((started.dayofyear.to_numpy() - 100) / 365 * 2 * np.pi)
+    return trips
+
+
+def write_notebook_csv(path, rows=3000, seed=0, index=False):
+    # As 2.6 writes it (to_csv(..., index=False)); with index=True the unnamed index is the first column
+    notebook_trips(rows, seed).to_csv(path, index=index)
+    return path
+
+
+def tripdata_csvs(folder, rows_per_month=400, months=(1, 2, 3), seed=0):
+    """Monthly raw tripdata exports (YYYYMM-citibike-tripdata.csv) as ingest.py reads them."""
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for month in months:
+        trips = notebook_trips(rows_per_month * 12, seed + month)
+        trips = trips[pd.to_datetime(trips['started_at']).dt.month == month]
+        trips = trips.drop(columns=['date', 'season', 'trip_count', 'avgTemp'])
+        path = os.path.join(folder, f'2022{month:02d}-citibike-tripdata.csv')
+        trips.to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def deployment(tmp_path, monkeypatch):
+    """An empty dashboard folder (with the intro image) as the working directory."""
+    shutil.copy(os.path.join(ROOT, 'CitiBike.jpg'), tmp_path / 'CitiBike.jpg')
+    monkeypatch.chdir(tmp_path)
+    for name in ['MAP_ASSETS_URL', 'QUERY_BACKEND', 'DASHBOARD_TRACE_LOG', 'DASHBOARD_DEBUG']:
+        monkeypatch.delenv(name, raising=False)
+    return tmp_path
+
+
+def render_pages(pages=DATA_PAGES):
+    """Open the dashboard in the working directory and visit every page. Returns {page: [exception and error
+    messages]}."""
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(DASHBOARD, default_timeout=60)
+    at.run()
+    errors = {}
+    for page in pages:
+        at.sidebar.selectbox[0].select(page).run()
+        errors[page] = [e.value for e in at.exception] + [e.value for e in at.error]
+    return errors
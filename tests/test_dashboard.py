@@ -0,0 +1,83 @@
+import os
+import re
+import copy
+import json
+import shutil
+import subprocess
+import sys
+import pytest
+from conftest import ROOT, DASHBOARD, DATA_PAGES, render_pages, write_notebook_csv, tripdata_csvs
+
+
+def run_script(*args):
+    subprocess.run([sys.executable, os.path.join(ROOT, args[0]), *args[1:]], check=True, capture_output=True)
+
+
+def test_pages_with_only_the_notebook_csv(deployment):
+    write_notebook_csv('reduced_data_to_plot.csv')
+    assert render_pages() == {page: [] for page in DATA_PAGES}
+
+
+def test_pages_with_daily_facts_and_no_cube(deployment):
+    # The documented conversion of the old CSV, without building the trip cube
+    write_notebook_csv('reduced_data_to_plot.csv')
+    run_script('daily_facts.py', '--trips', 'reduced_data_to_plot.csv')
+    assert os.path.exists('daily_facts.parquet') and not os.path.exists('trip_cube.parquet')
+    assert render_pages() == {page: [] for page in DATA_PAGES}
+
+
+def test_pages_of_an_ingested_deployment(deployment):
+    # The trip store and every aggregate ingest.py merges
+    tripdata_csvs('tripdata', months=(1, 4, 7, 10))
+    run_script('ingest.py', 'tripdata', '--workers', '2')
+    for path in ['trip_cube.parquet', 'daily_facts.parquet', 'map_layers.parquet', 'station_rankings.parquet',
+                 'station_flows.parquet', 'duration_sketches.parquet']:
+        assert os.path.exists(path), path
+    assert render_pages() == {page: [] for page in DATA_PAGES}
+
+
+def test_pages_of_a_store_queried_by_duckdb(deployment, monkeypatch):
+    pytest.importorskip('duckdb')
+    write_notebook_csv('notebook.csv')
+    run_script('trip_store.py', 'notebook.csv')
+    monkeypatch.setenv('QUERY_BACKEND', 'duckdb')
+    assert render_pages() == {page: [] for page in DATA_PAGES}
+
+
+def test_pages_of_a_stratified_sample(deployment):
+    write_notebook_csv('notebook.csv')
+    run_script('trip_store.py', 'notebook.csv')
+    run_script('sampling.py', 'trip_store', 'reduced_data_to_plot.csv', '--fraction', '0.2')
+    shutil.rmtree('trip_store')
+    assert render_pages() == {page: [] for page in DATA_PAGES}
+
+
+def map_page(server_address, monkeypatch):
+    """The map page's iframe sources and notices, with built (empty) map assets and the given browser.serverAddress."""
+    from streamlit import config
+    from streamlit.testing.v1 import AppTest
+    write_notebook_csv('reduced_data_to_plot.csv')
+    os.makedirs('map_assets', exist_ok=True)
+    with open(os.path.join('map_assets', 'manifest.json'), 'w') as f:
+        json.dump({}, f)
+    monkeypatch.setattr(config, '_config_options', copy.deepcopy(config.get_config_options()))
+    config.set_option('browser.serverAddress', server_address)
+    at = AppTest.from_file(DASHBOARD, default_timeout=60)
+    at.run()
+    at.sidebar.selectbox[0].select('Interactive map with aggregated bike trips').run()
+    return [e.proto.src for e in at.get('iframe')], [e.value for e in at.info]
+
+
+def test_map_assets_on_the_local_browser_address(deployment, monkeypatch):
+    monkeypatch.delenv('MAP_ASSETS_HOST', raising=False)
+    frames, notices = map_page('localhost', monkeypatch)
+    assert len(frames) == 1 and re.fullmatch(r'http://localhost:\d+/index.html', frames[0]) and not notices
+
+
+def test_map_assets_only_shared_when_opted_in(deployment, monkeypatch):
+    monkeypatch.delenv('MAP_ASSETS_HOST', raising=False)
+    frames, notices = map_page('dash.example.org', monkeypatch)
+    assert frames == [] and 'MAP_ASSETS_URL' in notices[0]
+    monkeypatch.setenv('MAP_ASSETS_HOST', '0.0.0.0')
+    frames, notices = map_page('dash.example.org', monkeypatch)
+    assert len(frames) == 1 and frames[0].startswith('http://dash.example.org:')
@@ -0,0 +1,75 @@
+import os
+import pandas as pd
+import pytest
+from conftest import tripdata_csvs
+from ingest import ingest_folder, read_manifest, pending_files, list_tripdata_files, merge_aggregate
+from trip_cube import build_cube
+from trip_store import read_trips, partition_months
+
+
+def sorted_cube(cube):
+    keys = [c for c in cube.columns if c != 'trip_count']
+    cube = cube.assign(**{c: cube[c].astype(str) for c in keys})
+    return cube.sort_values(keys, ignore_index=True)
+
+
+def csv_rows(paths):
+    return sum(len(pd.read_csv(p)) for p in paths)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return str(tmp_path / 'trip_store')
+
+
+def test_only_new_files_are_ingested(tmp_path, store):
+    folder = tmp_path / 'tripdata'
+    first = tripdata_csvs(folder, months=(1, 2))
+    done = ingest_folder(folder, store, workers=2, chunk_rows=150)
+    assert sorted(done) == first
+    manifest = read_manifest(store)
+    assert sorted(manifest) == [os.path.basename(p) for p in first]
+    assert [manifest[os.path.basename(p)]['rows'] for p in first] == [len(pd.read_csv(p)) for p in first]
+
+    assert ingest_folder(folder, store, workers=2) == {}
+    added = tripdata_csvs(folder, months=(3,))
+    assert sorted(ingest_folder(folder, store, workers=2, chunk_rows=150)) == added
+    assert partition_months(store) == [(2022, 1), (2022, 2), (2022, 3)]
+    assert len(read_trips(store, columns=['ride_id'])) == csv_rows(first + added)
+
+
+def test_changed_file_is_replaced_not_duplicated(tmp_path, store):
+    folder = tmp_path / 'tripdata'
+    paths = tripdata_csvs(folder, months=(1, 2))
+    ingest_folder(folder, store, workers=1, chunk_rows=150)
+    # A corrected February export
+    changed = tripdata_csvs(folder, months=(2,), rows_per_month=300, seed=7)
+    assert pending_files(list_tripdata_files(folder), read_manifest(store)) == changed
+    assert sorted(ingest_folder(folder, store, workers=1, chunk_rows=150)) == changed
+
+    trips = read_trips(store, columns=['ride_id'])
+    assert len(trips) == csv_rows(paths) and trips['ride_id'].is_unique
+    assert read_manifest(store)[os.path.basename(changed[0])]['rows'] == len(pd.read_csv(changed[0]))
+
+
+def test_same_size_change_is_detected(tmp_path, store):
+    folder = tmp_path / 'tripdata'
+    path, = tripdata_csvs(folder, months=(1,))
+    ingest_folder(folder, store, workers=1)
+    with open(path) as f:
+        text = f.read()
+    with open(path, 'w') as f:
+        # One rider type flipped: same size, another checksum
+        f.write(text.replace(',member,', ',casual,', 1))
+    assert os.path.getsize(path) == len(text)
+    assert pending_files([path], read_manifest(store)) == [path]
+
+
+def test_merged_deltas_match_a_full_scan(tmp_path, store):
+    folder = tmp_path / 'tripdata'
+    tripdata_csvs(folder, months=(1, 2))
+    ingest_folder(folder, store, workers=2, chunk_rows=100)
+    tripdata_csvs(folder, months=(2, 3), seed=3)
+    ingest_folder(folder, store, workers=2, chunk_rows=100)
+    pd.testing.assert_frame_equal(sorted_cube(merge_aggregate('cube', store)), sorted_cube(build_cube(store)),
+                                  check_dtype=False)
@@ -0,0 +1,68 @@
+import urllib.error
+import urllib.request
+import pyarrow as pa
+import pandas as pd
+import pytest
+from conftest import tripdata_csvs
+from ingest import ingest_folder, rebuild_map_layers
+from map_assets import start_asset_server
+from map_layers import MapLayerService, layer_query, layer_params
+
+
+SELECTION = {'seasons': ['spring', 'winter'], 'rideable_types': ['electric_bike'], 'min_trips': 3, 'level': 'top5',
+             'station': 'W 21 St & 6 Ave', 'start': pd.Timestamp('2022-02-01'), 'end': pd.Timestamp('2022-06-30'),
+             'near': 'Broadway & W 58 St', 'radius': 1500}
+
+
+def test_query_round_trip():
+    assert layer_params(layer_query(**SELECTION)) == SELECTION
+    assert layer_params(layer_query()) == {'seasons': None, 'rideable_types': None, 'min_trips': 1, 'level': 'all',
+                                           'station': None, 'start': None, 'end': None, 'near': None, 'radius': None}
+
+
+def test_dates_are_days():
+    params = layer_params('start=2022-03-05T17:45:00&end=20220630')
+    assert params['start'] == pd.Timestamp('2022-03-05') and params['end'] == pd.Timestamp('2022-06-30')
+
+
+@pytest.mark.parametrize('query', ['level=top3', 'level=', 'min_trips=many', 'min_trips=', 'radius=far',
+                                   'start=', 'start=yesterday-ish', 'end=2022-13-01', 'start=NaT'])
+def test_bad_values_raise_value_error(query):
+    with pytest.raises(ValueError):
+        layer_params(query)
+
+
+@pytest.fixture(scope='module')
+def layer_server(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('map')
+    tripdata_csvs(folder / 'tripdata', months=(1, 2, 6))
+    store = str(folder / 'trip_store')
+    ingest_folder(folder / 'tripdata', store, workers=1)
+    layers = rebuild_map_layers(store, str(folder / 'map_layers.parquet'))
+    server, url = start_asset_server(str(folder / 'map_assets'), port=0, layers_path=layers, store=store)
+    yield url, MapLayerService.from_files(layers, store)
+    server.shutdown()
+
+
+def get(url):
+    with urllib.request.urlopen(url) as response:
+        return response.status, response.read()
+
+
+def test_server_cuts_the_route_layer(layer_server):
+    url, service = layer_server
+    selection = dict(SELECTION, station=None, near=None, radius=None)
+    status, body = get(f'{url}/layers/routes.arrow?{layer_query(**selection)}')
+    routes = pa.ipc.open_stream(body).read_all().to_pandas()
+    expected = service.routes(**selection)
+    assert status == 200 and len(routes) == len(expected) > 0
+    assert routes['trips'].tolist() == expected['trips'].tolist()
+
+
+@pytest.mark.parametrize('query', ['level=top3', 'start=not-a-date', 'min_trips=x', 'radius=1km&near=x'])
+@pytest.mark.parametrize('layer', ['routes.arrow', 'stations.arrow'])
+def test_server_answers_400_to_bad_values(layer_server, layer, query):
+    url, service = layer_server
+    with pytest.raises(urllib.error.HTTPError) as error:
+        get(f'{url}/layers/{layer}?{query}')
+    assert error.value.code == 400
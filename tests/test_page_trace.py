@@ -0,0 +1,53 @@
+import sys
+import builtins
+import importlib
+import pytest
+import page_trace
+from page_trace import PageTrace
+
+
+def test_spans_without_current_memory(monkeypatch):
+    # Where only the peak is known, a span's change in memory is not reported
+    monkeypatch.setattr(page_trace, 'rss_bytes', lambda: None)
+    trace = PageTrace('Most popular stations')
+    with trace.span('load'):
+        pass
+    trace.lap('render', 100)
+    assert [s['rss_delta_mb'] for s in trace.spans] == [None, None]
+    assert trace.record()['rss_mb'] is None
+    assert trace.table()['rss_delta_mb'].tolist() == ['n/a', 'n/a', 'n/a']
+
+
+def test_spans_with_current_memory():
+    trace = PageTrace('Most popular stations')
+    with trace.span('load'):
+        block = bytearray(64 * 2 ** 20)
+        block[::4096] = b'\1' * len(block[::4096])
+    assert trace.spans[0]['rss_delta_mb'] > 32
+    assert trace.table()['rss_delta_mb'][0].startswith('+')
+
+
+@pytest.mark.parametrize('platform, factor', [('linux', 1024), ('darwin', 1)])
+def test_peak_rss_units(monkeypatch, platform, factor):
+    resource = pytest.importorskip('resource')
+    monkeypatch.setattr(sys, 'platform', platform)
+    expected = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * factor
+    assert page_trace.peak_rss_bytes() == expected
+
+
+def test_import_without_resource(monkeypatch):
+    # As on Windows
+    real_import = builtins.__import__
+
+    def no_resource(name, *args, **kwargs):
+        if name == 'resource':
+            raise ImportError(name)
+        return real_import(name, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, '__import__', no_resource)
+    module = importlib.reload(page_trace)
+    try:
+        assert module.peak_rss_bytes() is None or module.psutil is not None
+    finally:
+        monkeypatch.undo()
+        importlib.reload(page_trace)
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import write_notebook_csv
+from sampling import STRATA, MIN_PER_STRATUM, Z_95, collapse_strata, stratified_sample, estimate_counts
+
+
+@pytest.fixture(scope='module')
+def population(tmp_path_factory):
+    path = write_notebook_csv(str(tmp_path_factory.mktemp('sampling') / 'trips.csv'), rows=20000)
+    return path, pd.read_csv(path)
+
+
+def summer_electric(frame):
+    return (frame['season'] == 'summer') & (frame['rideable_type'] == 'electric_bike')
+
+
+def test_every_stratum_has_two_rows(population):
+    path, trips = population
+    codes = collapse_strata(trips, STRATA, 0.1)
+    assert (codes >= 0).all() and len(np.unique(codes)) < trips.groupby(STRATA).ngroups
+    sample = stratified_sample(path, 0.1, seed=1)
+    strata = sample.groupby('stratum').agg(rows=('weight', 'size'), weight=('weight', 'first'))
+    # Each stratum gets the two rows its variance needs, unless it is sampled whole
+    assert ((strata['rows'] >= MIN_PER_STRATUM) | (strata['weight'] == 1)).all()
+
+
+def test_weights_add_up_to_the_population(population):
+    path, trips = population
+    sample = stratified_sample(path, 0.1, seed=1)
+    assert abs(len(sample) / len(trips) - 0.1) < 0.01
+    total = estimate_counts(sample)
+    # Every trip is in the domain: the estimate is exact and has no variance
+    assert total['estimate'][0] == pytest.approx(len(trips))
+    assert total['low'][0] == pytest.approx(len(trips)) and total['high'][0] == pytest.approx(len(trips))
+
+
+def test_variance_of_a_domain_by_hand():
+    # Stratum 0: 4 of 10 trips sampled, 1 in the domain; stratum 1: 2 of 2, both in it
+    sample = pd.DataFrame({'stratum': [0, 0, 0, 0, 1, 1], 'weight': [2.5] * 4 + [1.0] * 2,
+                           'member_casual': ['member', 'casual', 'casual', 'casual', 'member', 'member']})
+    estimate = estimate_counts(sample, where=sample['member_casual'] == 'member')
+    p, n, N = 1 / 4, 4, 10
+    variance = N ** 2 * (1 - n / N) * (n / (n - 1) * p * (1 - p)) / n  # stratum 1 is a census
+    assert estimate['estimate'][0] == pytest.approx(2.5 + 2)
+    assert estimate['high'][0] - estimate['estimate'][0] == pytest.approx(Z_95 * np.sqrt(variance))
+
+
+def test_groups_match_the_filtered_total(population):
+    path, trips = population
+    sample = stratified_sample(path, 0.1, seed=2)
+    by_type = estimate_counts(sample, by='rideable_type', where=sample['season'] == 'summer')
+    summer = estimate_counts(sample, where=sample['season'] == 'summer')
+    assert by_type['estimate'].sum() == pytest.approx(summer['estimate'][0])
+    assert set(by_type['rideable_type']) == {'classic_bike', 'electric_bike'}
+
+
+def test_empty_domain():
+    sample = pd.DataFrame({'stratum': [0, 0], 'weight': [5.0, 5.0], 'season': ['winter', 'winter']})
+    estimate = estimate_counts(sample, where=sample['season'] == 'summer')
+    assert estimate.to_dict('records') == [{'estimate': 0.0, 'low': 0.0, 'high': 0.0}]
+
+
+def test_intervals_cover_the_true_count(population):
+    # Over repeated samples the estimate is unbiased, its variance is what estimate_counts says, and the 95%
+    # intervals contain the true count about 95% of the time
+    path, trips = population
+    truth = summer_electric(trips).sum()
+    estimates, variances, covered = [], [], 0
+    for seed in range(40):
+        sample = stratified_sample(path, 0.1, seed=seed)
+        row = estimate_counts(sample, where=summer_electric(sample)).iloc[0]
+        estimates.append(row['estimate'])
+        variances.append(((row['high'] - row['estimate']) / Z_95) ** 2)
+        covered += row['low'] <= truth <= row['high']
+    assert abs(np.mean(estimates) - truth) < 3 * np.sqrt(np.mean(variances) / len(estimates))
+    assert 0.6 < np.var(estimates) / np.mean(variances) < 1.6
+    assert covered >= 34
@@ -0,0 +1,85 @@
+import pandas as pd
+import pytest
+from conftest import write_notebook_csv, tripdata_csvs
+from ingest import ingest_folder, rebuild_station_rankings
+from station_rankings import read_station_rankings
+from trip_store import convert_csv
+from trip_queries import open_queries
+
+pytest.importorskip('duckdb')
+
+RANGES = [(None, None), ('2022-02-10', '2022-05-03'), ('2022-03-01', None), (None, '2022-01-31')]
+
+
+@pytest.fixture(params=['csv', 'store', 'keyed store'])
+def source(request, tmp_path):
+    """The notebook CSV, the store converted from it and a store ingested from raw tripdata (station keys)."""
+    csv = write_notebook_csv(str(tmp_path / 'reduced_data_to_plot.csv'))
+    if request.param == 'csv':
+        return csv
+    if request.param == 'store':
+        convert_csv(csv, str(tmp_path / 'trip_store'))
+    else:
+        tripdata_csvs(tmp_path / 'tripdata', months=(1, 2, 6))
+        ingest_folder(tmp_path / 'tripdata', str(tmp_path / 'trip_store'), workers=1)
+    return str(tmp_path / 'trip_store')
+
+
+@pytest.fixture
+def backends(source):
+    return open_queries(source, 'pandas'), open_queries(source, 'duckdb')
+
+
+def test_dates_and_seasons(backends):
+    pandas, duckdb = backends
+    assert pandas.date_range() == duckdb.date_range()
+    assert pandas.seasons() == duckdb.seasons()
+
+
+@pytest.mark.parametrize('start, end', RANGES)
+def test_daily_counts(backends, start, end):
+    pandas, duckdb = backends
+    counts = pandas.daily_counts(start, end)
+    assert len(counts)
+    pd.testing.assert_frame_equal(counts, duckdb.daily_counts(start, end), check_dtype=False)
+
+
+@pytest.mark.parametrize('start, end', RANGES)
+@pytest.mark.parametrize('seasons', [None, ['winter'], ['spring', 'summer']])
+@pytest.mark.parametrize('direction', ['start', 'end'])
+def test_top_stations(backends, seasons, direction, start, end):
+    pandas, duckdb = backends
+    total, top = pandas.top_stations(seasons, 4, direction, start, end)
+    duck_total, duck_top = duckdb.top_stations(seasons, 4, direction, start, end)
+    assert total == duck_total
+    pd.testing.assert_frame_equal(top, duck_top, check_dtype=False)
+
+
+def test_top_of_chosen_stations(backends):
+    pandas, duckdb = backends
+    stations = ['West St & Chambers St', 'Soissons Landing', 'Not a station']
+    total, top = pandas.top_stations(None, 20, 'start', stations=stations)
+    duck_total, duck_top = duckdb.top_stations(None, 20, 'start', stations=stations)
+    assert total == duck_total and set(top['start_station_name']) <= set(stations)
+    pd.testing.assert_frame_equal(top, duck_top, check_dtype=False)
+
+
+@pytest.mark.parametrize('start, end', RANGES)
+def test_bike_crosstab(backends, start, end):
+    pandas, duckdb = backends
+    table = pandas.bike_crosstab(start, end)
+    pd.testing.assert_frame_equal(table, duckdb.bike_crosstab(start, end), check_dtype=False)
+
+
+@pytest.mark.parametrize('seasons', [None, ['winter'], ['spring', 'summer']])
+def test_station_rankings_file_agrees(tmp_path, seasons):
+    # The page reads the rankings ingest.py merges where they exist, the backend otherwise
+    tripdata_csvs(tmp_path / 'tripdata', months=(1, 2, 6))
+    store = str(tmp_path / 'trip_store')
+    ingest_folder(tmp_path / 'tripdata', store, workers=1)
+    rankings = read_station_rankings(rebuild_station_rankings(store, str(tmp_path / 'rankings.parquet')), store)
+    for direction in ['start', 'end']:
+        total, top = rankings.top(seasons, 4, direction)
+        duck_total, duck_top = open_queries(store, 'duckdb').top_stations(seasons, 4, direction)
+        assert total == duck_total
+        pd.testing.assert_frame_equal(top, duck_top, check_dtype=False)
@@ -0,0 +1,72 @@
+import os
+import glob
+import pandas as pd
+import pytest
+from conftest import notebook_trips, write_notebook_csv
+from trip_store import (BROADCAST_COLUMNS, convert_csv, read_trips, partition_months, partition_path, open_store,
+                        date_filter)
+
+
+@pytest.mark.parametrize('index', [True, False])
+def test_convert_csv_of_the_notebook_export(tmp_path, index):
+    trips = notebook_trips(2000)
+    csv = write_notebook_csv(tmp_path / 'reduced_data_to_plot.csv', 2000, index=index)
+    root = str(tmp_path / 'trip_store')
+    convert_csv(str(csv), root)
+
+    stored = read_trips(root)
+    assert len(stored) == len(trips)
+    assert not set(BROADCAST_COLUMNS) & set(stored.columns)
+    assert not any(str(c).startswith('Unnamed') for c in stored.columns)
+    assert len(partition_months(root)) == 12
+    assert (pd.to_datetime(stored['date']).dt.month.value_counts().sort_index().to_numpy() ==
+            pd.to_datetime(trips['date']).dt.month.value_counts().sort_index().to_numpy()).all()
+
+
+RANGES = [('2022-03-15', '2022-05-02'), ('2022-11-20', None), (None, '2022-01-31'), ('2022-06-30', '2022-06-30')]
+
+
+@pytest.fixture
+def store(tmp_path):
+    root = str(tmp_path / 'trip_store')
+    convert_csv(str(write_notebook_csv(tmp_path / 'reduced_data_to_plot.csv', 4000)), root)
+    return root
+
+
+@pytest.mark.parametrize('start, end', RANGES)
+def test_date_filter_prunes_month_partitions(store, start, end):
+    dataset = open_store(store)
+    fragments = list(dataset.get_fragments(filter=date_filter(start, end, dataset.schema.names)))
+    months = {(int(f.path.split('year=')[1][:4]), int(f.path.split('month=')[1].split('/')[0])) for f in fragments}
+    first = pd.Timestamp(start or '2022-01-01')
+    last = pd.Timestamp(end or '2022-12-31')
+    assert months == {(m.year, m.month) for m in pd.period_range(first, last, freq='M')}
+
+
+@pytest.mark.parametrize('start, end', RANGES)
+def test_read_trips_never_opens_other_months(store, start, end):
+    everything = read_trips(store)
+    dates = pd.to_datetime(everything['date'])
+    inside = pd.Series(True, index=everything.index)
+    if start is not None:
+        inside &= dates >= pd.Timestamp(start)
+    if end is not None:
+        inside &= dates <= pd.Timestamp(end)
+    # Corrupt every file outside the range: reading the range must not touch them. The first month is kept, the
+    # dataset takes its schema from the first file
+    first = pd.Timestamp(start or '2022-01-01').to_period('M')
+    last = pd.Timestamp(end or '2022-12-31').to_period('M')
+    for year, month in partition_months(store)[1:]:
+        if not first <= pd.Period(year=year, month=month, freq='M') <= last:
+            for part in glob.glob(os.path.join(partition_path(store, year, month), '*.parquet')):
+                with open(part, 'wb') as f:
+                    f.write(b'not parquet')
+    trips = read_trips(store, ['ride_id', 'date'], start, end)
+    assert sorted(trips['ride_id']) == sorted(everything.loc[inside, 'ride_id'])
+
+
+def test_date_filter_without_a_date_column():
+    # Only the partition terms, e.g. for a projection without dates
+    expression = date_filter('2022-03-15', '2022-05-02', ['ride_id', 'season'])
+    assert 'date' not in str(expression) and 'started_at' not in str(expression)
+    assert date_filter(None, None, ['date']) is None
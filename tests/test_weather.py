@@ -0,0 +1,89 @@
+import os
+import asyncio
+import subprocess
+import sys
+import pandas as pd
+import pytest
+import weather
+from conftest import ROOT
+from weather import NOAAClient, WeatherAPIError, DATATYPES, LAGUARDIA, daily_weather
+from weather_stub import start_stub_server
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(**options):
+        server, base_url = start_stub_server(**options)
+        servers.append(server)
+        return server, base_url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    sleep = asyncio.sleep
+    monkeypatch.setattr(weather.asyncio, 'sleep', lambda seconds: sleep(0))
+
+
+def test_fetch_pages_and_converts(stub, tmp_path):
+    server, base_url = stub()
+    client = NOAAClient(base_url=base_url, cache_dir=tmp_path / 'cache', rate=1000)
+    observations = client.fetch_daily('2021-07-01', '2022-06-30', datatypes=['TAVG', 'PRCP'])
+    # Two yearly queries of 184 and 181 days of two measures, a page each
+    assert len(observations) == 365 * 2 and client.requests_made == 2
+    assert set(observations['datatype']) == {'TAVG', 'PRCP'} and (observations['station'] == LAGUARDIA).all()
+    daily = daily_weather(observations)
+    assert len(daily) == 365 and list(daily.columns) == ['date', 'avgTemp', 'precipitation']
+    # Tenths of a degree in the API, degrees in the frame
+    assert daily['avgTemp'].between(-20, 40).all()
+
+
+def test_fetch_every_page_of_a_long_query(stub, tmp_path):
+    server, base_url = stub()
+    client = NOAAClient(base_url=base_url, cache_dir=None, rate=1000)
+    observations = client.fetch_daily('2022-01-01', '2022-12-31', datatypes=DATATYPES)
+    assert len(observations) == 365 * len(DATATYPES)
+    assert client.requests_made == 3  # limit 1000
+    assert not observations.duplicated(['date', 'datatype']).any()
+
+
+def test_cached_pages_are_not_fetched_again(stub, tmp_path):
+    server, base_url = stub()
+    first = NOAAClient(base_url=base_url, cache_dir=tmp_path / 'cache', rate=1000)
+    expected = first.fetch_daily('2022-01-01', '2022-03-31')
+    again = NOAAClient(base_url=base_url, cache_dir=tmp_path / 'cache', rate=1000)
+    pd.testing.assert_frame_equal(again.fetch_daily('2022-01-01', '2022-03-31'), expected)
+    assert again.requests_made == 0
+
+
+def test_retries_rate_limits_and_server_errors(stub, no_backoff):
+    server, base_url = stub()
+    expected = NOAAClient(base_url=base_url, cache_dir=None, rate=1000).fetch_daily('2022-01-01', '2022-12-31')
+    server, base_url = stub(failure_rate=0.3)
+    client = NOAAClient(base_url=base_url, cache_dir=None, rate=1000, max_retries=20)
+    pd.testing.assert_frame_equal(client.fetch_daily('2022-01-01', '2022-12-31'), expected)
+
+
+def test_client_errors_are_raised(stub):
+    server, base_url = stub(token='secret')
+    with pytest.raises(WeatherAPIError, match='400'):
+        NOAAClient(token='wrong', base_url=base_url, cache_dir=None, rate=1000).fetch_daily('2022-01-01', '2022-01-31')
+    observations = NOAAClient(token='secret', base_url=base_url, cache_dir=None,
+                              rate=1000).fetch_daily('2022-01-01', '2022-01-31', datatypes=['TAVG'])
+    assert len(observations) == 31
+
+
+def test_command_line_against_the_stub(stub, tmp_path):
+    # The --base-url documented in weather.py and weather_stub.py
+    server, base_url = stub()
+    assert base_url.endswith('/cdo-web/api/v2')
+    out = tmp_path / 'weather.csv'
+    subprocess.run([sys.executable, os.path.join(ROOT, 'weather.py'), '--start', '2022-01-01', '--end', '2022-01-10',
+                    '--base-url', base_url, '--cache-dir', str(tmp_path / 'cache'), '--out', str(out)],
+                   check=True, capture_output=True)
+    assert len(pd.read_csv(out)) == 10 * len(DATATYPES)
@@ -0,0 +1,145 @@
+################################################ CITIBIKES TRIP CUBE #####################################################
+# Offline, pre-aggregated trip counts keyed by
+#
+#     date x start station x rideable_type x member_casual x season
+#
+# The station is the integer start_station_key when the trips carry station keys (see stations.py), otherwise the
+# start_station_name; names are only decoded for the stations a page actually shows.
+#
+# The cube is built once from the full trip data (trip store or CSV), streaming one month / chunk at a time, and the
+# dashboard pages answer from it instead of aggregating millions of raw rows on every rerun.
+#
+#     python trip_cube.py trip_store trip_cube.parquet
+
+import os
+import argparse
+import pandas as pd
+from trip_store import STORE_DIR, SEASONS, SEASON_BY_MONTH, open_store
+
+
+CUBE_PATH = 'trip_cube.parquet'
+
+CUBE_DIMENSIONS = ['date', 'start_station_key', 'start_station_name', 'rideable_type', 'member_casual', 'season']
+
+# Columns the build needs from the trips (started_at is only used when there is no date column)
+CUBE_INPUT_COLUMNS = CUBE_DIMENSIONS + ['started_at']
+
+CSV_CHUNK_ROWS = 1_000_000
+
+# Dimensions of the bike type crosstab behind the 'Classic versus Electric Bikes' page
+CROSSTAB_DIMENSIONS = ['rideable_type', 'season', 'member_casual']
+
+
+########################## Build ############################################################################################
+
+def _prepare(chunk):
+    if 'date' not in chunk.columns:
+        chunk = chunk.assign(date=pd.to_datetime(chunk['started_at']).dt.normalize())
+    else:
+        chunk = chunk.assign(date=pd.to_datetime(chunk['date']))
+    if 'season' not in chunk.columns:
+        chunk = chunk.assign(season=SEASON_BY_MONTH[chunk['date'].dt.month.to_numpy()])
+    return chunk
+
+
+def aggregate_chunk(chunk):
+    """Trip counts of one chunk of raw trips, as a flat frame with one row per cube cell."""
+    chunk = _prepare(chunk)
+    dims = [c for c in CUBE_DIMENSIONS if c in chunk.columns]
+    keys = {c: chunk[c].astype(object) if isinstance(chunk[c].dtype, pd.CategoricalDtype) else chunk[c] for c in dims}
+    counts = pd.DataFrame(keys).groupby(dims, dropna=False).size()
+    return counts.rename('trips').reset_index()
+
+
+def _iter_source_chunks(source):
+    if os.path.isdir(source):
+        dataset = open_store(source)
+        columns = [c for c in CUBE_INPUT_COLUMNS if c in dataset.schema.names]
+        if 'date' in columns and 'started_at' in columns:
+            columns.remove('started_at')
+        for fragment in dataset.get_fragments():
+            yield fragment.to_table(columns=columns).to_pandas()
+    else:
+        reader = pd.read_csv(source, usecols=lambda c: c in CUBE_INPUT_COLUMNS, chunksize=CSV_CHUNK_ROWS)
+        for chunk in reader:
+            yield chunk
+
+
+def finalize_cube(partials):
+    """Merge per-chunk counts into the typed cube."""
+    partials = [p for p in partials if len(p)]
+    if not partials:
+        return pd.DataFrame(columns=CUBE_DIMENSIONS + ['trips'])
+    df = pd.concat(partials, ignore_index=True)
+    dims = [c for c in CUBE_DIMENSIONS if c in df.columns]
+    cube = df.groupby(dims, dropna=False)['trips'].sum().reset_index()
+    for col in dims:
+        if col == 'season':
+            cube[col] = pd.Categorical(cube[col], categories=SEASONS, ordered=True)
+        elif col == 'start_station_key':
+            cube[col] = cube[col].astype('int32')
+        elif col != 'date':
+            cube[col] = cube[col].astype('category')
+    cube['trips'] = cube['trips'].astype('int64')
+    return cube.sort_values(dims).reset_index(drop=True)
+
+
+def build_cube(source=STORE_DIR):
+    """Build the cube from the trip store directory or from a trip CSV, one month / chunk at a time."""
+    return finalize_cube(aggregate_chunk(chunk) for chunk in _iter_source_chunks(source))
+
+
+def write_cube(cube, path=CUBE_PATH):
+    cube.to_parquet(path, index=False)
+    return path
+
+
+def read_cube(path=CUBE_PATH):
+    cube = pd.read_parquet(path)
+    if 'season' in cube.columns:
+        cube['season'] = pd.Categorical(cube['season'], categories=SEASONS, ordered=True)
+    return cube
+
+
+########################## Queries ##########################################################################################
+# Small helpers shared by the dashboard pages. They never modify the cube they are given.
+
+def daily_counts(cube):
+    return cube.groupby('date', as_index=False)['trips'].sum().rename(columns={'trips': 'trip_count'})
+
+
+def bike_crosstab(table):
+    """Trips per rideable_type x season x member_casual, every combination present (a few dozen rows).
+
+    table is the cube (summing its trips) or trip rows (counting them); a missing member_casual column is left out.
+    """
+    dims = [c for c in CROSSTAB_DIMENSIONS if c in table.columns]
+    keys = [pd.Series(pd.Categorical(table[c], categories=SEASONS, ordered=True) if c == 'season' else
+                      pd.Categorical(table[c]), index=table.index, name=c) for c in dims]
+    if 'trips' in table.columns:
+        counts = table['trips'].groupby(keys, observed=False).sum()
+    else:
+        counts = table.groupby(keys, observed=False).size()
+    return counts.rename('trips').reset_index()
+
+
+def bike_season_counts(table, rideable_type, member_types=None):
+    """Trips per season for one bike type (optionally some member_casual values only), with every season present.
+
+    table is the cube or its bike_crosstab.
+    """
+    mask = table['rideable_type'] == rideable_type
+    if member_types is not None:
+        mask &= table['member_casual'].isin(member_types)
+    counts = table['trips'][mask].groupby(table['season'][mask], observed=False).sum()
+    return counts.reindex(SEASONS, fill_value=0).rename_axis('season').reset_index(name='trip_count')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the pre-aggregated Citi Bike trip cube')
+    parser.add_argument('source', nargs='?', default=STORE_DIR, help='trip store directory or trip CSV')
+    parser.add_argument('out', nargs='?', default=CUBE_PATH)
+    args = parser.parse_args()
+    cube = build_cube(args.source)
+    write_cube(cube, args.out)
+    print(f'Wrote {len(cube):,} cube rows ({cube["trips"].sum():,} trips) to {args.out}')
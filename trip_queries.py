@@ -0,0 +1,243 @@
+################################################ CITIBIKES TRIP QUERIES #####################################################
+# The questions the dashboard pages ask of the trip rows, answered by a pluggable backend.
+#
+# Where no pre-aggregated file exists (trip_cube.parquet, station_rankings.parquet, daily_facts.parquet), the pages
+# used to load whole columns of the trips into pandas, which only works while the data fits in memory. The pages
+# now ask a TripQueries backend for an answer instead:
+#
+#     date_range()                                        first and last trip date
+#     seasons()                                           seasons with trips, in SEASONS order
+#     daily_counts(start, end)                            date, trip_count
+#     top_stations(seasons, k, direction, start, end,     (total trips, the k busiest start / end stations,
+#                  stations)                                of the given station names only if stations is set)
+#     bike_crosstab(start, end)                           trips per rideable_type x season x member_casual
+#
+# start / end restrict a query to a date range (inclusive, None leaves a side open). On the trip store the range is
+# pushed down to the month partitions, so only the months in range are read (see trip_store.date_filter).
+#
+# Two backends answer them from the trip store directory or a trip CSV:
+#   - pandas: reads the needed columns (of the months in range) into memory and keeps the last few reads
+#   - duckdb: runs each query as SQL straight over the partitioned Parquet files (or the CSV), streaming them with a
+#     bounded memory limit, so several years of trips can be served from a small VM. Needs the duckdb package
+#     (duckdb >= 0.10), an optional extra that is not in 2.7 requirements.txt.
+#
+#     queries = open_queries('trip_store', backend='duckdb', memory_limit='1GB')
+#     total, top = queries.top_stations(['summer', 'fall'], k=20, direction='start', start='2022-06-01')
+
+import os
+import pandas as pd
+from data_cache import LRUCache
+from trip_store import SEASONS, STATION_KEYS, open_store, read_trips, station_dim_path, store_date_range
+from trip_cube import CROSSTAB_DIMENSIONS, bike_crosstab
+from station_rankings import StationRankings
+try:
+    import duckdb
+except ImportError:  # optional: only the duckdb backend needs it
+    duckdb = None
+
+
+QUERY_BACKENDS = ['pandas', 'duckdb']
+DEFAULT_BACKEND = 'pandas'
+
+# Frames (column set x date range) the pandas backend keeps in memory
+FRAME_CACHE_SIZE = 4
+
+
+def source_columns(source):
+    """Columns of a trip store directory or trip CSV."""
+    if os.path.isdir(source):
+        return open_store(source).schema.names
+    return list(pd.read_csv(source, nrows=0).columns)
+
+
+def date_column(columns):
+    """The column trips are dated by: date, or the started_at timestamp of raw trips (None if neither)."""
+    return 'date' if 'date' in columns else 'started_at' if 'started_at' in columns else None
+
+
+def _day(value):
+    return None if value is None else pd.Timestamp(value).normalize()
+
+
+def _sql_string(text):
+    return "'" + text.replace("'", "''") + "'"
+
+
+def _top_frame(direction, names, values):
+    return pd.DataFrame({f'{direction}_station_name': names, 'value': values})
+
+
+########################## pandas ###########################################################################################
+
+class PandasQueries:
+    """Answers from columns read into memory; the last FRAME_CACHE_SIZE reads are shared by all queries."""
+
+    def __init__(self, source):
+        self.source = source
+        self.columns = source_columns(source)
+        self.dated_by = date_column(self.columns)
+        self._frames = LRUCache(FRAME_CACHE_SIZE)
+
+    def _trips(self, columns, start=None, end=None):
+        start, end = (_day(start), _day(end)) if self.dated_by is not None else (None, None)
+        columns = tuple(c for c in columns if c in self.columns or STATION_KEYS.get(c) in self.columns)
+        if os.path.isdir(self.source):
+            # Only the months in range are read
+            return self._frames.get_or_compute((columns, start, end),
+                                               lambda: read_trips(self.source, list(columns), start, end))
+        # A CSV is read whole once and cut to the range in memory
+        read = columns + ((self.dated_by,) if (start, end) != (None, None) and self.dated_by not in columns else ())
+        trips = self._frames.get_or_compute((read, None, None), lambda: pd.read_csv(self.source, usecols=list(read)))
+        if (start, end) == (None, None):
+            return trips
+        dates = pd.to_datetime(trips[self.dated_by])
+        keep = pd.Series(True, index=trips.index)
+        if start is not None:
+            keep &= dates >= start
+        if end is not None:
+            keep &= dates < end + pd.Timedelta(days=1)
+        return trips[keep]
+
+    def date_range(self):
+        if self.dated_by is None:
+            return None
+        if os.path.isdir(self.source) and self.dated_by == 'date':
+            return store_date_range(self.source)
+        dates = pd.to_datetime(self._trips((self.dated_by,))[self.dated_by])
+        return (dates.min().normalize(), dates.max().normalize()) if len(dates) else None
+
+    def seasons(self):
+        seasons = set(self._trips(('season',))['season'].dropna().astype(str))
+        return [s for s in SEASONS if s in seasons]
+
+    def daily_counts(self, start=None, end=None):
+        dates = pd.to_datetime(self._trips((self.dated_by,), start, end)[self.dated_by]).dt.normalize()
+        return dates.value_counts().sort_index().rename_axis('date').reset_index(name='trip_count')
+
+    def top_stations(self, seasons=None, k=20, direction='start', start=None, end=None, stations=None):
+        columns = ('season', 'start_station_name', 'end_station_name')
+        rankings = self._frames.get_or_compute(('rankings', _day(start), _day(end)),
+                                               lambda: StationRankings.from_trips(self._trips(columns, start, end)))
+        return rankings.top(seasons, k, direction, stations)
+
+    def bike_crosstab(self, start=None, end=None):
+        return bike_crosstab(self._trips(CROSSTAB_DIMENSIONS, start, end))
+
+
+########################## DuckDB ###########################################################################################
+
+class DuckDBQueries:
+    """Answers computed by DuckDB over the files on every call; nothing but the results is held in memory."""
+
+    def __init__(self, source, memory_limit=None, threads=None):
+        if duckdb is None:
+            raise ImportError("the duckdb query backend needs the duckdb package, an optional extra left out of "
+                              "'2.7 requirements.txt': pip install 'duckdb>=0.10', or use the pandas backend")
+        self.source = source
+        self.columns = source_columns(source)
+        self.dated_by = date_column(self.columns)
+        self.partitioned = os.path.isdir(source)
+        self._con = duckdb.connect()
+        if memory_limit:
+            self._con.execute(f"SET memory_limit = '{memory_limit}'")
+        if threads:
+            self._con.execute(f'SET threads = {int(threads)}')
+        if self.partitioned:
+            # Only the month partitions; the store's _station_dim / _aggregates files are not trips
+            files = _sql_string(os.path.join(source, 'year=*', 'month=*', '*.parquet'))
+            self._con.execute(f"CREATE VIEW trips AS SELECT * FROM read_parquet({files}, hive_partitioning = true, "
+                              f"hive_types = {{'year': INTEGER, 'month': INTEGER}}, union_by_name = true)")
+        else:
+            self._con.execute(f'CREATE VIEW trips AS SELECT * FROM read_csv_auto({_sql_string(source)})')
+        self.keyed = 'start_station_key' in self.columns
+        if self.keyed:
+            dim = _sql_string(station_dim_path(source))
+            self._con.execute(f'CREATE VIEW stations AS SELECT station_key, station_name FROM read_parquet({dim})')
+
+    def _query(self, sql, params=None):
+        # One cursor per query: cursors of one connection may run in different threads
+        return self._con.cursor().execute(sql, params or []).df()
+
+    def _where(self, seasons=None, start=None, end=None):
+        """SQL condition and parameters of a season selection and date range."""
+        terms, params = ['TRUE'], []
+        if seasons is not None:
+            terms.append('list_contains(?, CAST(season AS VARCHAR))')
+            params.append(list(seasons))
+        start, end = _day(start), _day(end)
+        if self.dated_by is None:
+            return ' AND '.join(terms), params
+        day = f'CAST({self.dated_by} AS DATE)'
+        if start is not None:
+            if self.partitioned:
+                # On the partition columns alone, so DuckDB skips the files of earlier months
+                terms.append('(year > ? OR (year = ? AND month >= ?))')
+                params += [start.year, start.year, start.month]
+            terms.append(f'{day} >= ?')
+            params.append(start.date())
+        if end is not None:
+            if self.partitioned:
+                terms.append('(year < ? OR (year = ? AND month <= ?))')
+                params += [end.year, end.year, end.month]
+            terms.append(f'{day} <= ?')
+            params.append(end.date())
+        return ' AND '.join(terms), params
+
+    def date_range(self):
+        if self.dated_by is None:
+            return None
+        first, last = self._query(f'SELECT min(CAST({self.dated_by} AS DATE)) AS first, '
+                                  f'max(CAST({self.dated_by} AS DATE)) AS last FROM trips').iloc[0]
+        return None if pd.isna(first) else (pd.Timestamp(first), pd.Timestamp(last))
+
+    def seasons(self):
+        found = set(self._query('SELECT DISTINCT CAST(season AS VARCHAR) AS season FROM trips')['season'].dropna())
+        return [s for s in SEASONS if s in found]
+
+    def daily_counts(self, start=None, end=None):
+        where, params = self._where(start=start, end=end)
+        counts = self._query(f'SELECT CAST({self.dated_by} AS DATE) AS date, count(*) AS trip_count FROM trips '
+                             f'WHERE {where} AND {self.dated_by} IS NOT NULL GROUP BY 1 ORDER BY 1', params)
+        counts['date'] = pd.to_datetime(counts['date'])
+        counts['trip_count'] = counts['trip_count'].astype('int64')
+        return counts
+
+    def top_stations(self, seasons=None, k=20, direction='start', start=None, end=None, stations=None):
+        where, params = self._where(seasons if seasons is not None else SEASONS, start, end)
+        if stations is not None:
+            if self.keyed:
+                where += (f' AND {direction}_station_key IN '
+                          f'(SELECT station_key FROM stations WHERE list_contains(?, station_name))')
+            else:
+                where += f' AND list_contains(?, CAST({direction}_station_name AS VARCHAR))'
+            params = params + [list(stations)]
+        total = self._query(f'SELECT count(*) AS n FROM trips WHERE {where}', params)['n'].iloc[0]
+        if self.keyed:
+            # Count per integer key, and only look up the names of the k stations kept
+            sql = (f'SELECT s.station_name AS name, c.value FROM '
+                   f'(SELECT {direction}_station_key AS station_key, count(*) AS value FROM trips '
+                   f' WHERE {where} AND {direction}_station_key >= 0 GROUP BY 1) c '
+                   f'JOIN stations s USING (station_key) ORDER BY c.value DESC, s.station_name LIMIT ?')
+        else:
+            sql = (f'SELECT {direction}_station_name AS name, count(*) AS value FROM trips '
+                   f'WHERE {where} AND {direction}_station_name IS NOT NULL GROUP BY 1 ORDER BY 2 DESC, 1 LIMIT ?')
+        top = self._query(sql, params + [int(k)])
+        return float(total), _top_frame(direction, top['name'].astype(object).to_numpy(),
+                                        top['value'].to_numpy(dtype='int64'))
+
+    def bike_crosstab(self, start=None, end=None):
+        where, params = self._where(start=start, end=end)
+        dims = [c for c in CROSSTAB_DIMENSIONS if c in self.columns]
+        columns = ', '.join(f'CAST({c} AS VARCHAR) AS {c}' for c in dims)
+        counts = self._query(f'SELECT {columns}, count(*) AS trips FROM trips WHERE {where} GROUP BY ALL', params)
+        return bike_crosstab(counts)
+
+
+BACKEND_CLASSES = {'pandas': PandasQueries, 'duckdb': DuckDBQueries}
+
+
+def open_queries(source, backend=DEFAULT_BACKEND, **options):
+    """The query backend of a trip store directory or trip CSV (options: memory_limit, threads for duckdb)."""
+    if backend not in BACKEND_CLASSES:
+        raise ValueError(f'query backend must be one of {QUERY_BACKENDS}, not {backend!r}')
+    return BACKEND_CLASSES[backend](source, **options)
@@ -0,0 +1,250 @@
+################################################ CITIBIKES TRIP STORE #####################################################
+# Columnar (Parquet) store for the Citi Bike trips, partitioned by month:
+#
+#     trip_store/year=2022/month=01/part-0.parquet
+#
+# Text columns with few distinct values are stored as categoricals and the timestamps as real datetimes, so a page
+# can read just the columns it needs without parsing the whole CSV again.
+#
+# Trips loaded by ingest.py carry integer station keys (start_station_key / end_station_key) instead of the station
+# names. The keys point into the station dimension table kept next to the partitions (_station_dim.parquet), and
+# read_trips turns them back into names only when a caller asks for the name columns.
+#
+# A date range passed to read_trips is pushed down to the store: the year=/month= folder names are the min/max
+# statistics of every file, so partitions outside the range are skipped without being opened, and inside the
+# boundary months Parquet row groups are skipped by the min/max statistics of their date column.
+#
+# Convert an existing CSV once with:
+#     python trip_store.py reduced_data_to_plot.csv trip_store
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+STORE_DIR = 'trip_store'
+
+SEASONS = ['winter', 'spring', 'summer', 'fall']
+
+# Season of each month as defined in 2.6: winter Dec-Apr, spring May, summer Jun-Sep, fall Oct-Nov
+SEASON_BY_MONTH = np.array([None, 'winter', 'winter', 'winter', 'winter', 'spring', 'summer', 'summer', 'summer',
+                            'summer', 'fall', 'fall', 'winter'], dtype=object)
+
+# Typed schema for every column we know about. Columns missing from a frame are simply skipped.
+CATEGORY_COLUMNS = ['rideable_type', 'member_casual', 'start_station_name', 'start_station_id',
+                    'end_station_name', 'end_station_id']
+DATETIME_COLUMNS = ['started_at', 'ended_at', 'date']
+FLOAT_COLUMNS = ['start_lat', 'start_lng', 'end_lat', 'end_lng', 'avgTemp', 'tripduration']
+INT_COLUMNS = ['trip_count']
+SMALL_INT_COLUMNS = ['month', 'hour', 'weekday']
+KEY_COLUMNS = ['start_station_key', 'end_station_key']
+
+# Station name column -> integer key column. Key -1 means the trip has no station.
+STATION_KEYS = {'start_station_name': 'start_station_key', 'end_station_name': 'end_station_key'}
+STATION_DIM_NAME = '_station_dim.parquet'
+STATION_DIM_COLUMNS = ['station_key', 'station_name', 'lat', 'lng']
+
+# Helper columns left behind by the notebooks that should never be stored
+DROP_COLUMNS = ['Unnamed: 0', '_merge', 'merge_flag', 'value']
+
+# Per-day values the notebooks copied onto every trip row. They belong in the daily fact table (daily_facts.py), not
+# on the trips.
+BROADCAST_COLUMNS = ['trip_count', 'avgTemp']
+
+PARTITION_COLUMNS = ['year', 'month']
+
+
+########################## Schema ###########################################################################################
+
+def normalize_trips(df):
+    """Cast a raw trip frame to the store schema (returns a new frame)."""
+    df = df.drop(columns=[c for c in DROP_COLUMNS if c in df.columns])
+    out = {}
+    for col in df.columns:
+        s = df[col]
+        if col in CATEGORY_COLUMNS:
+            s = s.astype('category')
+        elif col == 'season':
+            s = pd.Categorical(s, categories=SEASONS, ordered=True)
+        elif col in DATETIME_COLUMNS:
+            if not pd.api.types.is_datetime64_any_dtype(s):
+                s = pd.to_datetime(s)
+        elif col in FLOAT_COLUMNS:
+            s = pd.to_numeric(s, errors='coerce').astype('float64')
+        elif col in INT_COLUMNS:
+            s = pd.to_numeric(s, errors='coerce').astype('Int64')
+        elif col in KEY_COLUMNS:
+            s = s.astype('int32')
+        elif col in SMALL_INT_COLUMNS:
+            s = s.astype('int8')
+        out[col] = s
+    return pd.DataFrame(out).reset_index(drop=True)
+
+
+def _partition_keys(df):
+    # Month partitions follow the trip date; fall back to the start timestamp for raw tripdata
+    when = df['date'] if 'date' in df.columns else df['started_at']
+    return when.dt.year, when.dt.month
+
+
+########################## Write ############################################################################################
+
+def partition_path(root, year, month):
+    return os.path.join(root, f'year={int(year)}', f'month={int(month):02d}')
+
+
+def write_trips(df, root=STORE_DIR, part_name='part-0'):
+    """Normalize a trip frame and write one Parquet file per month partition. Returns the written paths."""
+    df = normalize_trips(df)
+    years, months = _partition_keys(df)
+    written = []
+    # year and month are implied by the partition folder and come back from it on read
+    df = df.drop(columns=[c for c in PARTITION_COLUMNS if c in df.columns])
+    for (year, month), idx in df.groupby([years, months], observed=True).groups.items():
+        part = df.loc[idx].copy()
+        # Drop categories that don't occur in this month so each file only carries its own dictionary
+        for col in part.select_dtypes('category').columns:
+            if col != 'season':
+                part[col] = part[col].cat.remove_unused_categories()
+        folder = partition_path(root, year, month)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f'{part_name}.parquet')
+        pq.write_table(pa.Table.from_pandas(part, preserve_index=False), path)
+        written.append(path)
+    return written
+
+
+def convert_csv(csv_path, root=STORE_DIR):
+    """One-off conversion of one of the notebook CSV exports into the store (without the broadcast columns)."""
+    df = pd.read_csv(csv_path)
+    # The notebooks write their frames with the index as an unnamed first column
+    if len(df.columns) and str(df.columns[0]).startswith('Unnamed: '):
+        df = df.drop(columns=df.columns[0])
+    if 'date' not in df.columns and 'started_at' not in df.columns:
+        raise ValueError(f'{csv_path} has neither a date nor a started_at column to partition on')
+    df = df.drop(columns=[c for c in BROADCAST_COLUMNS if c in df.columns])
+    return write_trips(df.reset_index(drop=True), root)
+
+
+########################## Read #############################################################################################
+
+def store_exists(root=STORE_DIR):
+    return os.path.isdir(root) and any(name.startswith('year=') for name in os.listdir(root))
+
+
+def open_store(root=STORE_DIR):
+    return ds.dataset(root, format='parquet', partitioning='hive')
+
+
+def partition_months(root=STORE_DIR):
+    """(year, month) of every month partition, from the folder names alone."""
+    months = []
+    for year in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        if year.startswith('year='):
+            months += [(int(year[5:]), int(month[6:])) for month in sorted(os.listdir(os.path.join(root, year)))
+                       if month.startswith('month=')]
+    return sorted(months)
+
+
+def store_date_range(root=STORE_DIR):
+    """First day of the first month and last day of the last month in the store (None when empty), without opening
+    any file."""
+    months = partition_months(root)
+    if not months:
+        return None
+    first, last = pd.Timestamp(*months[0], 1), pd.Timestamp(*months[-1], 1)
+    return first, last + pd.offsets.MonthEnd(0)
+
+
+def date_filter(start=None, end=None, schema_names=()):
+    """Dataset filter of the trips dated start..end (inclusive dates; None leaves that side open).
+
+    The year / month terms are evaluated against the partition folders, so out-of-range files are never opened. The
+    date (or started_at) terms drop the out-of-range rows of the boundary months.
+    """
+    year, month = ds.field('year'), ds.field('month')
+    when = 'date' if 'date' in schema_names else 'started_at' if 'started_at' in schema_names else None
+    terms = []
+    if start is not None:
+        start = pd.Timestamp(start).normalize()
+        terms.append((year > start.year) | ((year == start.year) & (month >= start.month)))
+        if when is not None:
+            terms.append(ds.field(when) >= start.to_pydatetime())
+    if end is not None:
+        end = pd.Timestamp(end).normalize()
+        terms.append((year < end.year) | ((year == end.year) & (month <= end.month)))
+        if when is not None:
+            terms.append(ds.field(when) < (end + pd.Timedelta(days=1)).to_pydatetime())
+    expression = None
+    for term in terms:
+        expression = term if expression is None else expression & term
+    return expression
+
+
+def read_trips(root=STORE_DIR, columns=None, start=None, end=None):
+    """Read the trips back as a typed DataFrame, only loading the requested columns (and months, see date_filter).
+
+    Station names asked for on a store that only holds station keys are decoded from the station dimension.
+    """
+    dataset = open_store(root)
+    names = dataset.schema.names
+    decode = []
+    if columns is not None:
+        decode = [c for c in columns if c not in names and STATION_KEYS.get(c) in names]
+        columns = [STATION_KEYS[c] if c in decode else c for c in columns if c in names or c in decode]
+    df = dataset.to_table(columns=columns, filter=date_filter(start, end, names)).to_pandas()
+    if 'season' in df.columns:
+        df['season'] = pd.Categorical(df['season'], categories=SEASONS, ordered=True)
+    if decode:
+        df = decode_station_keys(df, read_station_dim(root), [STATION_KEYS[c] for c in decode])
+    return df
+
+
+########################## Station dimension ################################################################################
+
+def station_dim_path(root=STORE_DIR):
+    return os.path.join(root, STATION_DIM_NAME)
+
+
+def read_station_dim(root=STORE_DIR):
+    """station_key, station_name, lat, lng of every station seen so far, ordered by key (empty if none yet)."""
+    path = station_dim_path(root)
+    if not os.path.exists(path):
+        return pd.DataFrame({'station_key': pd.Series(dtype='int32'), 'station_name': pd.Series(dtype=object),
+                             'lat': pd.Series(dtype='float64'), 'lng': pd.Series(dtype='float64')})
+    return pd.read_parquet(path).sort_values('station_key').reset_index(drop=True)
+
+
+def write_station_dim(dim, root=STORE_DIR):
+    os.makedirs(root, exist_ok=True)
+    tmp = station_dim_path(root) + '.tmp'
+    dim[STATION_DIM_COLUMNS].to_parquet(tmp, index=False)
+    os.replace(tmp, station_dim_path(root))
+
+
+def decode_station_keys(df, dim, key_columns=None):
+    """Replace start/end_station_key columns by categorical station names (returns a new frame)."""
+    if key_columns is None:
+        key_columns = [c for c in KEY_COLUMNS if c in df.columns]
+    # Keys are dense (0..n-1), so a key is directly the code of its name
+    names = dim['station_name'].astype(object).to_numpy()
+    key_to_name = {key: name for name, key in STATION_KEYS.items()}
+    out = df.copy(deep=False)
+    for col in key_columns:
+        out[col] = pd.Categorical.from_codes(out[col].to_numpy(), categories=pd.Index(names))
+        out = out.rename(columns={col: key_to_name[col]})
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a Citi Bike CSV export into the partitioned trip store')
+    parser.add_argument('csv_path')
+    parser.add_argument('root', nargs='?', default=STORE_DIR)
+    args = parser.parse_args()
+    paths = convert_csv(args.csv_path, args.root)
+    print(f'Wrote {len(paths)} month partitions to {args.root}')
+    print(f'Build the per-day trip_count / avgTemp with: python daily_facts.py --trips {args.csv_path}')
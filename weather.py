@@ -0,0 +1,219 @@
+################################################ CITIBIKES WEATHER #####################################################
+# NOAA Climate Data Online client for the daily weather used next to the trips.
+#
+# The 2.2 notebook does a single blocking requests.get (one station, TAVG only, limit=1000, no paging). This client:
+#   - splits a request into one query per station and year (the API allows at most a year per query),
+#   - pages through every query with limit/offset,
+#   - runs the pages concurrently with asyncio under a token-bucket rate limiter (NOAA allows 5 requests/second),
+#   - retries rate-limit answers, server errors and timeouts with exponential backoff,
+#   - caches every page on disk keyed by its query, so data we already have is never fetched again.
+#
+# The token is read from the NOAA_TOKEN environment variable. For local runs use the stub server in weather_stub.py:
+#
+#     python weather.py --start 2022-01-01 --end 2022-12-31 --out NYC_LaGuardia_Weather_2022.csv
+#     python weather.py --base-url http://127.0.0.1:8765/cdo-web/api/v2        (python weather_stub.py --port 8765)
+
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import requests
+import pandas as pd
+
+
+BASE_URL = 'https://www.ncdc.noaa.gov/cdo-web/api/v2'
+LAGUARDIA = 'GHCND:USW00014732'
+DATATYPES = ['TAVG', 'TMAX', 'TMIN', 'PRCP', 'SNOW', 'AWND']
+
+PAGE_LIMIT = 1000  # largest page the API serves
+REQUESTS_PER_SECOND = 5
+MAX_CONCURRENCY = 5
+MAX_RETRIES = 5
+TIMEOUT = 30
+CACHE_DIR = 'weather_cache'
+
+# GHCND values come in tenths of a unit (deg C, mm, m/s) except snowfall, which is in mm
+SCALE = {'TAVG': 0.1, 'TMAX': 0.1, 'TMIN': 0.1, 'PRCP': 0.1, 'SNOW': 1.0, 'AWND': 0.1}
+
+# Column names of the daily weather frame (avgTemp as in the notebooks)
+COLUMN_NAMES = {'TAVG': 'avgTemp', 'TMAX': 'maxTemp', 'TMIN': 'minTemp', 'PRCP': 'precipitation',
+                'SNOW': 'snowfall', 'AWND': 'avgWind'}
+
+
+class WeatherAPIError(Exception):
+    pass
+
+
+########################## Rate limiting and caching ########################################################################
+
+class RateLimiter:
+    """Async token bucket: at most `rate` acquisitions per second, with bursts up to `rate`."""
+
+    def __init__(self, rate=REQUESTS_PER_SECOND):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class DiskCache:
+    """One JSON file per query, named after a hash of the query parameters (the token is never part of the key)."""
+
+    def __init__(self, folder=CACHE_DIR):
+        self.folder = folder
+
+    def path(self, endpoint, params):
+        key = json.dumps({'endpoint': endpoint, 'params': sorted(params)}, sort_keys=True)
+        return os.path.join(self.folder, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def get(self, endpoint, params):
+        path = self.path(endpoint, params)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def put(self, endpoint, params, payload):
+        os.makedirs(self.folder, exist_ok=True)
+        path = self.path(endpoint, params)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(payload, f)
+        os.replace(path + '.tmp', path)
+
+
+########################## Client ###########################################################################################
+
+class NOAAClient:
+
+    def __init__(self, token=None, base_url=BASE_URL, cache_dir=CACHE_DIR, rate=REQUESTS_PER_SECOND,
+                 max_concurrency=MAX_CONCURRENCY, max_retries=MAX_RETRIES, timeout=TIMEOUT):
+        self.token = token if token is not None else os.environ.get('NOAA_TOKEN', '')
+        self.base_url = base_url.rstrip('/')
+        self.cache = DiskCache(cache_dir) if cache_dir else None
+        self.rate = rate
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.requests_made = 0
+
+    def _get(self, endpoint, params):
+        response = self.session.get(f'{self.base_url}/{endpoint}', params=params, headers={'token': self.token},
+                                    timeout=self.timeout)
+        self.requests_made += 1
+        return response
+
+    async def _fetch(self, endpoint, params, limiter, slots):
+        """One page, from the disk cache if we have it, otherwise from the API with retries."""
+        params = list(params)
+        if self.cache is not None:
+            cached = self.cache.get(endpoint, params)
+            if cached is not None:
+                return cached
+
+        for attempt in range(self.max_retries + 1):
+            await limiter.acquire()
+            async with slots:
+                try:
+                    response = await asyncio.to_thread(self._get, endpoint, params)
+                except (requests.ConnectionError, requests.Timeout) as error:
+                    response, failure = None, error
+            if response is not None:
+                if response.status_code == 200:
+                    # An empty object means the query has no results
+                    payload = response.json() or {}
+                    if self.cache is not None:
+                        self.cache.put(endpoint, params, payload)
+                    return payload
+                if response.status_code != 429 and response.status_code < 500:
+                    raise WeatherAPIError(f'{response.status_code} for {endpoint} {params}: {response.text[:200]}')
+                failure = WeatherAPIError(f'{response.status_code} for {endpoint} {params}')
+            await asyncio.sleep(min(30, 2 ** attempt) * (0.5 + random.random() / 2))
+        raise failure
+
+    async def _query(self, params, limiter, slots):
+        """All results of one query: the first page tells how many there are, the rest are fetched concurrently."""
+        first = await self._fetch('data', params + [('limit', PAGE_LIMIT), ('offset', 1)], limiter, slots)
+        results = list(first.get('results', []))
+        count = first.get('metadata', {}).get('resultset', {}).get('count', len(results))
+        offsets = range(1 + PAGE_LIMIT, count + 1, PAGE_LIMIT)
+        pages = await asyncio.gather(*(self._fetch('data', params + [('limit', PAGE_LIMIT), ('offset', offset)],
+                                                   limiter, slots) for offset in offsets))
+        for page in pages:
+            results.extend(page.get('results', []))
+        return results
+
+    async def fetch_daily_async(self, start, end, stations=(LAGUARDIA,), datatypes=DATATYPES):
+        limiter = RateLimiter(self.rate)
+        slots = asyncio.Semaphore(self.max_concurrency)
+        queries = []
+        for station in stations:
+            for year_start, year_end in year_ranges(start, end):
+                params = [('datasetid', 'GHCND'), ('stationid', station),
+                          ('startdate', year_start), ('enddate', year_end)]
+                params += [('datatypeid', datatype) for datatype in sorted(datatypes)]
+                queries.append(params)
+        results = await asyncio.gather(*(self._query(params, limiter, slots) for params in queries))
+        return to_frame([row for rows in results for row in rows])
+
+    def fetch_daily(self, start, end, stations=(LAGUARDIA,), datatypes=DATATYPES):
+        """Daily GHCND observations as a long frame: date, station, datatype, value (converted units)."""
+        return asyncio.run(self.fetch_daily_async(start, end, stations, datatypes))
+
+
+########################## Helpers ##########################################################################################
+
+def year_ranges(start, end):
+    """Split [start, end] into calendar-year chunks, the largest range one query may ask for."""
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    ranges = []
+    while start <= end:
+        year_end = min(end, pd.Timestamp(year=start.year, month=12, day=31))
+        ranges.append((start.strftime('%Y-%m-%d'), year_end.strftime('%Y-%m-%d')))
+        start = year_end + pd.Timedelta(days=1)
+    return ranges
+
+
+def to_frame(results):
+    df = pd.DataFrame(results, columns=['date', 'datatype', 'station', 'attributes', 'value'])
+    df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%dT%H:%M:%S')
+    df['value'] = df['value'].astype('float64') * df['datatype'].map(SCALE).fillna(1.0)
+    return df[['date', 'station', 'datatype', 'value']].sort_values(['station', 'datatype', 'date'], ignore_index=True)
+
+
+def daily_weather(observations, station=LAGUARDIA):
+    """One row per date for one station, with a column per measure (avgTemp, maxTemp, ...)."""
+    rows = observations[observations['station'] == station]
+    wide = rows.pivot_table(index='date', columns='datatype', values='value', aggfunc='mean')
+    wide = wide[[d for d in DATATYPES if d in wide.columns] + [d for d in wide.columns if d not in DATATYPES]]
+    return wide.rename(columns=COLUMN_NAMES).rename_axis(columns=None).reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download daily NOAA weather for the Citi Bike analysis')
+    parser.add_argument('--start', default='2022-01-01')
+    parser.add_argument('--end', default='2022-12-31')
+    parser.add_argument('--stations', nargs='+', default=[LAGUARDIA])
+    parser.add_argument('--datatypes', nargs='+', default=DATATYPES)
+    parser.add_argument('--base-url', default=BASE_URL, help='e.g. http://127.0.0.1:8765/cdo-web/api/v2 for weather_stub.py')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--out', default='NYC_Weather.csv')
+    args = parser.parse_args()
+    client = NOAAClient(base_url=args.base_url, cache_dir=args.cache_dir)
+    observations = client.fetch_daily(args.start, args.end, args.stations, args.datatypes)
+    observations.to_csv(args.out, index=False)
+    print(f'Wrote {len(observations):,} observations to {args.out} ({client.requests_made} API requests)')
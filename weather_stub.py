@@ -0,0 +1,119 @@
+################################################ NOAA STUB SERVER #####################################################
+# Local stand-in for the NOAA CDO v2 'data' endpoint, to develop and test weather.py (tests/test_weather.py) without
+# a token or network.
+#
+# Serves deterministic synthetic GHCND daily values for any station / datatype / date range, with the same
+# limit/offset paging and metadata as the real API. It can also reject a share of requests with 429 or 503 to
+# exercise the client's retries, and counts every request it answers.
+#
+#     python weather_stub.py --port 8765
+#     python weather.py --base-url http://127.0.0.1:8765/cdo-web/api/v2
+#
+# From Python: server, base_url = start_stub_server(); ...; server.shutdown()
+
+import math
+import json
+import random
+import argparse
+import threading
+from datetime import date, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+API_PATH = '/cdo-web/api/v2'
+
+
+def synthetic_value(station, datatype, day):
+    """Plausible New York values in GHCND units (tenths), repeatable for the same inputs."""
+    seasonal = math.sin((day.timetuple().tm_yday - 105) / 365 * 2 * math.pi)
+    noise = random.Random(f'{station}|{datatype}|{day}').gauss(0, 1)
+    if datatype == 'TAVG':
+        return round(130 + 120 * seasonal + 30 * noise)
+    if datatype == 'TMAX':
+        return round(180 + 120 * seasonal + 30 * noise)
+    if datatype == 'TMIN':
+        return round(80 + 110 * seasonal + 30 * noise)
+    if datatype == 'PRCP':
+        return max(0, round(40 * noise))
+    if datatype == 'SNOW':
+        return max(0, round(50 * noise * (seasonal < -0.5)))
+    if datatype == 'AWND':
+        return round(45 + 10 * abs(noise))
+    return round(100 * noise)
+
+
+def query_results(params):
+    stations = params.get('stationid', ['GHCND:USW00014732'])
+    datatypes = params.get('datatypeid', ['TAVG'])
+    start = date.fromisoformat(params['startdate'][0][:10])
+    end = date.fromisoformat(params['enddate'][0][:10])
+    results = []
+    day = start
+    while day <= end:
+        for datatype in sorted(datatypes):
+            for station in stations:
+                results.append({'date': f'{day.isoformat()}T00:00:00', 'datatype': datatype, 'station': station,
+                                'attributes': ',,W,2400', 'value': synthetic_value(station, datatype, day)})
+        day += timedelta(days=1)
+    return results
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    token = None
+    failure_rate = 0.0
+    requests_served = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        with StubHandler.lock:
+            StubHandler.requests_served += 1
+        if not url.path.endswith('/data'):
+            return self._send(404, {'message': 'not found'})
+        if self.token is not None and self.headers.get('token') != self.token:
+            return self._send(400, {'message': 'token parameter is required'})
+        if self.failure_rate and random.random() < self.failure_rate:
+            return self._send(random.choice([429, 503]), {'message': 'try again'})
+
+        results = query_results(params)
+        limit = min(int(params.get('limit', ['25'])[0]), 1000)
+        offset = int(params.get('offset', ['1'])[0])
+        page = results[offset - 1:offset - 1 + limit]
+        if not page:
+            # Like the real API: an empty object when nothing matches
+            return self._send(200, {})
+        self._send(200, {'metadata': {'resultset': {'offset': offset, 'count': len(results), 'limit': limit}},
+                         'results': page})
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(port=0, token=None, failure_rate=0.0):
+    """Start the stub in a background thread. Returns (server, base_url); stop it with server.shutdown()."""
+    handler = type('Handler', (StubHandler,), {'token': token, 'failure_rate': failure_rate})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}{API_PATH}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a local stub of the NOAA CDO v2 data endpoint')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--token', default=None, help='require this token header')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of requests answered with 429/503')
+    args = parser.parse_args()
+    handler = type('Handler', (StubHandler,), {'token': args.token, 'failure_rate': args.failure_rate})
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), handler)
+    print(f'NOAA stub listening on http://127.0.0.1:{args.port}{API_PATH}')
+    server.serve_forever()